@@ -4,17 +4,16 @@ import queue
 import tkinter as tk
 from tkinter import scrolledtext, messagebox
 from dotenv import load_dotenv, find_dotenv
-from openai import OpenAI
+from llm_client import get_client
+from llm_metrics import create_completion, serve_metrics
 
 load_dotenv(find_dotenv())
 
-api_key = os.getenv("OPENAI_API_KEY")
-base_url = os.getenv("OPENAI_BASE_URL")
-
-if not api_key:
-    raise RuntimeError("OPENAI_API_KEY is not set. Please set it in your environment or in a .env file.")
-
-client = OpenAI(api_key=api_key, base_url=base_url) if base_url else OpenAI(api_key=api_key)
+# Render loop: ~60 fps while tokens flow, backing off to IDLE_POLL_MS when quiet
+ACTIVE_POLL_MS = 16
+IDLE_POLL_MS = 200
+# Older transcript lines are dropped so insert/redraw cost stays bounded in long sessions
+MAX_TRANSCRIPT_LINES = 5000
 
 
 class ChatApplication:
@@ -23,13 +22,29 @@ class ChatApplication:
         self.root.title("Киберленинка")
 
         self.chat_display = scrolledtext.ScrolledText(self.root, wrap=tk.WORD, state=tk.DISABLED, width=80, height=24)
-        self.chat_display.grid(row=0, column=0, columnspan=2, padx=10, pady=10, sticky="nsew")
+        self.chat_display.grid(row=0, column=0, columnspan=3, padx=10, pady=10, sticky="nsew")
+
+        # Collapsible pane with the model's reasoning tokens (deepseek-reasoner reasoning_content)
+        self.reasoning_display = scrolledtext.ScrolledText(
+            self.root, wrap=tk.WORD, state=tk.DISABLED, width=80, height=8, foreground="gray40"
+        )
+        self.reasoning_display.grid(row=1, column=0, columnspan=3, padx=10, pady=(0, 10), sticky="nsew")
+        self.reasoning_display.grid_remove()
+
+        self.show_reasoning = tk.BooleanVar(value=False)
+        self.reasoning_toggle = tk.Checkbutton(
+            self.root, text="Показывать рассуждения", variable=self.show_reasoning, command=self._toggle_reasoning
+        )
+        self.reasoning_toggle.grid(row=3, column=0, padx=10, pady=(0, 10), sticky="w")
 
         self.user_input = tk.Text(self.root, height=3, width=70)
-        self.user_input.grid(row=1, column=0, padx=10, pady=(0, 10), sticky="ew")
+        self.user_input.grid(row=2, column=0, padx=10, pady=(0, 10), sticky="ew")
 
         self.send_button = tk.Button(self.root, text="Отправить", command=self.on_send)
-        self.send_button.grid(row=1, column=1, padx=10, pady=(0, 10), sticky="e")
+        self.send_button.grid(row=2, column=1, padx=(10, 0), pady=(0, 10), sticky="e")
+
+        self.stop_button = tk.Button(self.root, text="Стоп", command=self.on_stop, state=tk.DISABLED)
+        self.stop_button.grid(row=2, column=2, padx=10, pady=(0, 10), sticky="e")
 
         self.root.grid_rowconfigure(0, weight=1)
         self.root.grid_columnconfigure(0, weight=1)
@@ -43,18 +58,47 @@ class ChatApplication:
 
         self.stream_queue: "queue.Queue[str | tuple]" = queue.Queue()
         self.streaming_in_progress = False
+        self._poll_interval = IDLE_POLL_MS
+        # Cancellation of the running generation: the event is checked per chunk,
+        # closing the response aborts a blocked read and frees the connection
+        self._cancel_event = threading.Event()
+        self._active_response = None
 
-        self.root.after(50, self._poll_stream_queue)
+        self.root.after(self._poll_interval, self._poll_stream_queue)
 
     def _handle_enter(self, event: tk.Event) -> str:
         self.on_send()
         return "break"
 
+    def _toggle_reasoning(self) -> None:
+        if self.show_reasoning.get():
+            self.reasoning_display.grid()
+        else:
+            self.reasoning_display.grid_remove()
+
     def append_to_chat(self, text: str) -> None:
-        self.chat_display.configure(state=tk.NORMAL)
-        self.chat_display.insert(tk.END, text)
-        self.chat_display.see(tk.END)
-        self.chat_display.configure(state=tk.DISABLED)
+        self._append(self.chat_display, text)
+
+    def append_to_reasoning(self, text: str) -> None:
+        self._append(self.reasoning_display, text)
+
+    def _append(self, widget: scrolledtext.ScrolledText, text: str) -> None:
+        if not text:
+            return
+        # Only follow the tail if the user hasn't scrolled up to read something
+        at_bottom = widget.yview()[1] >= 0.999
+        widget.configure(state=tk.NORMAL)
+        widget.insert(tk.END, text)
+        self._trim_transcript(widget)
+        if at_bottom:
+            widget.see(tk.END)
+        widget.configure(state=tk.DISABLED)
+
+    def _trim_transcript(self, widget: scrolledtext.ScrolledText) -> None:
+        line_count = int(widget.index("end-1c").split(".")[0])
+        excess = line_count - MAX_TRANSCRIPT_LINES
+        if excess > 0:
+            widget.delete("1.0", f"{excess + 1}.0")
 
     def on_send(self) -> None:
         if self.streaming_in_progress:
@@ -67,63 +111,135 @@ class ChatApplication:
         self.user_input.delete("1.0", tk.END)
 
         self.append_to_chat(f"Вы: {user_text}\n")
+        self.append_to_reasoning(f"— {user_text}\n")
 
         self.conversation_messages.append({"role": "user", "content": user_text})
 
         self.streaming_in_progress = True
+        self._cancel_event = threading.Event()
         self.send_button.configure(state=tk.DISABLED)
-        threading.Thread(target=self._stream_assistant_reply, daemon=True).start()
-
-    def _stream_assistant_reply(self) -> None:
+        self.stop_button.configure(state=tk.NORMAL)
+        threading.Thread(
+            target=self._stream_assistant_reply,
+            args=(list(self.conversation_messages), self._cancel_event),
+            daemon=True,
+        ).start()
+
+    def on_stop(self) -> None:
+        if not self.streaming_in_progress:
+            return
+        self._cancel_event.set()
+        self.stop_button.configure(state=tk.DISABLED)
+        response = self._active_response
+        if response is not None:
+            try:
+                response.close()
+            except Exception:
+                pass
+
+    def _stream_assistant_reply(self, messages: list[dict[str, str]], cancel_event: threading.Event) -> None:
+        accumulated_text_parts: list[str] = []
+        response = None
         try:
             self.stream_queue.put(("prefix", "Ассистент: "))
 
-            response = client.chat.completions.create(
+            response = create_completion(
+                get_client(),
+                agent="ChatApplication",
                 model="deepseek-reasoner",
-                messages=self.conversation_messages,
+                messages=messages,
                 stream=True,
                 temperature=0.2,
             )
+            self._active_response = response
+            if cancel_event.is_set():
+                response.close()
 
-            accumulated_text_parts: list[str] = []
             for chunk in response:
+                if cancel_event.is_set():
+                    break
+                if not chunk.choices:
+                    continue
+                reasoning = getattr(chunk.choices[0].delta, "reasoning_content", None)
+                if reasoning:
+                    self.stream_queue.put(("reasoning", reasoning))
                 delta = getattr(chunk.choices[0].delta, "content", None)
                 if delta:
                     self.stream_queue.put(("token", delta))
                     accumulated_text_parts.append(delta)
+        except Exception as e:
+            if not cancel_event.is_set():
+                self.stream_queue.put(("error", str(e)))
+                return
+        finally:
+            self._active_response = None
 
-            assistant_text = "".join(accumulated_text_parts)
-            self.conversation_messages.append({"role": "assistant", "content": assistant_text})
+        if cancel_event.is_set():
+            if response is not None:
+                response.close()
+            self.stream_queue.put(("cancelled", "".join(accumulated_text_parts)))
+            return
 
-            self.stream_queue.put(("done", "\n"))
-        except Exception as e:
-            self.stream_queue.put(("error", str(e)))
+        assistant_text = "".join(accumulated_text_parts)
+        self.stream_queue.put(("done", assistant_text))
+
+    def _finish_stream(self) -> None:
+        self.streaming_in_progress = False
+        self.send_button.configure(state=tk.NORMAL)
+        self.stop_button.configure(state=tk.DISABLED)
 
     def _poll_stream_queue(self) -> None:
+        # Drain everything queued since the last frame and render it with one insert
+        pending: list[str] = []
+        pending_reasoning: list[str] = []
+        drained = 0
         try:
             while True:
                 item = self.stream_queue.get_nowait()
+                drained += 1
                 kind, payload = item if isinstance(item, tuple) else ("token", item)
 
-                if kind == "prefix":
-                    self.append_to_chat(str(payload))
-                elif kind == "token":
-                    self.append_to_chat(str(payload))
-                elif kind == "done":
-                    self.append_to_chat(str(payload))
-                    self.streaming_in_progress = False
-                    self.send_button.configure(state=tk.NORMAL)
+                if kind in ("prefix", "token"):
+                    pending.append(str(payload))
+                elif kind == "reasoning":
+                    pending_reasoning.append(str(payload))
+                elif kind in ("done", "cancelled"):
+                    # History is only touched from the UI thread
+                    if kind == "done" or payload:
+                        self.conversation_messages.append({"role": "assistant", "content": str(payload)})
+                    elif self.conversation_messages[-1]["role"] == "user":
+                        # Stopped before any answer: drop the question so roles keep alternating
+                        self.conversation_messages.pop()
+                    pending.append("\n" if kind == "done" else " [остановлено]\n")
+                    pending_reasoning.append("\n")
+                    self._finish_stream()
                 elif kind == "error":
-                    self.streaming_in_progress = False
-                    self.send_button.configure(state=tk.NORMAL)
+                    if self.conversation_messages[-1]["role"] == "user":
+                        # No answer made it into history: drop the question, as on a stop
+                        self.conversation_messages.pop()
+                    self.append_to_chat("".join(pending))
+                    pending.clear()
+                    self._finish_stream()
                     messagebox.showerror("Ошибка", f"Произошла ошибка: {payload}")
         except queue.Empty:
             pass
         finally:
-            self.root.after(50, self._poll_stream_queue)
-
+            self.append_to_chat("".join(pending))
+            self.append_to_reasoning("".join(pending_reasoning))
+            if drained or self.streaming_in_progress:
+                self._poll_interval = ACTIVE_POLL_MS
+            else:
+                self._poll_interval = min(IDLE_POLL_MS, self._poll_interval * 2)
+            self.root.after(self._poll_interval, self._poll_stream_queue)
 
 def main() -> None:
+    if not os.getenv("OPENAI_API_KEY"):
+        raise RuntimeError("OPENAI_API_KEY is not set. Please set it in your environment or in a .env file.")
+
+    # Prometheus metrics for the LLM calls on :METRICS_PORT/metrics
+    if os.getenv("METRICS_PORT"):
+        serve_metrics(int(os.environ["METRICS_PORT"]))
+
     root = tk.Tk()
     app = ChatApplication(root)
     root.mainloop()
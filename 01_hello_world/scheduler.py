@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Hashable, List, Optional
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# Chat the current task works for; handlers set it once, tasks they spawn inherit it
+CURRENT_CHAT: contextvars.ContextVar[Optional[Hashable]] = contextvars.ContextVar("llm_chat", default=None)
+
+
+def set_chat(chat_id: Hashable) -> None:
+    CURRENT_CHAT.set(chat_id)
+
+
+def estimate_prompt_tokens(messages: List[Dict[str, Any]]) -> int:
+    # Same heuristic as history compaction: ~3 chars per token plus per-message framing
+    return sum(4 + len(str(m.get("content") or "")) // 3 for m in messages)
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, burst: Optional[float] = None) -> None:
+        self.rate = per_minute / 60.0
+        # Providers refill continuously, so by default allow only about a second's worth at once
+        self.capacity = burst if burst is not None else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        # Oversized requests only need a full bucket, otherwise they would never pass
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= amount
+
+
+class _Waiter:
+    __slots__ = ("future", "tokens")
+
+    def __init__(self, future: asyncio.Future, tokens: int) -> None:
+        self.future = future
+        self.tokens = tokens
+
+
+class LLMScheduler:
+    # Admission control for LLM calls shared by every chat in the process.
+    # Calls wait in per-priority queues; inside a priority, chats are served
+    # round-robin so one busy chat cannot starve the others. A call is released
+    # once both the requests/minute and tokens/minute buckets can pay for it.
+
+    def __init__(self, rpm: float = 0, tpm: float = 0) -> None:
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self._queues: Dict[int, "OrderedDict[Hashable, Deque[_Waiter]]"] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @classmethod
+    def from_env(cls) -> "LLMScheduler":
+        return cls(rpm=float(os.getenv("LLM_RPM", "0")), tpm=float(os.getenv("LLM_TPM", "0")))
+
+    @property
+    def enabled(self) -> bool:
+        return self.requests is not None or self.tokens is not None
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(q) for chats in self._queues.values() for q in chats.values())
+
+    async def acquire(self, tokens: int, *, priority: int = PRIORITY_INTERACTIVE) -> None:
+        if not self.enabled:
+            return
+        chat = CURRENT_CHAT.get()
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), tokens)
+        self._queues.setdefault(priority, OrderedDict()).setdefault(chat, deque()).append(waiter)
+        self._release()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Granted at the same moment we were cancelled: give the budget back
+                self.refund(1, tokens)
+            else:
+                self._forget(priority, chat, waiter)
+            raise
+
+    def settle(self, estimated: int, actual: int) -> None:
+        # Charge the real usage once the response reports it (may run the bucket into debt)
+        if self.tokens is not None:
+            self.tokens.take(actual - estimated)
+
+    def refund(self, requests: int, tokens: int) -> None:
+        if self.requests is not None:
+            self.requests.take(-requests)
+        if self.tokens is not None:
+            self.tokens.take(-tokens)
+        self._release()
+
+    def _next(self) -> Optional[tuple[int, Hashable, _Waiter]]:
+        for priority in sorted(self._queues):
+            chats = self._queues[priority]
+            for chat, queue in chats.items():
+                return priority, chat, queue[0]
+        return None
+
+    def _release(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while True:
+            head = self._next()
+            if head is None:
+                return
+            priority, chat, waiter = head
+            if waiter.future.done():
+                # Cancelled while still queued: drop it without charging the buckets
+                self._pop(priority, chat)
+                continue
+            wait = max(
+                self.requests.wait_time(1) if self.requests is not None else 0.0,
+                self.tokens.wait_time(waiter.tokens) if self.tokens is not None else 0.0,
+            )
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._release)
+                return
+            self._pop(priority, chat)
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(waiter.tokens)
+            waiter.future.set_result(None)
+
+    def _pop(self, priority: int, chat: Hashable) -> None:
+        chats = self._queues[priority]
+        queue = chats.pop(chat)
+        queue.popleft()
+        if queue:
+            # Round-robin: the chat goes to the back of the line with its remaining calls
+            chats[chat] = queue
+        if not chats:
+            del self._queues[priority]
+
+    def _forget(self, priority: int, chat: Hashable, waiter: _Waiter) -> None:
+        chats = self._queues.get(priority)
+        queue = chats.get(chat) if chats is not None else None
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        if not queue:
+            del chats[chat]
+        if not chats:
+            del self._queues[priority]
+        self._release()
+
+
+SCHEDULER = LLMScheduler.from_env()
@@ -1,41 +1,72 @@
 from __future__ import annotations
 
+import asyncio
 from dataclasses import dataclass
-import json
+from typing import Awaitable, Callable
 import os
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+from llm_client import get_async_client, get_client
+from llm_metrics import acreate_completion, create_completion
+from cache import ResponseCache, make_key
+from similar import NearDuplicateIndex
+from prompts import SystemPrompt
+from structured import JSON_MODE_UNSUPPORTED, CompiledSchema, StructuredOutput, compile_template, render
+
+
+SYSTEM_PROMPT_BASE = (
+    "Ты — историк-агент. Твоя задача — отвечать на вопросы о биографии людей. "
+    "Ты должен возвращать ответ строго в формате и схеме, заданных во внешнем шаблоне (template.json). "
+    "Если вопрос не о конкретном человеке, ответь обычным текстом: 'У меня нет компетенций отвечать на это. Уточните имя человека.'"
+)
 
 
 class FormattingAgent:
-    def __init__(self, client: OpenAI, model: str = "deepseek-chat", temperature: float = 0.6) -> None:
+    def __init__(
+        self,
+        client: OpenAI | None = None,
+        model: str = "deepseek-chat",
+        temperature: float = 0.6,
+        *,
+        async_client: AsyncOpenAI | None = None,
+        cache: ResponseCache | None = None,
+        similar: NearDuplicateIndex | None = None,
+        structured: bool = True,
+    ) -> None:
+        if client is None:
+            # Shared pooled clients from llm_client, built on first use
+            client, async_client = get_client(), async_client or get_async_client()
         self.client = client
+        self.async_client = async_client
+        self.cache = cache
+        # Rephrased repeats of answered questions ("кто такой А.С. Пушкин" after "биография Пушкина")
+        self.similar = similar if cache is not None else None
         self.model = model
         self.temperature = temperature
-        self._template: dict | None = None
-        self._load_template()
+        # Validate JSON answers against template.json's schema and repair broken fields
+        self.structured = structured
+        self._prompt = SystemPrompt(SYSTEM_PROMPT_BASE, os.path.join(os.path.dirname(__file__), "template.json"))
 
-    def _load_template(self) -> None:
-        template_path = os.path.join(os.path.dirname(__file__), "template.json")
-        try:
-            with open(template_path, "r", encoding="utf-8") as f:
-                self._template = json.load(f)
-        except Exception:
-            self._template = None
+    @property
+    def _template(self) -> dict | None:
+        return self._prompt.template
 
-    def _build_system_prompt(self) -> str:
-        base = (
-            "Ты — историк-агент. Твоя задача — отвечать на вопросы о биографии людей. "
-            "Ты должен возвращать ответ строго в формате и схеме, заданных во внешнем шаблоне (template.json). "
-            "Если вопрос не о конкретном человеке, ответь обычным текстом: 'У меня нет компетенций отвечать на это. Уточните имя человека.'"
-        )
+    @property
+    def prompt_fingerprint(self) -> str:
+        return self._prompt.fingerprint
 
-        if self._template:
-            try:
-                template_str = json.dumps(self._template, ensure_ascii=False)
-                return base + "\nТребования формата (JSON):\n" + template_str
-            except Exception:
-                return base
-        return base
+    @property
+    def _schema(self) -> CompiledSchema | None:
+        return compile_template(self._template) if self.structured else None
+
+    @property
+    def _json_mode(self) -> bool:
+        return self._schema is not None and self.model not in JSON_MODE_UNSUPPORTED
+
+    def _format_kwargs(self) -> dict:
+        return {"response_format": {"type": "json_object"}} if self._json_mode else {}
+
+    def _build_system_prompt(self) -> str:
+        return self._prompt.text
 
     def _detect_lang(self, text: str) -> str:
         lower = text.lower()
@@ -49,31 +80,118 @@ class FormattingAgent:
         colon_lines = sum(1 for ln in lines[:10] if ":" in ln and not ln.strip().startswith("#"))
         return "yaml" if colon_lines >= 2 else "text"
 
+    async def _astream_text(self, messages: list[dict[str, str]], on_delta: Callable[[str], Awaitable[None]]) -> str:
+        stream = await acreate_completion(
+            self.async_client,
+            agent=type(self).__name__,
+            model=self.model,
+            messages=messages,
+            temperature=self.temperature,
+            stream=True,
+            **self._format_kwargs(),
+        )
+        parts: list[str] = []
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    await on_delta(delta)
+        except BaseException:
+            # Stopped early (superseded reply, failed edit): free the connection
+            await stream.close()
+            raise
+        return "".join(parts)
+
     @dataclass
     class ReplyPayload:
         text: str
         use_markdown: bool
 
-    def reply_payload(self, user_text: str) -> "FormattingAgent.ReplyPayload":
-        messages = [
+    def _build_messages(self, user_text: str) -> list[dict[str, str]]:
+        return [
             {"role": "system", "content": self._build_system_prompt()},
             {
                 "role": "user",
                 "content": (
                     "Ответь на вопрос о биографии человека, используя строго схему из template.json и формат desired_format. "
-                    "Если вопрос не о человеке — ответь обычным текстом о нехватке компетенций.\n"
-                    f"Вопрос: {user_text}"
+                    + (
+                        'Если вопрос не о человеке — верни JSON {"message": "<объяснение о нехватке компетенций>"}.\n'
+                        if self._json_mode
+                        else "Если вопрос не о человеке — ответь обычным текстом о нехватке компетенций.\n"
+                    )
+                    + f"Вопрос: {user_text}"
                 ),
             },
         ]
 
-        response = self.client.chat.completions.create(
+    def _payload_from_response(self, response) -> "FormattingAgent.ReplyPayload":
+        text = response.choices[0].message.content or ""
+        output = self._structured_output(sync=True)
+        if output is None:
+            return self._payload_from_text(text)
+        output.feed(text)
+        return self._payload_from_structured(output, text, output.result(self._repair_text))
+
+    async def _apayload_from_response(self, response) -> "FormattingAgent.ReplyPayload":
+        text = response.choices[0].message.content or ""
+        output = self._structured_output()
+        if output is None:
+            return self._payload_from_text(text)
+        output.feed(text)
+        return self._payload_from_structured(output, text, await self._aresult(output))
+
+    def _structured_output(self, *, sync: bool = False) -> StructuredOutput | None:
+        schema = self._schema
+        if schema is None:
+            return None
+        return StructuredOutput(schema, arepair=None if sync else self._arepair_text)
+
+    async def _aresult(self, output: StructuredOutput) -> dict | None:
+        if self._refusal(output) is not None:
+            output.cancel()
+            return None
+        return await output.aresult()
+
+    def _refusal(self, output: StructuredOutput) -> str | None:
+        # JSON mode answers off-topic questions as {"message": ...}
+        value = output.value
+        if isinstance(value, dict) and set(value) == {"message"}:
+            return str(value["message"])
+        return None
+
+    def _payload_from_structured(
+        self, output: StructuredOutput, text: str, document: dict | None
+    ) -> "FormattingAgent.ReplyPayload":
+        refusal = self._refusal(output)
+        if refusal is not None:
+            return self.ReplyPayload(text=refusal, use_markdown=False)
+        if document is None:
+            # Not a JSON object (or not parseable): render it as before
+            return self._payload_from_text(text)
+        return self.ReplyPayload(text=render(document), use_markdown=True)
+
+    def _repair_kwargs(self, messages: list[dict[str, str]]) -> dict:
+        return dict(
+            agent=f"{type(self).__name__}Repair",
             model=self.model,
             messages=messages,
-            temperature=self.temperature,
+            temperature=0.0,
+            **self._format_kwargs(),
         )
 
-        content = (response.choices[0].message.content or "").strip()
+    def _repair_text(self, messages: list[dict[str, str]]) -> str:
+        response = create_completion(self.client, **self._repair_kwargs(messages))
+        return response.choices[0].message.content or ""
+
+    async def _arepair_text(self, messages: list[dict[str, str]]) -> str:
+        response = await acreate_completion(self.async_client, **self._repair_kwargs(messages))
+        return response.choices[0].message.content or ""
+
+    def _payload_from_text(self, text: str) -> "FormattingAgent.ReplyPayload":
+        content = text.strip()
         lang = self._detect_lang(content)
 
         if lang == "fenced":
@@ -85,6 +203,105 @@ class FormattingAgent:
         fenced = f"```{lang}\n{content}\n```"
         return self.ReplyPayload(text=fenced, use_markdown=True)
 
+    def _cache_key(self, user_text: str) -> str | None:
+        if self.cache is None:
+            return None
+        # A changed template.json changes the prompt fingerprint, so stale entries never match
+        return make_key(user_text, self.prompt_fingerprint, self.model, self.temperature)
+
+    @property
+    def _cache_scope(self) -> str:
+        # Near-duplicates only match answers given under the same prompt, model and temperature
+        return f"{self.prompt_fingerprint}\x1f{self.model}\x1f{self.temperature:.3f}"
+
+    def _cached_payload(self, key: str | None, user_text: str) -> "FormattingAgent.ReplyPayload | None":
+        if key is None or self.cache is None:
+            return None
+        cached = self.cache.get(key)
+        if cached is None and self.similar is not None:
+            cached = self.similar.lookup(user_text, self._cache_scope, self.cache.get)
+        if cached is None:
+            return None
+        return self.ReplyPayload(text=cached[0], use_markdown=cached[1])
+
+    def _remember_payload(self, key: str | None, user_text: str, payload: "FormattingAgent.ReplyPayload") -> None:
+        if key is not None and self.cache is not None:
+            self.cache.put(key, (payload.text, payload.use_markdown))
+            if self.similar is not None:
+                self.similar.add(user_text, key, self._cache_scope)
+
+    def reply_payload(self, user_text: str) -> "FormattingAgent.ReplyPayload":
+        key = self._cache_key(user_text)
+        cached = self._cached_payload(key, user_text)
+        if cached is not None:
+            return cached
+
+        response = create_completion(
+            self.client,
+            agent=type(self).__name__,
+            model=self.model,
+            messages=self._build_messages(user_text),
+            temperature=self.temperature,
+            **self._format_kwargs(),
+        )
+        payload = self._payload_from_response(response)
+        self._remember_payload(key, user_text, payload)
+        return payload
+
+    async def areply_payload(self, user_text: str) -> "FormattingAgent.ReplyPayload":
+        if self.async_client is None:
+            # No async client configured: keep the event loop free the old way
+            return await asyncio.to_thread(self.reply_payload, user_text)
+
+        key = self._cache_key(user_text)
+        cached = self._cached_payload(key, user_text)
+        if cached is not None:
+            return cached
+
+        response = await acreate_completion(
+            self.async_client,
+            agent=type(self).__name__,
+            model=self.model,
+            messages=self._build_messages(user_text),
+            temperature=self.temperature,
+            **self._format_kwargs(),
+        )
+        payload = await self._apayload_from_response(response)
+        self._remember_payload(key, user_text, payload)
+        return payload
+
+    async def astream_reply_payload(
+        self, user_text: str, on_delta: Callable[[str], Awaitable[None]]
+    ) -> "FormattingAgent.ReplyPayload":
+        # Same as areply_payload, but raw tokens are passed to on_delta as they arrive
+        if self.async_client is None:
+            return await self.areply_payload(user_text)
+
+        key = self._cache_key(user_text)
+        cached = self._cached_payload(key, user_text)
+        if cached is not None:
+            return cached
+
+        output = self._structured_output()
+        if output is None:
+            text = await self._astream_text(self._build_messages(user_text), on_delta)
+            payload = self._payload_from_text(text)
+        else:
+
+            async def on_text(delta: str) -> None:
+                # Fields are validated as they close; broken ones get repaired while the rest streams
+                output.feed(delta)
+                await on_delta(delta)
+
+            try:
+                text = await self._astream_text(self._build_messages(user_text), on_text)
+            except BaseException:
+                output.cancel()
+                raise
+            payload = self._payload_from_structured(output, text, await self._aresult(output))
+        self._remember_payload(key, user_text, payload)
+        return payload
+
     def reply(self, user_text: str) -> str:
         payload = self.reply_payload(user_text)
         return payload.text
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+# Cached value: (text, use_markdown) — exactly what FormattingAgent.ReplyPayload needs
+CachedReply = Tuple[str, bool]
+
+_PUNCT_RE = re.compile(r"[^\w\s]+", re.UNICODE)
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_question(text: str) -> str:
+    lowered = text.casefold().replace("ё", "е")
+    return _SPACE_RE.sub(" ", _PUNCT_RE.sub(" ", lowered)).strip()
+
+
+def make_key(question: str, prompt_fingerprint: str, model: str, temperature: float) -> str:
+    raw = "\x1f".join([normalize_question(question), prompt_fingerprint, model, f"{temperature:.3f}"])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class SqliteCacheBackend:
+    def __init__(self, path: str) -> None:
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS replies (key TEXT PRIMARY KEY, text TEXT NOT NULL, use_markdown INTEGER NOT NULL, expires REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str, now: float) -> Optional[Tuple[CachedReply, float]]:
+        with self._lock:
+            row = self._conn.execute("SELECT text, use_markdown, expires FROM replies WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[2] <= now:
+                self._conn.execute("DELETE FROM replies WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+        return (row[0], bool(row[1])), row[2]
+
+    def put(self, key: str, value: CachedReply, expires: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO replies (key, text, use_markdown, expires) VALUES (?, ?, ?, ?)",
+                (key, value[0], int(value[1]), expires),
+            )
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM replies")
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        *,
+        max_entries: int = 2048,
+        ttl: float = 7 * 24 * 3600,
+        backend: Optional[SqliteCacheBackend] = None,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[CachedReply, float]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[CachedReply]:
+        now = time.time()
+        item = self._entries.get(key)
+        if item is not None and item[1] <= now:
+            del self._entries[key]
+            item = None
+        if item is None and self.backend is not None:
+            item = self.backend.get(key, now)
+            if item is not None:
+                self._remember(key, item)
+        if item is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def put(self, key: str, value: CachedReply) -> None:
+        item = (value, time.time() + self.ttl)
+        self._remember(key, item)
+        if self.backend is not None:
+            self.backend.put(key, value, item[1])
+
+    def clear(self) -> None:
+        self._entries.clear()
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+        }
+
+    def _remember(self, key: str, item: Tuple[CachedReply, float]) -> None:
+        self._entries[key] = item
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -3,18 +3,27 @@ import os
 from aiogram import Bot, Dispatcher, Router
 from aiogram.filters import CommandStart
 from aiogram.types import Message
-from aiogram.enums import ParseMode, ChatAction
+from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from dotenv import load_dotenv, find_dotenv
-from openai import OpenAI
+from chat_action import HEARTBEAT
+from llm_client import aclose_clients
+from llm_metrics import serve_metrics
+from resilience import CircuitOpenError
+from scheduler import set_chat
 from agent import FormattingAgent
+from streaming import TelegramStreamer
+from cache import ResponseCache, SqliteCacheBackend
+from similar import NearDuplicateIndex, SqliteIndexBackend
+from webhook import WebhookSettings, run_webhook
 
 
 # Load environment variables
 load_dotenv(find_dotenv())
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
 TELEGRAM_API_KEY = os.getenv("TELEGRAM_API_KEY")
 
 if not OPENAI_API_KEY:
@@ -28,18 +37,31 @@ if not TELEGRAM_API_KEY:
     )
 
 
-# Initialize OpenAI client (mirrors 01_hello_world behavior)
-openai_client = (
-    OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
-    if OPENAI_BASE_URL
-    else OpenAI(api_key=OPENAI_API_KEY)
-)
-
 router = Router()
 
 
+# Repeat questions are served from cache; RESPONSE_CACHE_DB enables the persistent backend
+RESPONSE_CACHE_DB = os.getenv("RESPONSE_CACHE_DB")
+RESPONSE_CACHE = ResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2048")),
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600))),
+    backend=SqliteCacheBackend(RESPONSE_CACHE_DB) if RESPONSE_CACHE_DB else None,
+)
+
+# Rephrased repeats are matched to answered questions by MinHash similarity (0 = exact matches only)
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.8"))
+SIMILAR_QUESTIONS = (
+    NearDuplicateIndex(
+        threshold=RESPONSE_CACHE_SIMILARITY,
+        max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2048")),
+        backend=SqliteIndexBackend(RESPONSE_CACHE_DB) if RESPONSE_CACHE_DB else None,
+    )
+    if RESPONSE_CACHE_SIMILARITY > 0
+    else None
+)
+
 # Single agent instance
-AGENT = FormattingAgent(openai_client)
+AGENT = FormattingAgent(cache=RESPONSE_CACHE, similar=SIMILAR_QUESTIONS)
 
 
 @router.message(CommandStart())
@@ -53,43 +75,72 @@ async def on_message(message: Message) -> None:
         await message.answer("Пожалуйста, отправьте текст запроса.", parse_mode=None)
         return
 
+    # LLM calls of this handler queue fairly against other chats in the shared scheduler
+    set_chat(message.chat.id)
+
+    # First tokens go out as a message right away, the rest arrive as throttled edits
+    streamer = TelegramStreamer(message)
+
+    # Show typing while processing, until the first chunk of the reply is out
+    typing = HEARTBEAT.typing(message.bot, message.chat.id)
+
     try:
-        # Show typing while processing
-        stop_event = asyncio.Event()
-
-        async def keep_typing() -> None:
-            try:
-                while not stop_event.is_set():
-                    await message.bot.send_chat_action(chat_id=message.chat.id, action=ChatAction.TYPING)
-                    await asyncio.wait_for(stop_event.wait(), timeout=4.0)
-            except asyncio.TimeoutError:
-                # loop again to keep typing
-                await keep_typing()
-
-        typing_task = asyncio.create_task(keep_typing())
-
-        # Run blocking call in a thread to avoid blocking the event loop
-        payload = await asyncio.to_thread(AGENT.reply_payload, user_text)
-        stop_event.set()
-        await typing_task
-        if payload.use_markdown:
-            await message.answer(payload.text)
-        else:
-            await message.answer(payload.text, parse_mode=None)
+        async def on_delta(delta: str) -> None:
+            await streamer.push(delta)
+            if streamer.sent is not None:
+                typing.stop()
+
+        payload = await AGENT.astream_reply_payload(user_text, on_delta)
+        typing.stop()
+        await streamer.finish(payload.text, use_markdown=payload.use_markdown)
+    except CircuitOpenError:
+        await streamer.close()
+        await message.answer("LLM сейчас недоступна, попробуйте через минуту.", parse_mode=None)
     except Exception as exc:  # noqa: BLE001
+        await streamer.close()
         await message.answer(f"Произошла ошибка при обращении к LLM: {exc}", parse_mode=None)
+    finally:
+        typing.stop()
 
 
-async def main() -> None:
-    bot = Bot(token=TELEGRAM_API_KEY, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN_V2))
+async def on_shutdown() -> None:
+    HEARTBEAT.close()
+    await aclose_clients()
+
+
+def build_bot() -> Bot:
+    # TELEGRAM_API_SERVER: self-hosted Bot API server (or a local fake in load tests)
+    api_server = os.getenv("TELEGRAM_API_SERVER")
+    session = AiohttpSession(api=TelegramAPIServer.from_base(api_server)) if api_server else None
+    return Bot(token=TELEGRAM_API_KEY, session=session, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN_V2))
+
+
+def build_dispatcher() -> Dispatcher:
     dp = Dispatcher()
     dp.include_router(router)
-    await dp.start_polling(bot)
+    dp.shutdown.register(on_shutdown)
+    return dp
+
+
+async def main() -> None:
+    # Prometheus metrics for every LLM call (latency, TTFT, tokens, retries) on :METRICS_PORT/metrics
+    if os.getenv("METRICS_PORT"):
+        serve_metrics(int(os.environ["METRICS_PORT"]))
+
+    bot = build_bot()
+    # getUpdates is refused while a webhook from an earlier webhook-mode run is set
+    await bot.delete_webhook()
+    await build_dispatcher().start_polling(bot)
 
 
 if __name__ == "__main__":
+    # WEBHOOK_URL switches to webhook mode; WEBHOOK_WORKERS > 1 shards chats over processes
+    WEBHOOK = WebhookSettings.from_env()
     try:
-        asyncio.run(main())
+        if WEBHOOK is not None:
+            run_webhook(build_bot, build_dispatcher, WEBHOOK)
+        else:
+            asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         pass
 
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class SystemPrompt:
+    # Builds the system message once and rebuilds it only when template.json's mtime
+    # changes. The text stays byte-identical between requests, which keeps the
+    # provider's prompt-prefix cache warm.
+
+    def __init__(
+        self,
+        base: str,
+        template_path: str | None = None,
+        *,
+        check_interval: float = 1.0,
+        computed_keys: tuple[str, ...] = (),
+    ) -> None:
+        self.base = base
+        self.template_path = template_path
+        # Schema keys filled in by code after generation: validated, but not shown to the model
+        self.computed_keys = computed_keys
+        self.check_interval = check_interval
+        self.template: dict | None = None
+        self._lock = threading.Lock()
+        self._mtime: float | None = None
+        self._checked_at = 0.0
+        self._text = base
+        self._fingerprint = ""
+        self._rebuild(self._current_mtime())
+
+    @property
+    def text(self) -> str:
+        self._maybe_reload()
+        return self._text
+
+    @property
+    def fingerprint(self) -> str:
+        self._maybe_reload()
+        return self._fingerprint
+
+    def _current_mtime(self) -> float | None:
+        if not self.template_path:
+            return None
+        try:
+            return os.path.getmtime(self.template_path)
+        except OSError:
+            return None
+
+    def _maybe_reload(self) -> None:
+        if not self.template_path:
+            return
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        mtime = self._current_mtime()
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    self._rebuild(mtime)
+
+    def _shown(self, template: dict) -> dict:
+        if not self.computed_keys:
+            return template
+        return {
+            key: {k: v for k, v in value.items() if k not in self.computed_keys}
+            if key.endswith("_schema") and isinstance(value, dict)
+            else value
+            for key, value in template.items()
+        }
+
+    def _rebuild(self, mtime: float | None) -> None:
+        template: dict | None = None
+        if self.template_path:
+            try:
+                with open(self.template_path, "r", encoding="utf-8") as f:
+                    template = json.load(f)
+            except Exception:
+                template = None
+
+        text = self.base
+        if template:
+            try:
+                text = self.base + "\nТребования формата (JSON):\n" + json.dumps(self._shown(template), ensure_ascii=False)
+            except Exception:
+                text = self.base
+
+        self.template = template
+        self._text = text
+        self._fingerprint = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        self._mtime = mtime
+        self._checked_at = time.monotonic()
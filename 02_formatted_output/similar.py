@@ -0,0 +1,255 @@
+from __future__ import annotations
+
+import hashlib
+import random
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple, TypeVar
+
+from cache import normalize_question
+from llm_metrics import METRICS
+
+# MinHash signature length and its LSH split: 16 bands x 4 rows puts the
+# candidate threshold around Jaccard 0.5, the final check is the estimate itself
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE = 3
+
+T = TypeVar("T")
+
+_PRIME = (1 << 61) - 1
+# Fixed seed: signatures are persisted, so the permutations must not change between runs
+_rng = random.Random(20240501)
+_PERMS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+
+# Filler of biography questions; only the person's name should remain
+_STOP_WORDS = frozenset(
+    "кто такой такая такие такое что чем о об про мне нам пожалуйста расскажи расскажите "
+    "напиши опиши дай биография биографию биографии краткая краткую жизнь жизни был была были "
+    "это ли и a about biography is was who tell me the of life please".split()
+)
+# Russian case endings, longest first: "Пушкина"/"Пушкину" and "Пушкин" share a stem
+_SUFFIXES = ("ого", "его", "ому", "ему", "ыми", "ими", "ой", "ей", "ом", "ем", "ым", "им", "ую", "юю", "а", "я", "у", "ю", "е", "ы")
+
+
+def _stem(token: str) -> str:
+    if len(token) > 4:
+        for suffix in _SUFFIXES:
+            if token.endswith(suffix) and len(token) - len(suffix) >= 4:
+                return token[: -len(suffix)]
+    return token
+
+
+_STOP_STEMS = frozenset(_stem(word) for word in _STOP_WORDS)
+
+# Regnal and ordinal numbers ("Екатерина II", "Пётр 1") tell people apart, so they are
+# never dropped as too short and must match exactly, not just be similar
+_NUMERAL_RE = re.compile(r"^(?:\d+|(?=[ivx])x{0,3}(?:ix|iv|v?i{0,3}))$")
+
+
+def numerals(question: str) -> FrozenSet[str]:
+    return frozenset(token for token in normalize_question(question).split() if _NUMERAL_RE.match(token))
+
+
+def shingles(question: str) -> FrozenSet[str]:
+    # Character 3-grams of the name tokens: word order, initials, punctuation and
+    # most inflection do not matter ("кто такой А.С. Пушкин" ~ "биография Пушкина")
+    result: Set[str] = set()
+    for token in normalize_question(question).split():
+        stem = _stem(token)
+        if not _NUMERAL_RE.match(stem) and (len(stem) < 2 or stem in _STOP_STEMS):
+            continue
+        padded = f"\x02{stem}\x03"
+        result.update(padded[i : i + SHINGLE] for i in range(len(padded) - SHINGLE + 1))
+    return frozenset(result)
+
+
+def signature(items: Iterable[str]) -> Tuple[int, ...]:
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big") for s in items]
+    if not hashes:
+        return ()
+    return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMS)
+
+
+def similarity(left: Tuple[int, ...], right: Tuple[int, ...]) -> float:
+    # Share of equal MinHash slots estimates the Jaccard similarity of the shingle sets
+    return sum(x == y for x, y in zip(left, right)) / NUM_PERM
+
+
+class SqliteIndexBackend:
+    def __init__(self, path: str) -> None:
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS similar_questions (key TEXT PRIMARY KEY, scope TEXT NOT NULL, signature BLOB NOT NULL, seen REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def load(self, limit: int) -> List[Tuple[str, str, Tuple[int, ...]]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, scope, signature FROM similar_questions ORDER BY seen DESC LIMIT ?", (limit,)
+            ).fetchall()
+        # Oldest first, so the in-memory LRU order matches
+        return [(key, scope, tuple(array("Q", blob))) for key, scope, blob in reversed(rows)]
+
+    def put(self, key: str, scope: str, sig: Tuple[int, ...]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO similar_questions (key, scope, signature, seen) VALUES (?, ?, ?, ?)",
+                (key, scope, array("Q", sig).tobytes(), time.time()),
+            )
+            self._conn.commit()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM similar_questions WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM similar_questions")
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class NearDuplicateIndex:
+    # Past questions by MinHash signature, bucketed with LSH so a lookup only compares
+    # against questions that share a band. Maps a rephrased question to the cache key
+    # of an already answered one; entries are scoped (prompt, model, temperature) like
+    # the cache keys themselves. Bounded LRU, optionally persisted to SQLite.
+
+    def __init__(
+        self,
+        *,
+        threshold: float = 0.8,
+        max_entries: int = 2048,
+        backend: Optional[SqliteIndexBackend] = None,
+    ) -> None:
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[str, Tuple[int, ...]]]" = OrderedDict()
+        self._buckets: Dict[int, Set[str]] = {}
+        if backend is not None:
+            for key, scope, sig in backend.load(max_entries):
+                self._insert(key, scope, sig)
+
+    @staticmethod
+    def _scope(scope: str, question: str) -> str:
+        # Numerals are part of the exact-match scope: "Екатерина I" never finds "Екатерина II"
+        marks = numerals(question)
+        return f"{scope}\x1f{' '.join(sorted(marks))}" if marks else scope
+
+    @staticmethod
+    def _bands(scope: str, sig: Tuple[int, ...]) -> List[int]:
+        return [hash((scope, band, sig[band * ROWS : (band + 1) * ROWS])) for band in range(BANDS)]
+
+    def lookup(self, question: str, scope: str, fetch: Callable[[str], Optional[T]]) -> Optional[T]:
+        # fetch(key) of the most similar indexed question that clears the threshold;
+        # keys whose answer is gone from the cache (TTL, eviction) are dropped on the way
+        sig = signature(shingles(question))
+        scope = self._scope(scope, question)
+        ranked: List[Tuple[float, str]] = []
+        if sig:
+            with self._lock:
+                candidates = set().union(*(self._buckets.get(b, ()) for b in self._bands(scope, sig)))
+                ranked = sorted(
+                    ((score, key) for key in candidates if (score := similarity(sig, self._entries[key][1])) >= self.threshold),
+                    reverse=True,
+                )
+        for _, key in ranked:
+            value = fetch(key)
+            if value is not None:
+                with self._lock:
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                self._count("hit")
+                return value
+            self._discard(key)
+        self._count("miss")
+        return None
+
+    def add(self, question: str, key: str, scope: str) -> None:
+        sig = signature(shingles(question))
+        if not sig:
+            # Nothing but filler words ("кто это?"): not a question about a person
+            return
+        scope = self._scope(scope, question)
+        with self._lock:
+            self._insert(key, scope, sig)
+            evicted = self._evict()
+        if self.backend is not None:
+            self.backend.put(key, scope, sig)
+            for old in evicted:
+                self.backend.delete(old)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+        }
+
+    def _insert(self, key: str, scope: str, sig: Tuple[int, ...]) -> None:
+        self._remove(key)
+        self._entries[key] = (scope, sig)
+        for band in self._bands(scope, sig):
+            self._buckets.setdefault(band, set()).add(key)
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for band in self._bands(*entry):
+            bucket = self._buckets.get(band)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band]
+
+    def _evict(self) -> List[str]:
+        evicted = []
+        while len(self._entries) > self.max_entries:
+            key = next(iter(self._entries))
+            self._remove(key)
+            evicted.append(key)
+        return evicted
+
+    def _discard(self, key: str) -> None:
+        with self._lock:
+            self._remove(key)
+        self.stale += 1
+        METRICS.inc("response_cache_similar_lookups_total", (("result", "stale"),))
+        if self.backend is not None:
+            self.backend.delete(key)
+
+    def _count(self, result: str) -> None:
+        if result == "hit":
+            self.hits += 1
+        else:
+            self.misses += 1
+        METRICS.inc("response_cache_similar_lookups_total", (("result", result),))
+
@@ -0,0 +1,15 @@
+from similar import NearDuplicateIndex, numerals
+
+
+def test_numerals_are_kept() -> None:
+    assert numerals("Кто такая Екатерина II?") == {"ii"}
+    assert numerals("Пётр 1") == {"1"}
+    assert numerals("Кто такой Пушкин?") == frozenset()
+
+
+def test_regnal_numbers_must_match_exactly() -> None:
+    index = NearDuplicateIndex(threshold=0.8)
+    index.add("Кто такая Екатерина II?", "catherine-2", "scope")
+
+    assert index.lookup("Кто такая Екатерина I?", "scope", lambda key: key) is None
+    assert index.lookup("Биография Екатерины II", "scope", lambda key: key) == "catherine-2"
@@ -1,49 +1,85 @@
 from __future__ import annotations
 
+import asyncio
 from dataclasses import dataclass
-import json
+from typing import Awaitable, Callable
 import os
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+from llm_client import get_async_client, get_client
+from llm_metrics import acreate_completion, create_completion
+from nutrition import apply_nutrition
+from planner import MenuPlanner
+from prompts import SystemPrompt
+from structured import CompiledSchema, StructuredOutput, compile_template, render
+from tokens import COUNTER
+
+
+SYSTEM_PROMPT_BASE = (
+    "Ты — фитнес-тренер-агент по питанию. Формируй меню/план питания по запросу пользователя. "
+    "Ты должен возвращать ответ строго в формате и схеме, заданных во внешнем шаблоне (template.json). "
+    "Если запрос не о меню/плане питания, ответь обычным текстом: 'У меня нет компетенций отвечать на это. Уточните запрос по меню/питанию.'"
+    "Все текстовые значения на русском (ru). Ключи строго как в menu_schema."
+    "Будь краток и фактичен. Пиши пунктирно-короткими фразами."
+    "Если информация неизвестна — ставь null для одиночных полей или пустые массивы для списков."
+    "Никаких комментариев вокруг финального вывода. Возвращай ТОЛЬКО JSON по схеме."
+    "При задавании уточнений — не более 1 вопроса за раз."
+    "Режим: если данных недостаточно для корректного заполнения ключей из menu_schema без домыслов — не возвращай JSON в этом сообщении и задай 1–3 целевых вопроса."
+    "Возвращай JSON только когда данных достаточно."
+    "Обязательно требуй узнать количество приемов пищи и аллегрию. 1 СООБЩЕНИЕ - 1 ВОПРОС. Пример диалога (для референса): '1. Сколько приемов пищи в день?' потом '2. Три в день на 30 дней' потом '2. На что у тебя есть аллергия', узнаёшь что-то дополинтельное и пишешь json с готовым ежедневным рационом по шаблону"
+)
+
+# Filled in by nutrition.py from the ingredients, so the model does not spend tokens on them
+COMPUTED_KEYS = ("shopping_list",)
+
+
+class _SkeletonReady(Exception):
+    # Raised from the stream callback once a long plan's skeleton is complete
+    pass
 
 
 class FormattingAgent:
-    def __init__(self, client: OpenAI, model: str = "deepseek-chat", temperature: float = 0.6) -> None:
+    def __init__(
+        self,
+        client: OpenAI | None = None,
+        model: str = "deepseek-chat",
+        temperature: float = 0.6,
+        *,
+        async_client: AsyncOpenAI | None = None,
+        structured: bool = True,
+        planner: MenuPlanner | None = None,
+    ) -> None:
+        if client is None:
+            # Shared pooled clients from llm_client, built on first use
+            client, async_client = get_client(), async_client or get_async_client()
         self.client = client
+        self.async_client = async_client
         self.model = model
         self.temperature = temperature
-        self._template: dict | None = None
-        self._load_template()
+        # Validate the final menu JSON against menu_schema and repair only the broken fields.
+        # No response_format here: clarifying questions in the dialog are plain text.
+        self.structured = structured
+        # Long plans: stop the stream after the skeleton and let the planner fan out the days
+        self.planner = planner
+        self._prompt = SystemPrompt(
+            SYSTEM_PROMPT_BASE,
+            os.path.join(os.path.dirname(__file__), "template.json"),
+            computed_keys=COMPUTED_KEYS,
+        )
 
-    def _load_template(self) -> None:
-        template_path = os.path.join(os.path.dirname(__file__), "template.json")
-        try:
-            with open(template_path, "r", encoding="utf-8") as f:
-                self._template = json.load(f)
-        except Exception:
-            self._template = None
+    @property
+    def _template(self) -> dict | None:
+        return self._prompt.template
 
-    def _build_system_prompt(self) -> str:
-        base = (
-            "Ты — фитнес-тренер-агент по питанию. Формируй меню/план питания по запросу пользователя. "
-            "Ты должен возвращать ответ строго в формате и схеме, заданных во внешнем шаблоне (template.json). "
-            "Если запрос не о меню/плане питания, ответь обычным текстом: 'У меня нет компетенций отвечать на это. Уточните запрос по меню/питанию.'"
-            "Все текстовые значения на русском (ru). Ключи строго как в menu_schema."
-            "Будь краток и фактичен. Пиши пунктирно-короткими фразами."
-            "Если информация неизвестна — ставь null для одиночных полей или пустые массивы для списков."
-            "Никаких комментариев вокруг финального вывода. Возвращай ТОЛЬКО JSON по схеме."
-            "При задавании уточнений — не более 1 вопроса за раз."
-            "Режим: если данных недостаточно для корректного заполнения ключей из menu_schema без домыслов — не возвращай JSON в этом сообщении и задай 1–3 целевых вопроса."
-            "Возвращай JSON только когда данных достаточно."
-            "Обязательно требуй узнать количество приемов пищи и аллегрию. 1 СООБЩЕНИЕ - 1 ВОПРОС. Пример диалога (для референса): '1. Сколько приемов пищи в день?' потом '2. Три в день на 30 дней' потом '2. На что у тебя есть аллергия', узнаёшь что-то дополинтельное и пишешь json с готовым ежедневным рационом по шаблону"
-        )
+    @property
+    def prompt_fingerprint(self) -> str:
+        return self._prompt.fingerprint
+
+    @property
+    def _schema(self) -> CompiledSchema | None:
+        return compile_template(self._template) if self.structured else None
 
-        if self._template:
-            try:
-                template_str = json.dumps(self._template, ensure_ascii=False)
-                return base + "\nТребования формата (JSON):\n" + template_str
-            except Exception:
-                return base
-        return base
+    def _build_system_prompt(self) -> str:
+        return self._prompt.text
 
     def _detect_lang(self, text: str) -> str:
         lower = text.lower()
@@ -57,34 +93,50 @@ class FormattingAgent:
         colon_lines = sum(1 for ln in lines[:10] if ":" in ln and not ln.strip().startswith("#"))
         return "yaml" if colon_lines >= 2 else "text"
 
-    @dataclass
-    class ReplyPayload:
-        text: str
-        use_markdown: bool
-
-    def reply_payload_from_history(self, conversation_history: list[dict[str, str]]) -> "FormattingAgent.ReplyPayload":
-        messages = [{"role": "system", "content": self._build_system_prompt()}]
-        messages.extend(conversation_history)
-
-        response = self.client.chat.completions.create(
+    async def _astream_text(self, messages: list[dict[str, str]], on_delta: Callable[[str], Awaitable[None]]) -> str:
+        stream = await acreate_completion(
+            self.async_client,
+            agent=type(self).__name__,
             model=self.model,
             messages=messages,
             temperature=self.temperature,
+            max_tokens=COUNTER.fit_max_tokens(self.model, messages),
+            stream=True,
         )
+        parts: list[str] = []
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    await on_delta(delta)
+        except BaseException:
+            # Stopped early (skeleton handed to the planner, superseded reply): free the connection
+            await stream.close()
+            raise
+        return "".join(parts)
 
-        content = (response.choices[0].message.content or "").strip()
-        lang = self._detect_lang(content)
+    @dataclass
+    class ReplyPayload:
+        text: str
+        use_markdown: bool
+        # Validated menu_schema document behind `text`, for rendering it for humans
+        document: dict | None = None
 
-        if lang == "fenced":
-            return self.ReplyPayload(text=content, use_markdown=True)
-        if lang == "text":
-            return self.ReplyPayload(text=content, use_markdown=False)
+    def history_token_limit(self, *, reserve: int = 1024) -> int:
+        # Largest history (in COUNTER tokens) that still fits next to the system prompt and a reply
+        system = COUNTER.count_message({"role": "system", "content": self._build_system_prompt()})
+        return COUNTER.prompt_limit(self.model, reserve=reserve) - system
 
-        fenced = f"```{lang}\n{content}\n```"
-        return self.ReplyPayload(text=fenced, use_markdown=True)
+    def _history_messages(self, conversation_history: list[dict[str, str]]) -> list[dict[str, str]]:
+        messages = [{"role": "system", "content": self._build_system_prompt()}]
+        messages.extend(conversation_history)
+        return messages
 
-    def reply_payload(self, user_text: str) -> "FormattingAgent.ReplyPayload":
-        messages = [
+    def _request_messages(self, user_text: str) -> list[dict[str, str]]:
+        return [
             {"role": "system", "content": self._build_system_prompt()},
             {
                 "role": "user",
@@ -96,13 +148,55 @@ class FormattingAgent:
             },
         ]
 
-        response = self.client.chat.completions.create(
+    def _payload_from_response(self, response) -> "FormattingAgent.ReplyPayload":
+        text = response.choices[0].message.content or ""
+        output = self._structured_output(sync=True)
+        if output is None:
+            return self._payload_from_text(text)
+        output.feed(text)
+        return self._payload_from_structured(text, output.result(self._repair_text))
+
+    async def _apayload_from_response(self, response) -> "FormattingAgent.ReplyPayload":
+        text = response.choices[0].message.content or ""
+        output = self._structured_output()
+        if output is None:
+            return self._payload_from_text(text)
+        output.feed(text)
+        return self._payload_from_structured(text, await output.aresult())
+
+    def _structured_output(self, *, sync: bool = False) -> StructuredOutput | None:
+        schema = self._schema
+        if schema is None:
+            return None
+        return StructuredOutput(schema, arepair=None if sync else self._arepair_text)
+
+    def _payload_from_structured(self, text: str, document: dict | None) -> "FormattingAgent.ReplyPayload":
+        if document is None:
+            # Clarifying question or unparseable output: render it as before
+            return self._payload_from_text(text)
+        if document.get("days"):
+            # Macros, calorie totals and shopping_list come from the ingredients, not the model
+            apply_nutrition(document)
+        return self.ReplyPayload(text=render(document), use_markdown=True, document=document)
+
+    def _repair_kwargs(self, messages: list[dict[str, str]]) -> dict:
+        return dict(
+            agent=f"{type(self).__name__}Repair",
             model=self.model,
             messages=messages,
-            temperature=self.temperature,
+            temperature=0.0,
         )
 
-        content = (response.choices[0].message.content or "").strip()
+    def _repair_text(self, messages: list[dict[str, str]]) -> str:
+        response = create_completion(self.client, **self._repair_kwargs(messages))
+        return response.choices[0].message.content or ""
+
+    async def _arepair_text(self, messages: list[dict[str, str]]) -> str:
+        response = await acreate_completion(self.async_client, **self._repair_kwargs(messages))
+        return response.choices[0].message.content or ""
+
+    def _payload_from_text(self, text: str) -> "FormattingAgent.ReplyPayload":
+        content = text.strip()
         lang = self._detect_lang(content)
 
         if lang == "fenced":
@@ -113,6 +207,75 @@ class FormattingAgent:
         fenced = f"```{lang}\n{content}\n```"
         return self.ReplyPayload(text=fenced, use_markdown=True)
 
+    def _complete(self, messages: list[dict[str, str]]) -> "FormattingAgent.ReplyPayload":
+        response = create_completion(
+            self.client,
+            agent=type(self).__name__,
+            model=self.model,
+            messages=messages,
+            temperature=self.temperature,
+            max_tokens=COUNTER.fit_max_tokens(self.model, messages),
+        )
+        return self._payload_from_response(response)
+
+    async def _acomplete(self, messages: list[dict[str, str]]) -> "FormattingAgent.ReplyPayload":
+        if self.async_client is None:
+            return await asyncio.to_thread(self._complete, messages)
+
+        response = await acreate_completion(
+            self.async_client,
+            agent=type(self).__name__,
+            model=self.model,
+            messages=messages,
+            temperature=self.temperature,
+            max_tokens=COUNTER.fit_max_tokens(self.model, messages),
+        )
+        return await self._apayload_from_response(response)
+
+    def reply_payload_from_history(self, conversation_history: list[dict[str, str]]) -> "FormattingAgent.ReplyPayload":
+        return self._complete(self._history_messages(conversation_history))
+
+    async def areply_payload_from_history(self, conversation_history: list[dict[str, str]]) -> "FormattingAgent.ReplyPayload":
+        return await self._acomplete(self._history_messages(conversation_history))
+
+    async def astream_reply_payload_from_history(
+        self, conversation_history: list[dict[str, str]], on_delta: Callable[[str], Awaitable[None]]
+    ) -> "FormattingAgent.ReplyPayload":
+        # Same as areply_payload_from_history, but raw tokens are passed to on_delta as they arrive
+        if self.async_client is None:
+            return await self.areply_payload_from_history(conversation_history)
+        messages = self._history_messages(conversation_history)
+        output = self._structured_output()
+        if output is None:
+            return self._payload_from_text(await self._astream_text(messages, on_delta))
+
+        async def on_text(delta: str) -> None:
+            # Days are validated as they close; broken ones get repaired while the rest streams
+            output.feed(delta)
+            await on_delta(delta)
+            if (
+                self.planner is not None
+                and output.parser.current_key == "days"
+                and self.planner.should_fan_out(output.members)
+            ):
+                raise _SkeletonReady
+
+        try:
+            text = await self._astream_text(messages, on_text)
+        except _SkeletonReady:
+            output.cancel()
+            return self._payload_from_structured("", await self.planner.agenerate(output.schema, output.members))
+        except BaseException:
+            output.cancel()
+            raise
+        return self._payload_from_structured(text, await output.aresult())
+
+    def reply_payload(self, user_text: str) -> "FormattingAgent.ReplyPayload":
+        return self._complete(self._request_messages(user_text))
+
+    async def areply_payload(self, user_text: str) -> "FormattingAgent.ReplyPayload":
+        return await self._acomplete(self._request_messages(user_text))
+
     def reply(self, user_text: str) -> str:
         payload = self.reply_payload(user_text)
         return payload.text
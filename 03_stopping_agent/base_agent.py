@@ -1,8 +1,13 @@
 from __future__ import annotations
 
+import asyncio
 from dataclasses import dataclass
 from typing import Any, List, Dict, Tuple
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+from llm_client import get_async_client, get_client
+from llm_metrics import acreate_completion, create_completion
+from scheduler import PRIORITY_INTERACTIVE
+from tokens import COUNTER
 
 
 @dataclass
@@ -12,21 +17,63 @@ class UsageInfo:
     prompt_tokens: int
     completion_tokens: int
     max_tokens: int
+    # Prompt tokens no longer resent each turn thanks to history compaction
+    saved_tokens: int = 0
 
 
 class BaseAgent:
-    def __init__(self, client: OpenAI, model: str = "deepseek-chat", temperature: float = 0.6) -> None:
+    # Queue class in the shared LLM scheduler (see scheduler.py)
+    priority = PRIORITY_INTERACTIVE
+
+    def __init__(
+        self,
+        client: OpenAI | None = None,
+        model: str = "deepseek-chat",
+        temperature: float = 0.6,
+        *,
+        async_client: AsyncOpenAI | None = None,
+    ) -> None:
+        if client is None:
+            # Shared pooled clients from llm_client, built on first use
+            client, async_client = get_client(), async_client or get_async_client()
         self.client = client
+        self.async_client = async_client
         self.model = model
         self.temperature = temperature
 
-    def chat_completion(self, messages: List[Dict[str, str]], *, max_tokens: int) -> Tuple[str, UsageInfo]:
-        response = self.client.chat.completions.create(
+    def _fit_max_tokens(self, messages: List[Dict[str, str]], max_tokens: int | None) -> int:
+        # Capped by what the context window leaves; an oversized prompt raises PromptTooLargeError here
+        return COUNTER.fit_max_tokens(self.model, messages, max_tokens)
+
+    def chat_completion(self, messages: List[Dict[str, str]], *, max_tokens: int | None = None) -> Tuple[str, UsageInfo]:
+        max_tokens = self._fit_max_tokens(messages, max_tokens)
+        response = create_completion(
+            self.client,
+            agent=type(self).__name__,
+            model=self.model,
+            messages=messages,
+            temperature=self.temperature,
+            max_tokens=max_tokens,
+        )
+        return self._parse_response(response, max_tokens)
+
+    async def achat_completion(self, messages: List[Dict[str, str]], *, max_tokens: int | None = None) -> Tuple[str, UsageInfo]:
+        if self.async_client is None:
+            return await asyncio.to_thread(self.chat_completion, messages, max_tokens=max_tokens)
+
+        max_tokens = self._fit_max_tokens(messages, max_tokens)
+        response = await acreate_completion(
+            self.async_client,
+            agent=type(self).__name__,
+            priority=self.priority,
             model=self.model,
             messages=messages,
             temperature=self.temperature,
             max_tokens=max_tokens,
         )
+        return self._parse_response(response, max_tokens)
+
+    def _parse_response(self, response: Any, max_tokens: int) -> Tuple[str, UsageInfo]:
         content = (response.choices[0].message.content or "").strip()
         usage = getattr(response, "usage", None)
         model_used = getattr(response, "model", self.model)
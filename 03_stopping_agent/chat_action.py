@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import asyncio
+import os
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from aiogram import Bot
+from aiogram.enums import ChatAction
+from aiogram.exceptions import TelegramRetryAfter
+
+from llm_metrics import METRICS
+from scheduler import TokenBucket
+
+# (bot, chat): one heartbeat per chat however many handlers wait in it
+_Key = Tuple[int, int]
+
+
+class _Entry:
+    __slots__ = ("bot", "chat_id", "refs", "slot")
+
+    def __init__(self, bot: Bot, chat_id: int) -> None:
+        self.bot = bot
+        self.chat_id = chat_id
+        self.refs = 0
+        # Wheel slot the next action is parked in; None while due or being sent
+        self.slot: Optional[int] = None
+
+
+class TypingLease:
+    # Returned by ChatActionHeartbeat.typing(); stop() is idempotent, so handlers can
+    # stop early (first streamed chunk is out) and again in their finally block
+
+    __slots__ = ("_heartbeat", "_key", "_active")
+
+    def __init__(self, heartbeat: "ChatActionHeartbeat", key: _Key) -> None:
+        self._heartbeat = heartbeat
+        self._key = key
+        self._active = True
+
+    def stop(self) -> None:
+        if self._active:
+            self._active = False
+            self._heartbeat._release(self._key)
+
+
+class ChatActionHeartbeat:
+    # "typing..." for every chat that waits on the LLM, driven by one timer wheel
+    # shared by the whole process instead of a task per request. Telegram shows the
+    # action for ~5 s, so each registered chat is re-sent TYPING once per `interval`:
+    # after a send the chat is parked in the current wheel slot and comes due again
+    # when the cursor gets back to it. Concurrent handlers of one chat share its entry.
+    # Sends go through a token bucket (`per_second`) so they leave room for the real
+    # messages under Telegram's ~30 requests/s limit, and a RetryAfter pauses them all.
+
+    def __init__(self, *, interval: float = 4.0, tick: float = 0.5, per_second: float = 10.0) -> None:
+        self.interval = interval
+        self.tick = tick
+        self.bucket = TokenBucket(per_second * 60, burst=per_second)
+        self._wheel: List[Set[_Key]] = [set() for _ in range(max(1, round(interval / tick)))]
+        self._cursor = 0
+        self._next_tick = 0.0
+        self._paused_until = 0.0
+        self._entries: Dict[_Key, _Entry] = {}
+        # Chats whose action is due, oldest first; they wait here while the bucket is empty
+        self._due: "OrderedDict[_Key, None]" = OrderedDict()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._sending: Set[asyncio.Task] = set()
+
+    @classmethod
+    def from_env(cls) -> "ChatActionHeartbeat":
+        return cls(
+            interval=float(os.getenv("CHAT_ACTION_INTERVAL", "4")),
+            per_second=float(os.getenv("CHAT_ACTION_RPS", "10")),
+        )
+
+    @property
+    def active(self) -> int:
+        return len(self._entries)
+
+    def typing(self, bot: Bot, chat_id: int) -> TypingLease:
+        # Show "typing..." in the chat until the returned lease is stopped
+        key = (id(bot), chat_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            if not self._entries:
+                self._next_tick = asyncio.get_running_loop().time() + self.tick
+            entry = self._entries[key] = _Entry(bot, chat_id)
+            self._due[key] = None
+            self._pump()
+        entry.refs += 1
+        return TypingLease(self, key)
+
+    def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for task in list(self._sending):
+            task.cancel()
+        self._entries.clear()
+        self._due.clear()
+        for slot in self._wheel:
+            slot.clear()
+
+    def _release(self, key: _Key) -> None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        entry.refs -= 1
+        if entry.refs > 0:
+            return
+        del self._entries[key]
+        self._due.pop(key, None)
+        if entry.slot is not None:
+            self._wheel[entry.slot].discard(key)
+        if not self._entries and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _pump(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._entries:
+            return
+        now = loop.time()
+        while now >= self._next_tick:
+            self._cursor = (self._cursor + 1) % len(self._wheel)
+            for key in self._wheel[self._cursor]:
+                self._entries[key].slot = None
+                self._due[key] = None
+            self._wheel[self._cursor].clear()
+            self._next_tick += self.tick
+        delay = self._next_tick - now
+        if self._due:
+            if now < self._paused_until:
+                delay = min(delay, self._paused_until - now)
+            else:
+                delay = min(delay, self._drain(loop))
+        self._timer = loop.call_later(max(delay, 0.0), self._pump)
+
+    def _drain(self, loop: asyncio.AbstractEventLoop) -> float:
+        # Sends as many due actions as the bucket allows; returns the wait for the rest
+        while self._due:
+            wait = self.bucket.wait_time(1)
+            if wait > 0:
+                return wait
+            self.bucket.take(1)
+            key, _ = self._due.popitem(last=False)
+            entry = self._entries[key]
+            entry.slot = self._cursor
+            self._wheel[self._cursor].add(key)
+            task = loop.create_task(self._send(entry))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+        return self.tick
+
+    async def _send(self, entry: _Entry) -> None:
+        try:
+            await entry.bot.send_chat_action(chat_id=entry.chat_id, action=ChatAction.TYPING)
+        except TelegramRetryAfter as exc:
+            # Flood control: hold every chat's heartbeat until Telegram allows requests again
+            self._paused_until = asyncio.get_running_loop().time() + exc.retry_after
+            METRICS.inc("telegram_chat_actions_total", (("result", "retry_after"),))
+        except Exception:  # noqa: BLE001
+            # Only cosmetic: a lost "typing..." must not fail the reply
+            METRICS.inc("telegram_chat_actions_total", (("result", "error"),))
+        else:
+            METRICS.inc("telegram_chat_actions_total", (("result", "sent"),))
+
+
+HEARTBEAT = ChatActionHeartbeat.from_env()
@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, TypeVar
+
+from aiogram.types import Message
+
+# process(last_message, merged_text): does the actual LLM work for one burst of messages
+ChatHandler = Callable[[Message, str], Awaitable[None]]
+
+T = TypeVar("T")
+
+
+async def deliver(reply: Awaitable[T]) -> T:
+    # Final send of a handler whose turn is already committed to the session: it runs
+    # to completion even if a newer message supersedes the call meanwhile, and the
+    # handler then returns normally, so the batch counts as handled (no discard, no retry)
+    task = asyncio.ensure_future(reply)
+    while not task.done():
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled():
+                raise
+            asyncio.current_task().uncancel()
+    return task.result()
+
+
+@dataclass
+class _ChatState:
+    pending: List[Message] = field(default_factory=list)
+    arrived: asyncio.Event = field(default_factory=asyncio.Event)
+    worker: Optional[asyncio.Task] = None
+    current: Optional[asyncio.Task] = None
+    # The handler task a newer message cancelled (and only that one gets retried)
+    superseded: Optional[asyncio.Task] = None
+    # Set by ChatDispatcher.cancel(): the worker must stop whatever it is waiting on
+    closed: bool = False
+
+
+class ChatDispatcher:
+    # One actor per chat_id: messages of a chat are handled strictly one burst at a
+    # time, while different chats run fully in parallel. Messages arriving within
+    # `debounce` seconds of each other are merged into one LLM call; a message that
+    # arrives while a call is in flight cancels it and gets merged into the retry.
+
+    def __init__(self, handler: ChatHandler, *, debounce: float = 0.4) -> None:
+        self.handler = handler
+        self.debounce = debounce
+        self._chats: Dict[int, _ChatState] = {}
+
+    def submit(self, message: Message) -> None:
+        chat_id = message.chat.id
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = self._chats[chat_id] = _ChatState()
+        state.pending.append(message)
+        state.arrived.set()
+        if state.current is not None and not state.current.done():
+            state.superseded = state.current
+            state.current.cancel()
+        if state.worker is None:
+            state.worker = asyncio.create_task(self._run(chat_id, state))
+
+    def cancel(self, chat_id: int) -> None:
+        # Drop queued and in-flight work, e.g. when the user restarts the dialog
+        state = self._chats.pop(chat_id, None)
+        if state is not None and state.worker is not None:
+            state.closed = True
+            state.worker.cancel()
+
+    async def join(self, chat_id: int) -> None:
+        # Wait until the chat has no queued or in-flight work (tests, benchmarks, shutdown)
+        while True:
+            state = self._chats.get(chat_id)
+            if state is None or state.worker is None:
+                return
+            await asyncio.wait([state.worker])
+
+    async def _run(self, chat_id: int, state: _ChatState) -> None:
+        try:
+            while state.pending and not state.closed:
+                await self._wait_quiet(state)
+                batch = list(state.pending)
+                text = "\n".join((m.text or "").strip() for m in batch)
+                task = state.current = asyncio.create_task(self.handler(batch[-1], text))
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    # Only a supersede of this very task is retried; cancel() always ends the worker
+                    if state.closed or state.superseded is not task:
+                        raise
+                    # Superseded by a newer message: keep the batch, it is merged into the retry
+                    continue
+                finally:
+                    state.current = None
+                del state.pending[: len(batch)]
+        finally:
+            if state.current is not None:
+                state.current.cancel()
+            if self._chats.get(chat_id) is state:
+                del self._chats[chat_id]
+
+    async def _wait_quiet(self, state: _ChatState) -> None:
+        while True:
+            state.arrived.clear()
+            try:
+                await asyncio.wait_for(state.arrived.wait(), timeout=self.debounce)
+            except asyncio.TimeoutError:
+                return
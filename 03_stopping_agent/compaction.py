@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from base_agent import UsageInfo
+from session_store import SessionStore
+from summarizer import SummarizerAgent
+from tokens import COUNTER
+
+History = List[Dict[str, str]]
+
+SUMMARY_PREFIX = "Краткое резюме предыдущей части диалога:\n"
+
+
+def estimate_tokens(messages: History) -> int:
+    # Tokenizer-backed and cached per message (tokens.py)
+    return COUNTER.count_messages(messages)
+
+
+def is_summary(message: Dict[str, str]) -> bool:
+    return message.get("role") == "system" and message.get("content", "").startswith(SUMMARY_PREFIX)
+
+
+@dataclass
+class CompactionResult:
+    history: History
+    folded_messages: int
+    usage: UsageInfo
+
+
+class HistoryCompactor:
+    def __init__(
+        self,
+        summarizer: SummarizerAgent,
+        *,
+        max_prompt_tokens: int = 3000,
+        keep_last: int = 6,
+        summary_max_tokens: int = 512,
+    ) -> None:
+        self.summarizer = summarizer
+        self.max_prompt_tokens = max_prompt_tokens
+        self.keep_last = keep_last
+        self.summary_max_tokens = summary_max_tokens
+        self.total_saved_tokens = 0
+        self._pending: Dict[int, asyncio.Task] = {}
+
+    def needs_compaction(self, history: History, tokens: Optional[int] = None) -> bool:
+        if len(history) <= self.keep_last + 1:
+            return False
+        return (estimate_tokens(history) if tokens is None else tokens) > self.max_prompt_tokens
+
+    async def acompact(self, history: History) -> Optional[CompactionResult]:
+        if not self.needs_compaction(history):
+            return None
+        # Older turns (including a previous rolling summary) get folded, the tail stays verbatim
+        head, tail = history[: -self.keep_last], history[-self.keep_last :]
+        summary = await self.summarizer.asummarize_history(head, max_tokens=self.summary_max_tokens)
+        compacted = [{"role": "system", "content": SUMMARY_PREFIX + summary.text}] + tail
+        saved = max(0, estimate_tokens(history) - estimate_tokens(compacted))
+        usage = UsageInfo(
+            model=summary.model,
+            total_tokens=summary.total_tokens,
+            prompt_tokens=summary.prompt_tokens,
+            completion_tokens=summary.completion_tokens,
+            max_tokens=summary.max_tokens,
+            saved_tokens=saved,
+        )
+        return CompactionResult(history=compacted, folded_messages=len(head), usage=usage)
+
+    def schedule(self, chat_id: int, store: SessionStore) -> None:
+        # Runs off the reply path; at most one compaction per chat at a time
+        history = store.get(chat_id)
+        if chat_id in self._pending or not self.needs_compaction(history, COUNTER.count_session(chat_id, history)):
+            return
+        task = asyncio.create_task(self._compact_in_background(chat_id, store, history))
+        self._pending[chat_id] = task
+        task.add_done_callback(lambda _t: self._pending.pop(chat_id, None))
+
+    async def compact_now(self, chat_id: int, store: SessionStore) -> History:
+        # The next prompt would not fit the context window: fold before the reply, not after it
+        pending = self._pending.get(chat_id)
+        if pending is not None:
+            # asyncio.wait does not cancel the background task if this handler gets cancelled
+            await asyncio.wait([pending])
+        history = await store.aget(chat_id)
+        if self.needs_compaction(history):
+            await self._compact(chat_id, store, history)
+        return await store.aget(chat_id)
+
+    async def _compact_in_background(self, chat_id: int, store: SessionStore, history: History) -> None:
+        try:
+            await self._compact(chat_id, store, history)
+        except Exception as exc:  # noqa: BLE001
+            print(f"[compaction] chat {chat_id}: {exc}")
+
+    async def _compact(self, chat_id: int, store: SessionStore, history: History) -> None:
+        folded = list(history[: -self.keep_last])
+        result = await self.acompact(history)
+        if result is None:
+            return
+        # New messages may have been appended (or the session reset) while we waited:
+        # only swap the prefix we actually summarized, in place, so handlers see it too.
+        if await store.aget(chat_id) is not history or history[: len(folded)] != folded:
+            return
+        history[: len(folded)] = result.history[:1]
+        store.save(chat_id, history)
+        self.total_saved_tokens += result.usage.saved_tokens
@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import json
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from nutrition import NutritionReport, _dicts, analyze_menu
+from structured import compile_template
+
+# Telegram hard limit for one message (same as streaming.MAX_MESSAGE_LEN)
+MAX_PAGE_LEN = 4096
+# Shopping list is condensed to this many items, the rest is counted
+MAX_SHOPPING_ITEMS = 30
+MAX_ISSUES = 10
+
+LABELS = {
+    "target": "Цель",
+    "duration_days": "Длительность, дней",
+    "meals_per_day": "Приёмов пищи в день",
+    "total_daily_calories": "Калорийность в день",
+    "dietary_style": "Стиль питания",
+    "restrictions": "Ограничения",
+    "avoid_ingredients": "Исключить",
+    "preferred_cuisines": "Кухни",
+    "budget_level": "Бюджет",
+    "max_cook_time_min": "Время готовки, мин",
+    "equipment": "Оборудование",
+    "macros_ratio": "БЖУ, %",
+    "shopping_list": "Список покупок",
+    "notes": "Заметки",
+}
+
+# A section turns (document, report) into text blocks; blocks are never split across pages
+Section = Callable[[Dict[str, Any], NutritionReport], List[str]]
+
+
+def _text(value: Any) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _list(value: Any) -> List[Any]:
+    # Bullet sections iterate their field; a scalar left by a failed repair is a single bullet
+    if isinstance(value, list):
+        return value
+    return [value] if value else []
+
+
+def _macros_line(values: np.ndarray) -> str:
+    if np.isnan(values).all():
+        return "нет данных"
+    kcal, protein, fat, carbs = (f"{v:.0f}" if not np.isnan(v) else "?" for v in values)
+    return f"{kcal} ккал, Б {protein} / Ж {fat} / У {carbs} г"
+
+
+def _field_line(key: str, spec: Any) -> Callable[[Dict[str, Any]], Optional[str]]:
+    label = LABELS.get(key, key)
+    if isinstance(spec, list):
+
+        def items(doc: Dict[str, Any]) -> Optional[str]:
+            value = doc.get(key)
+            if not value:
+                return None
+            # A failed repair can leave a bare string here; it is one item, not a list of characters
+            values = value if isinstance(value, list) else [value]
+            return f"{label}: {', '.join(_text(v) for v in values)}"
+
+        return items
+    if isinstance(spec, dict):
+
+        def line(doc: Dict[str, Any]) -> Optional[str]:
+            value = doc.get(key)
+            if not isinstance(value, dict):
+                return None
+            parts = [_text(value[k]) for k in spec if value.get(k) is not None]
+            if not parts:
+                return None
+            return f"{label}: {'/'.join(parts)}" if len(parts) == len(spec) else f"{label}: {', '.join(parts)}"
+
+        return line
+    return lambda doc: f"{label}: {_text(doc[key])}" if doc.get(key) is not None else None
+
+
+def _header(title_key: Optional[str], fields: List[Callable[[Dict[str, Any]], Optional[str]]]) -> Section:
+    def render(doc: Dict[str, Any], report: NutritionReport) -> List[str]:
+        lines = [str(doc.get(title_key) or "План питания") if title_key else "План питания"]
+        lines.extend(line for line in (field(doc) for field in fields) if line)
+        if not np.isnan(report.daily_average).all():
+            lines.append(f"В среднем за день: {_macros_line(report.daily_average)}")
+        if report.macros_ratio is not None:
+            lines.append("Фактическое БЖУ, %: " + "/".join(str(share) for share in report.macros_ratio))
+        return ["\n".join(lines)]
+
+    return render
+
+
+def _days(key: str, meal_keys: List[str]) -> Section:
+    def render(doc: Dict[str, Any], report: NutritionReport) -> List[str]:
+        blocks = []
+        days = _dicts(doc.get(key))
+        for number, day, totals in zip(report.day_numbers, days, report.days):
+            lines = [f"День {number} — {_macros_line(totals)}"]
+            for meal in _dicts(day.get("meals")):
+                title = " — ".join(_text(meal[k]) for k in meal_keys if meal.get(k))
+                calories = meal.get("calories")
+                lines.append(f"• {title}" + (f" ({calories} ккал)" if calories is not None else ""))
+            blocks.append("\n".join(lines))
+        return blocks
+
+    return render
+
+
+def _shopping(key: str) -> Section:
+    def render(doc: Dict[str, Any], report: NutritionReport) -> List[str]:
+        items = report.shopping_list or [_text(item) for item in _list(doc.get(key))]
+        if not items:
+            return []
+        lines = [f"{LABELS.get(key, key)}:"] + [f"• {item}" for item in items[:MAX_SHOPPING_ITEMS]]
+        if len(items) > MAX_SHOPPING_ITEMS:
+            lines.append(f"…и ещё {len(items) - MAX_SHOPPING_ITEMS}")
+        return ["\n".join(lines)]
+
+    return render
+
+
+def _bullets(key: str) -> Section:
+    def render(doc: Dict[str, Any], report: NutritionReport) -> List[str]:
+        items = _list(doc.get(key))
+        return [f"{LABELS.get(key, key)}:\n" + "\n".join(f"• {_text(item)}" for item in items)] if items else []
+
+    return render
+
+
+def _issues(doc: Dict[str, Any], report: NutritionReport) -> List[str]:
+    if not report.issues:
+        return []
+    lines = ["Отклонения от цели:"] + [f"• {issue}" for issue in report.issues[:MAX_ISSUES]]
+    if len(report.issues) > MAX_ISSUES:
+        lines.append(f"…и ещё {len(report.issues) - MAX_ISSUES}")
+    return ["\n".join(lines)]
+
+
+class MenuRenderer:
+    # Plain-text rendering of a menu_schema document, laid out once from the schema:
+    # scalar/short fields form the header, the days array becomes one block per day,
+    # shopping_list is condensed and notes are bullets. Plain text needs no escaping
+    # (sent with parse_mode=None), and pages() keeps every page under Telegram's limit.
+
+    def __init__(self, spec: Dict[str, Any]) -> None:
+        title_key = "plan_title" if "plan_title" in spec else None
+        fields = []
+        tail: List[Section] = []
+        for key, value in spec.items():
+            if key == title_key:
+                continue
+            if isinstance(value, list) and value and isinstance(value[0], dict):
+                meal_spec = value[0].get("meals")
+                meal_keys = [k for k in ("name", "dish") if isinstance(meal_spec, list) and meal_spec and k in meal_spec[0]]
+                tail.append(_days(key, meal_keys))
+            elif key == "shopping_list":
+                tail.append(_shopping(key))
+            elif key == "notes":
+                tail.append(_bullets(key))
+            else:
+                fields.append(_field_line(key, value))
+        self.sections = [_header(title_key, fields), *tail, _issues]
+
+    def blocks(self, document: Dict[str, Any], report: Optional[NutritionReport] = None) -> List[str]:
+        report = report or analyze_menu(document)
+        return [block for section in self.sections for block in section(document, report)]
+
+    def render(self, document: Dict[str, Any], report: Optional[NutritionReport] = None) -> str:
+        return "\n\n".join(self.blocks(document, report))
+
+    def pages(
+        self, document: Dict[str, Any], report: Optional[NutritionReport] = None, *, max_len: int = MAX_PAGE_LEN
+    ) -> List[str]:
+        # Whole blocks are packed greedily; room is left for the "стр. i/n" footer
+        limit = max_len - 16
+        pages: List[str] = []
+        current = ""
+        for block in self.blocks(document, report):
+            for piece in _split(block, limit):
+                if current and len(current) + 2 + len(piece) > limit:
+                    pages.append(current)
+                    current = ""
+                current = f"{current}\n\n{piece}" if current else piece
+        if current:
+            pages.append(current)
+        if len(pages) > 1:
+            pages = [f"{page}\n\nстр. {i}/{len(pages)}" for i, page in enumerate(pages, 1)]
+        return pages
+
+
+def _split(block: str, limit: int) -> List[str]:
+    # Only oversized blocks are cut, and then at line boundaries
+    if len(block) <= limit:
+        return [block]
+    pieces: List[str] = []
+    current = ""
+    for line in block.split("\n"):
+        while len(line) > limit:
+            pieces.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            pieces.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+@lru_cache(maxsize=8)
+def _compile_cached(spec_json: str) -> MenuRenderer:
+    return MenuRenderer(json.loads(spec_json))
+
+
+def compile_renderer(template: Optional[dict]) -> Optional[MenuRenderer]:
+    schema = compile_template(template)
+    if schema is None:
+        return None
+    return _compile_cached(json.dumps(schema.spec, ensure_ascii=False))
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import os
+import threading
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+
+# One pooled client per process: keep-alive sockets are reused by every chat, so the
+# TLS handshake is paid once per connection instead of once per request
+_lock = threading.Lock()
+_client: OpenAI | None = None
+_async_client: AsyncOpenAI | None = None
+
+
+def _credentials() -> dict:
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise RuntimeError("OPENAI_API_KEY is not set. Please set it in your environment or in a .env file.")
+    # SDK retries are off by default: resilience.py owns backoff, Retry-After and the circuit breaker
+    kwargs = {"api_key": api_key, "max_retries": int(os.getenv("LLM_MAX_RETRIES", "0"))}
+    if os.getenv("OPENAI_BASE_URL"):
+        kwargs["base_url"] = os.environ["OPENAI_BASE_URL"]
+    return kwargs
+
+
+def pool_limits() -> httpx.Limits:
+    max_connections = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE", str(max_connections))),
+        keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60")),
+    )
+
+
+def request_timeout(read: float | None = None) -> httpx.Timeout:
+    # Applied per request and per phase: read bounds the gap between streamed chunks,
+    # pool bounds the wait for a free socket so a stalled upstream fails fast instead of queueing forever
+    return httpx.Timeout(
+        connect=float(os.getenv("LLM_CONNECT_TIMEOUT", "5")),
+        read=read if read is not None else float(os.getenv("LLM_READ_TIMEOUT", "180")),
+        write=float(os.getenv("LLM_WRITE_TIMEOUT", "10")),
+        pool=float(os.getenv("LLM_POOL_TIMEOUT", "10")),
+    )
+
+
+def http2_enabled() -> bool:
+    # HTTP/2 multiplexes concurrent calls over one socket; needs the optional h2 package
+    if os.getenv("LLM_HTTP2", "1") == "0":
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_client() -> OpenAI:
+    global _client
+    with _lock:
+        if _client is None:
+            _client = OpenAI(
+                **_credentials(),
+                timeout=request_timeout(),
+                http_client=DefaultHttpxClient(limits=pool_limits(), http2=http2_enabled(), timeout=request_timeout()),
+            )
+        return _client
+
+
+def get_async_client() -> AsyncOpenAI:
+    global _async_client
+    with _lock:
+        if _async_client is None:
+            _async_client = AsyncOpenAI(
+                **_credentials(),
+                timeout=request_timeout(),
+                http_client=DefaultAsyncHttpxClient(
+                    limits=pool_limits(), http2=http2_enabled(), timeout=request_timeout()
+                ),
+            )
+        return _async_client
+
+
+async def aclose_clients() -> None:
+    global _client, _async_client
+    with _lock:
+        client, async_client = _client, _async_client
+        _client = _async_client = None
+    if async_client is not None:
+        await async_client.close()
+    if client is not None:
+        client.close()
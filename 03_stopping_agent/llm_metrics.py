@@ -0,0 +1,305 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+from resilience import RESILIENCE
+from scheduler import PRIORITY_INTERACTIVE, SCHEDULER, estimate_prompt_tokens
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_BUCKETS = (64, 256, 1024, 2048, 4096, 8192, 16384, 32768)
+
+log = logging.getLogger("llm")
+if os.getenv("LLM_METRICS_LOG") and not log.handlers:
+    # One JSON line per LLM call on stderr
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(_handler)
+    log.setLevel(logging.INFO)
+    log.propagate = False
+
+
+@dataclass
+class CallRecord:
+    agent: str
+    model: str
+    stream: bool
+    wall_time: float
+    # Non-streamed calls see their first token when the whole answer arrives
+    ttft: Optional[float]
+    prompt_tokens: int
+    completion_tokens: int
+    retries: int
+    error: Optional[str] = None
+
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class LLMMetrics:
+    # Prometheus-style counters and histograms per agent and model
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, _Histogram]] = {}
+
+    def observe(self, record: CallRecord) -> None:
+        labels: Labels = (("agent", record.agent), ("model", record.model))
+        status = "error" if record.error else "ok"
+        with self._lock:
+            self._inc("llm_requests_total", labels + (("status", status),))
+            self._inc("llm_retries_total", labels, record.retries)
+            self._inc("llm_prompt_tokens_total", labels, record.prompt_tokens)
+            self._inc("llm_completion_tokens_total", labels, record.completion_tokens)
+            self._observe("llm_request_duration_seconds", labels, LATENCY_BUCKETS, record.wall_time)
+            if record.ttft is not None:
+                self._observe("llm_time_to_first_token_seconds", labels, LATENCY_BUCKETS, record.ttft)
+            if not record.error:
+                self._observe("llm_prompt_tokens", labels, TOKEN_BUCKETS, record.prompt_tokens)
+        log.info(json.dumps({"event": "llm_call", **asdict(record)}, ensure_ascii=False))
+
+    def inc(self, name: str, labels: Labels = (), value: float = 1) -> None:
+        # Counters of other components (caches, indexes) exported next to the LLM ones
+        with self._lock:
+            self._inc(name, labels, value)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{name}{_fmt_labels(labels)} {value:g}")
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for labels, hist in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(hist.buckets + (float("inf"),), hist.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                        lines.append(f"{name}_bucket{_fmt_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_fmt_labels(labels)} {hist.total:g}")
+                    lines.append(f"{name}_count{_fmt_labels(labels)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def _inc(self, name: str, labels: Labels, value: float = 1) -> None:
+        series = self._counters.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + value
+
+    def _observe(self, name: str, labels: Labels, buckets: Tuple[float, ...], value: float) -> None:
+        series = self._histograms.setdefault(name, {})
+        hist = series.get(labels)
+        if hist is None:
+            hist = series[labels] = _Histogram(buckets)
+        hist.observe(value)
+
+
+def _fmt_labels(labels: Labels) -> str:
+    inner = ",".join(f'{key}="{value}"' for key, value in labels)
+    return "{" + inner + "}"
+
+
+METRICS = LLMMetrics()
+
+
+def serve_metrics(port: int, metrics: LLMMetrics = METRICS) -> ThreadingHTTPServer:
+    # GET /metrics in Prometheus text format, served from a daemon thread
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class _CallTracker:
+    def __init__(self, agent: str, kwargs: Dict[str, Any]) -> None:
+        self.agent = agent
+        self.model = str(kwargs.get("model", ""))
+        self.stream = bool(kwargs.get("stream"))
+        self.started = time.perf_counter()
+        self.ttft: Optional[float] = None
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # Tokens reserved with the scheduler up front, trued up against real usage in finish()
+        self.reserved_tokens = 0
+        self.done = False
+
+    def usage(self, usage: Any) -> None:
+        if usage is not None:
+            self.prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+            self.completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+
+    def chunk(self, chunk: Any) -> None:
+        if self.ttft is None and chunk.choices:
+            delta = chunk.choices[0].delta
+            if getattr(delta, "content", None) or getattr(delta, "reasoning_content", None):
+                self.ttft = time.perf_counter() - self.started
+        self.usage(getattr(chunk, "usage", None))
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        if self.done:
+            return
+        self.done = True
+        wall = time.perf_counter() - self.started
+        if self.reserved_tokens and error is None and self.prompt_tokens:
+            SCHEDULER.settle(self.reserved_tokens, self.prompt_tokens + self.completion_tokens)
+        METRICS.observe(
+            CallRecord(
+                agent=self.agent,
+                model=self.model,
+                stream=self.stream,
+                wall_time=wall,
+                ttft=self.ttft if self.stream else (None if error else wall),
+                prompt_tokens=self.prompt_tokens,
+                completion_tokens=self.completion_tokens,
+                retries=self.retries,
+                error=_error_name(error),
+            )
+        )
+
+
+def _error_name(error: Optional[BaseException]) -> Optional[str]:
+    if error is None:
+        return None
+    if isinstance(error, (GeneratorExit, asyncio.CancelledError)):
+        # Consumer stopped reading (user pressed stop, reply superseded)
+        return "Cancelled"
+    return type(error).__name__
+
+
+class _TrackedStream:
+    def __init__(self, stream: Any, tracker: _CallTracker) -> None:
+        self._stream = stream
+        self._tracker = tracker
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                self._tracker.chunk(chunk)
+                yield chunk
+        except BaseException as exc:
+            self._tracker.finish(exc)
+            raise
+        self._tracker.finish()
+
+    def close(self) -> None:
+        self._stream.close()
+        self._tracker.finish()
+
+
+class _AsyncTrackedStream:
+    def __init__(self, stream: Any, tracker: _CallTracker) -> None:
+        self._stream = stream
+        self._tracker = tracker
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                self._tracker.chunk(chunk)
+                yield chunk
+        except BaseException as exc:
+            self._tracker.finish(exc)
+            raise
+        self._tracker.finish()
+
+    async def close(self) -> None:
+        await self._stream.close()
+        self._tracker.finish()
+
+
+def _prepare(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    if kwargs.get("stream") and "stream_options" not in kwargs:
+        # Ask for the trailing usage chunk so streamed calls report tokens too
+        kwargs = {**kwargs, "stream_options": {"include_usage": True}}
+    return kwargs
+
+
+def create_completion(client: Any, *, agent: str, **kwargs: Any) -> Any:
+    # Drop-in for client.chat.completions.create(**kwargs) that records metrics
+    tracker = _CallTracker(agent, kwargs)
+    kwargs = _prepare(kwargs)
+    try:
+        # Retries with backoff and the circuit breaker live in resilience.py
+        raw, retries = RESILIENCE.call(
+            lambda: client.chat.completions.with_raw_response.create(**kwargs), track_latency=not tracker.stream
+        )
+        tracker.retries = retries + getattr(raw, "retries_taken", 0)
+        response = raw.parse()
+    except BaseException as exc:
+        tracker.finish(exc)
+        raise
+    if tracker.stream:
+        return _TrackedStream(response, tracker)
+    tracker.usage(getattr(response, "usage", None))
+    tracker.finish()
+    return response
+
+
+async def acreate_completion(
+    client: Any, *, agent: str, priority: int = PRIORITY_INTERACTIVE, **kwargs: Any
+) -> Any:
+    tracker = _CallTracker(agent, kwargs)
+    kwargs = _prepare(kwargs)
+    tracker.reserved_tokens = estimate_prompt_tokens(kwargs.get("messages", []))
+
+    async def admit() -> None:
+        # Every attempt (retry, hedge) counts against the provider limits, so each one queues
+        await SCHEDULER.acquire(tracker.reserved_tokens, priority=priority)
+
+    async def attempt() -> Any:
+        return await client.chat.completions.with_raw_response.create(**kwargs)
+
+    try:
+        # Streams are never hedged: a duplicate would double the tokens the user is already reading
+        raw, retries = await RESILIENCE.acall(
+            attempt,
+            hedge=not tracker.stream,
+            track_latency=not tracker.stream,
+            admit=admit,
+        )
+        tracker.retries = retries + getattr(raw, "retries_taken", 0)
+        response = raw.parse()
+    except BaseException as exc:
+        tracker.finish(exc)
+        raise
+    if tracker.stream:
+        return _AsyncTrackedStream(response, tracker)
+    tracker.usage(getattr(response, "usage", None))
+    tracker.finish()
+    return response
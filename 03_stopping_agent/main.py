@@ -3,18 +3,31 @@ import os
 from aiogram import Bot, Dispatcher, Router
 from aiogram.filters import CommandStart
 from aiogram.types import Message
-from aiogram.enums import ParseMode, ChatAction
+from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from dotenv import load_dotenv, find_dotenv
-from openai import OpenAI
+from chat_action import HEARTBEAT
+from llm_client import aclose_clients
+from llm_metrics import serve_metrics
+from resilience import CircuitOpenError
+from scheduler import set_chat
 from agent import FormattingAgent
+from chat_worker import ChatDispatcher, deliver
+from compaction import HistoryCompactor
+from planner import MenuPlanner
+from session_store import MemorySessionStore, SqliteSessionStore
+from streaming import TelegramStreamer
+from summarizer import SummarizerAgent
+from tokens import COUNTER, PromptTooLargeError
+from webhook import WebhookSettings, run_webhook
 
 
 # Load environment variables
 load_dotenv(find_dotenv())
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
 TELEGRAM_API_KEY = os.getenv("TELEGRAM_API_KEY")
 
 if not OPENAI_API_KEY:
@@ -28,26 +41,40 @@ if not TELEGRAM_API_KEY:
     )
 
 
-# Initialize OpenAI client
-openai_client = (
-    OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
-    if OPENAI_BASE_URL
-    else OpenAI(api_key=OPENAI_API_KEY)
-)
-
 router = Router()
 
 
-# In-memory sessions: chat_id -> list of messages
-SESSIONS: dict[int, list[dict[str, str]]] = {}
+# Sessions: hot chats in a bounded LRU, idle/evicted ones spilled to SQLite
+SESSIONS_DB = os.getenv("SESSIONS_DB") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "sessions.sqlite3")
+SESSIONS = MemorySessionStore(
+    max_sessions=int(os.getenv("SESSIONS_MAX_CHATS", "10000")),
+    max_bytes=int(os.getenv("SESSIONS_MAX_BYTES", str(64 * 1024 * 1024))),
+    idle_ttl=float(os.getenv("SESSIONS_IDLE_TTL", "3600")),
+    backend=SqliteSessionStore(SESSIONS_DB),
+)
+
+# Agent instance; plans longer than MENU_PLAN_CHUNK_DAYS are generated in concurrent chunks (0 = off)
+MENU_PLAN_CHUNK_DAYS = int(os.getenv("MENU_PLAN_CHUNK_DAYS", "7"))
+AGENT = FormattingAgent(
+    planner=MenuPlanner(chunk_days=MENU_PLAN_CHUNK_DAYS, max_parallel=int(os.getenv("MENU_PLAN_PARALLEL", "5")))
+    if MENU_PLAN_CHUNK_DAYS > 0
+    else None
+)
 
-# Agent instance
-AGENT = FormattingAgent(openai_client)
+# Long dialogs: older turns get folded into a rolling summary in the background
+SUMMARIZER = SummarizerAgent(llm_humanize=os.getenv("MENU_HUMANIZE_LLM") == "1")
+COMPACTOR = HistoryCompactor(
+    SUMMARIZER,
+    max_prompt_tokens=int(os.getenv("COMPACT_MAX_PROMPT_TOKENS", "3000")),
+    keep_last=int(os.getenv("COMPACT_KEEP_LAST", "6")),
+)
 
 
 @router.message(CommandStart())
 async def on_start(message: Message) -> None:
-    SESSIONS[message.chat.id] = []
+    DISPATCHER.cancel(message.chat.id)
+    SESSIONS.reset(message.chat.id)
+    COUNTER.forget(message.chat.id)
     await message.answer(
         "Привет! Я — ваш фитнес-тренер и нутрициолог. Опишите кратко цель (снижение жира/набор/поддержание) и предпочтения — задам уточняющие вопросы и соберу меню.",
         parse_mode=None,
@@ -56,57 +83,119 @@ async def on_start(message: Message) -> None:
 
 @router.message()
 async def on_message(message: Message) -> None:
-    chat_id = message.chat.id
     user_text = (message.text or "").strip()
     if not user_text:
         await message.answer("Пожалуйста, отправьте текст.", parse_mode=None)
         return
 
-    history = SESSIONS.setdefault(chat_id, [])
+    # Serialized per chat; bursts of messages are merged into one LLM call
+    DISPATCHER.submit(message)
+
+
+async def process_message(message: Message, user_text: str) -> None:
+    chat_id = message.chat.id
+    # LLM calls of this chat (and the compaction it schedules) queue fairly against other chats
+    set_chat(chat_id)
+    history = await SESSIONS.aget(chat_id)
+    streamer = TelegramStreamer(message)
+    # One shared heartbeat keeps "typing..." up while the chat waits on the LLM
+    typing = HEARTBEAT.typing(message.bot, chat_id)
 
     try:
-        # Build conversation history with the new user message
-        history.append({"role": "user", "content": user_text})
+        # The user turn is committed to the session only once the reply succeeded,
+        # so a cancelled (superseded) call leaves the history untouched
+        turn = {"role": "user", "content": user_text}
+
+        # Oversized prompts are compacted right away instead of failing upstream
+        if COUNTER.count_session(chat_id, history) + COUNTER.count_message(turn) > AGENT.history_token_limit():
+            history = await COMPACTOR.compact_now(chat_id, SESSIONS)
+
+        async def on_delta(delta: str) -> None:
+            await streamer.push(delta)
+            if streamer.sent is not None:
+                typing.stop()
+
+        # Call agent with full history, streaming the reply into the chat
+        payload = await AGENT.astream_reply_payload_from_history(history + [turn], on_delta)
+        # Menus go out as plain-text pages rendered from menu_schema, not as a JSON fence
+        menu = await SUMMARIZER.ahumanize_menu(payload.document) if payload.document is not None else None
+        typing.stop()
+
+        async def send_reply() -> None:
+            # Final formatting in the last edit; keep session open
+            if menu is None:
+                await streamer.finish(payload.text, use_markdown=payload.use_markdown)
+                return
+            await streamer.finish(menu.pages[0], use_markdown=False)
+            for page in menu.pages[1:]:
+                await message.answer(page, parse_mode=None)
+
+        # No await between the reply and the commit: once saved, the turn is consumed
+        # and the final edit is delivered even if a newer message arrives meanwhile
+        history.append(turn)
+        SESSIONS.save(chat_id, history)
+        await deliver(send_reply())
+
+        COMPACTOR.schedule(chat_id, SESSIONS)
+    except asyncio.CancelledError:
+        await streamer.discard()
+        raise
+    except PromptTooLargeError:
+        await streamer.close()
+        await message.answer("Сообщение слишком длинное для модели. Сократите его или начните заново: /start", parse_mode=None)
+    except CircuitOpenError:
+        await streamer.close()
+        await message.answer("LLM сейчас недоступна, попробуйте через минуту.", parse_mode=None)
+    except Exception as exc:  # noqa: BLE001
+        await streamer.close()
+        await message.answer(f"Произошла ошибка при обращении к LLM: {exc}", parse_mode=None)
+    finally:
+        typing.stop()
 
-        # Append user's answer
-        history.append({"role": "user", "content": user_text})
 
-        stop_event = asyncio.Event()
+# Per-chat actors: one in-flight LLM call per chat, superseded calls get cancelled
+DISPATCHER = ChatDispatcher(process_message, debounce=float(os.getenv("CHAT_DEBOUNCE", "0.4")))
 
-        async def keep_typing() -> None:
-            try:
-                while not stop_event.is_set():
-                    await message.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-                    await asyncio.wait_for(stop_event.wait(), timeout=4.0)
-            except asyncio.TimeoutError:
-                await keep_typing()
 
-        typing_task = asyncio.create_task(keep_typing())
+async def on_shutdown() -> None:
+    HEARTBEAT.close()
+    await SESSIONS.aclose()
+    await aclose_clients()
 
-        # Call agent with full history
-        payload = await asyncio.to_thread(AGENT.reply_payload_from_history, history)
-        stop_event.set()
-        await typing_task
 
-        # Send answer and keep session open
-        if payload.use_markdown:
-            await message.answer(payload.text)
-        else:
-            await message.answer(payload.text, parse_mode=None)
-    except Exception as exc:  # noqa: BLE001
-        await message.answer(f"Произошла ошибка при обращении к LLM: {exc}", parse_mode=None)
+def build_bot() -> Bot:
+    # TELEGRAM_API_SERVER: self-hosted Bot API server (or a local fake in load tests)
+    api_server = os.getenv("TELEGRAM_API_SERVER")
+    session = AiohttpSession(api=TelegramAPIServer.from_base(api_server)) if api_server else None
+    return Bot(token=TELEGRAM_API_KEY, session=session, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN_V2))
 
 
-async def main() -> None:
-    bot = Bot(token=TELEGRAM_API_KEY, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN_V2))
+def build_dispatcher() -> Dispatcher:
     dp = Dispatcher()
     dp.include_router(router)
-    await dp.start_polling(bot)
+    dp.shutdown.register(on_shutdown)
+    return dp
+
+
+async def main() -> None:
+    # Prometheus metrics for every LLM call (latency, TTFT, tokens, retries) on :METRICS_PORT/metrics
+    if os.getenv("METRICS_PORT"):
+        serve_metrics(int(os.environ["METRICS_PORT"]))
+
+    bot = build_bot()
+    # getUpdates is refused while a webhook from an earlier webhook-mode run is set
+    await bot.delete_webhook()
+    await build_dispatcher().start_polling(bot)
 
 
 if __name__ == "__main__":
+    # WEBHOOK_URL switches to webhook mode; WEBHOOK_WORKERS > 1 shards chats over processes
+    WEBHOOK = WebhookSettings.from_env()
     try:
-        asyncio.run(main())
+        if WEBHOOK is not None:
+            run_webhook(build_bot, build_dispatcher, WEBHOOK)
+        else:
+            asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         pass
 
@@ -0,0 +1,338 @@
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Column order of every macro array below
+MACROS = ("calories", "protein_g", "fat_g", "carbs_g")
+
+# Per 100 g (raw): kcal, protein, fat, carbs, and the weight of one piece where "шт" makes sense.
+# A stem matches at the start of a word; "a b" means a word starting with a followed by one
+# starting with b, and a trailing space means a whole word. See match_food for the resolution.
+FOODS: Tuple[Tuple[Tuple[str, ...], float, float, float, float, Optional[float]], ...] = (
+    (("куриное филе", "филе кур", "куриная груд", "куриной груд"), 113, 23.6, 1.9, 0.4, None),
+    (("индейк",), 114, 19.2, 0.7, 0.0, None),
+    (("говядин",), 187, 18.9, 12.4, 0.0, None),
+    (("свинин",), 259, 16.0, 21.6, 0.0, None),
+    (("лосос", "сёмг", "семг"), 208, 20.0, 13.0, 0.0, None),
+    (("треск", "минта", "хек"), 78, 17.7, 0.7, 0.0, None),
+    (("тунец", "тунца"), 101, 23.0, 1.0, 0.0, None),
+    (("креветк",), 95, 18.9, 2.2, 0.0, None),
+    (("яйц", "яйко"), 157, 12.7, 11.5, 0.7, 55),
+    (("творог",), 121, 17.0, 5.0, 1.8, None),
+    (("кефир",), 51, 3.0, 2.5, 4.0, None),
+    (("йогурт",), 66, 5.0, 3.2, 3.5, None),
+    (("молок",), 52, 2.8, 2.5, 4.7, None),
+    (("сливочн", "сливочн масл", "масл сливочн"), 748, 0.5, 82.5, 0.8, None),
+    (("масло",), 899, 0.0, 99.9, 0.0, None),
+    (("тофу",), 73, 8.1, 4.2, 0.6, None),
+    (("сыр",), 350, 26.0, 26.5, 0.0, None),
+    (("гречк", "гречнев"), 313, 12.6, 3.3, 62.1, None),
+    (("рис",), 344, 6.7, 0.7, 78.9, None),
+    (("овсян", "геркулес"), 352, 12.3, 6.1, 59.5, None),
+    (("киноа",), 368, 14.1, 6.1, 64.2, None),
+    (("булгур",), 342, 12.3, 1.3, 57.6, None),
+    (("макарон", "спагетти", "паста"), 338, 10.4, 1.1, 71.5, None),
+    (("хлеб", "хлебц"), 242, 8.1, 1.0, 48.8, None),
+    (("чечевиц",), 295, 24.0, 1.5, 46.3, None),
+    (("фасол",), 298, 21.0, 2.0, 47.0, None),
+    (("нут",), 364, 19.0, 6.0, 61.0, None),
+    (("миндал",), 609, 18.6, 53.7, 13.0, None),
+    (("орех",), 607, 16.0, 60.0, 11.0, None),
+    (("арахисов паст", "арахисов масл", "паст арахисов"), 588, 25.0, 50.0, 20.0, None),
+    (("авокадо",), 160, 2.0, 14.7, 8.5, 150),
+    (("банан",), 96, 1.5, 0.2, 21.8, 120),
+    (("яблок",), 47, 0.4, 0.4, 9.8, 180),
+    (("ягод", "черник", "клубник", "малин"), 45, 0.8, 0.4, 9.0, None),
+    (("батат",), 86, 1.6, 0.1, 20.1, 200),
+    (("картоф",), 77, 2.0, 0.4, 16.3, 100),
+    (("брокколи",), 34, 2.8, 0.4, 6.6, None),
+    (("огур",), 15, 0.8, 0.1, 2.8, 120),
+    (("помидор", "томат"), 20, 1.1, 0.2, 3.7, 120),
+    (("томатн паст", "паст томатн"), 99, 4.8, 0.0, 19.0, None),
+    (("морков",), 35, 1.3, 0.1, 6.9, 80),
+    (("болгарск", "перец слад"), 27, 1.3, 0.0, 5.3, 150),
+    (("лук",), 41, 1.4, 0.0, 10.4, 80),
+    (("шпинат",), 23, 2.9, 0.3, 2.0, None),
+    (("капуст",), 27, 1.8, 0.1, 4.7, None),
+    (("гриб", "шампиньон", "вешенк", "сыроеж", "опят"), 27, 4.3, 1.0, 0.1, None),
+    (("мёд", "мед "), 329, 0.8, 0.0, 80.3, None),
+    (("сахар",), 398, 0.0, 0.0, 99.7, None),
+)
+
+# Words that contain a food's stem but are not that food ("морковь сырая", plant milks,
+# sweeteners); they win over the shorter stem they cover and match nothing themselves
+NOT_FOODS: Tuple[str, ...] = (
+    "сырой ", "сырая ", "сырое ", "сырые ", "сырых ", "сырую ", "сырого ", "сырник",
+    "сахарозамен", "подсластит",
+    "миндальн молок", "овсян молок", "соев молок", "кокосов молок", "рисов молок",
+    "молок миндальн", "молок овсян", "молок соев", "молок кокосов", "молок рисов",
+)
+
+_FOOD_MACROS = np.array([food[1:5] for food in FOODS], dtype=float) / 100.0
+_FOOD_PIECE = np.array([np.nan if food[5] is None else food[5] for food in FOODS], dtype=float)
+# Oils are lighter than water; everything else measured in ml is close enough to 1 g/ml
+_FOOD_DENSITY = np.array([0.92 if "масло" in food[0] else 1.0 for food in FOODS], dtype=float)
+
+# Unit spelling (lower case, no dots or spaces) -> (base unit, factor)
+UNITS: Dict[str, Tuple[str, float]] = {
+    "г": ("г", 1.0),
+    "гр": ("г", 1.0),
+    "грамм": ("г", 1.0),
+    "граммов": ("г", 1.0),
+    "g": ("г", 1.0),
+    "кг": ("г", 1000.0),
+    "kg": ("г", 1000.0),
+    "мг": ("г", 0.001),
+    "мл": ("мл", 1.0),
+    "ml": ("мл", 1.0),
+    "л": ("мл", 1000.0),
+    "l": ("мл", 1000.0),
+    "стл": ("мл", 15.0),
+    "столоваяложка": ("мл", 15.0),
+    "чл": ("мл", 5.0),
+    "чайнаяложка": ("мл", 5.0),
+    "стакан": ("мл", 250.0),
+    "шт": ("шт", 1.0),
+    "штук": ("шт", 1.0),
+    "штуки": ("шт", 1.0),
+    "pcs": ("шт", 1.0),
+}
+
+# Shares of energy: protein and carbs give 4 kcal/g, fat 9 kcal/g
+_KCAL_PER_G = np.array([4.0, 9.0, 4.0])
+CALORIES_TOLERANCE = 0.10
+RATIO_TOLERANCE = 5.0
+
+
+def normalize_unit(unit: Any) -> Tuple[str, float]:
+    raw = str(unit or "").strip()
+    key = raw.lower().replace(".", "").replace(" ", "")
+    return UNITS.get(key, (raw.lower(), 1.0))
+
+
+def _stem_pattern(stem: str) -> "re.Pattern[str]":
+    words = stem.split()
+    body = r"\w*\s+".join(re.escape(word) for word in words)
+    return re.compile(rf"(?<!\w){body}" + (r"(?!\w)" if stem.endswith(" ") else ""))
+
+
+# (pattern, specificity, food index or -1 for NOT_FOODS), most specific first
+_STEMS = sorted(
+    [(_stem_pattern(stem), len(stem.strip()), index) for index, food in enumerate(FOODS) for stem in food[0]]
+    + [(_stem_pattern(stem), len(stem.strip()), -1) for stem in NOT_FOODS],
+    key=lambda item: -item[1],
+)
+
+
+@lru_cache(maxsize=4096)
+def match_food(name: str) -> int:
+    # The longest stem claims its part of the name, shorter stems inside it are dropped
+    # ("миндальное молоко" is not milk, "сыроежки" not cheese). A name that still names
+    # two different foods is ambiguous and stays unknown, so the model's numbers are kept.
+    lower = name.lower()
+    taken: List[Tuple[int, int]] = []
+    foods = set()
+    for pattern, _, index in _STEMS:
+        for found in pattern.finditer(lower):
+            start, end = found.span()
+            if any(start < stop and begin < end for begin, stop in taken):
+                continue
+            taken.append((start, end))
+            if index >= 0:
+                foods.add(index)
+    return foods.pop() if len(foods) == 1 else -1
+
+
+def _number(value: Any) -> float:
+    return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else np.nan
+
+
+def _dicts(value: Any) -> List[Dict[str, Any]]:
+    # Items of a list that are objects; a failed repair can leave strings or nulls in their place
+    return [item for item in value if isinstance(item, dict)] if isinstance(value, list) else []
+
+
+@dataclass
+class NutritionReport:
+    # (meals, 4) / (days, 4) arrays in MACROS order; NaN where nothing is known
+    meals: np.ndarray
+    days: np.ndarray
+    day_numbers: List[int]
+    # Meals whose every ingredient was found in FOODS, so the computed values replace the model's
+    computed: np.ndarray
+    plan: np.ndarray
+    daily_average: np.ndarray
+    shopping_list: List[str]
+    issues: List[str] = field(default_factory=list)
+
+    @property
+    def macros_ratio(self) -> Optional[Tuple[int, int, int]]:
+        # Only meals with all three macros known: a partly known meal would skew the shares
+        grams = self.meals[:, 1:]
+        complete = ~np.isnan(grams).any(axis=1)
+        if not complete.any():
+            return None
+        energy = grams[complete].sum(axis=0) * _KCAL_PER_G
+        total = energy.sum()
+        if not total:
+            return None
+        return tuple(int(round(share)) for share in energy / total * 100)
+
+
+class _Flat:
+    # days[].meals[].ingredients[] flattened into parallel arrays (one row per ingredient / meal)
+
+    def __init__(self, days: List[Dict[str, Any]]) -> None:
+        self.day_numbers: List[int] = []
+        meal_day: List[int] = []
+        reported: List[List[float]] = []
+        ing_meal: List[int] = []
+        qty: List[float] = []
+        factor: List[float] = []
+        self.names: List[str] = []
+        self.units: List[str] = []
+        for d, day in enumerate(days):
+            self.day_numbers.append(day.get("day") if isinstance(day.get("day"), int) else d + 1)
+            for meal in _dicts(day.get("meals")):
+                m = len(meal_day)
+                meal_day.append(d)
+                reported.append([_number(meal.get(key)) for key in MACROS])
+                for ingredient in _dicts(meal.get("ingredients")):
+                    name = str(ingredient.get("name") or "").strip()
+                    if not name:
+                        continue
+                    unit, unit_factor = normalize_unit(ingredient.get("unit"))
+                    ing_meal.append(m)
+                    qty.append(_number(ingredient.get("qty")))
+                    factor.append(unit_factor)
+                    self.names.append(name)
+                    self.units.append(unit)
+        self.meal_day = np.array(meal_day, dtype=int)
+        self.reported = np.array(reported, dtype=float).reshape(-1, len(MACROS))
+        self.ing_meal = np.array(ing_meal, dtype=int)
+        # Quantity in the base unit (г, мл, шт, or whatever unit the model invented)
+        self.amount = np.array(qty, dtype=float) * np.array(factor, dtype=float)
+        self.food = np.array([match_food(name) for name in self.names], dtype=int)
+        self.base_units = np.array(self.units, dtype=object)
+
+    def grams(self) -> np.ndarray:
+        known = self.food >= 0
+        food = np.where(known, self.food, 0)
+        grams = np.full(self.amount.shape, np.nan)
+        grams = np.where(self.base_units == "г", self.amount, grams)
+        grams = np.where(self.base_units == "мл", self.amount * _FOOD_DENSITY[food], grams)
+        grams = np.where(self.base_units == "шт", self.amount * _FOOD_PIECE[food], grams)
+        return np.where(known, grams, np.nan)
+
+
+def _computed_meals(flat: _Flat) -> Tuple[np.ndarray, np.ndarray]:
+    meals = len(flat.meal_day)
+    grams = flat.grams()
+    macros = grams[:, None] * _FOOD_MACROS[np.where(flat.food >= 0, flat.food, 0)]
+    known = ~np.isnan(grams)
+    totals = np.zeros((meals, len(MACROS)))
+    np.add.at(totals, flat.ing_meal[known], macros[known])
+    # A meal counts as computed only if every ingredient is known; otherwise keep the model's numbers
+    unknown = np.bincount(flat.ing_meal[~known], minlength=meals)
+    counted = np.bincount(flat.ing_meal, minlength=meals)
+    return totals, (unknown == 0) & (counted > 0)
+
+
+def _group_sum(values: np.ndarray, groups: np.ndarray, size: int) -> np.ndarray:
+    # NaN-aware sum per group; a group with no known value stays NaN
+    totals = np.zeros((size, values.shape[1]))
+    seen = np.zeros((size, values.shape[1]), dtype=bool)
+    present = ~np.isnan(values)
+    np.add.at(totals, groups, np.where(present, values, 0.0))
+    np.logical_or.at(seen, groups, present)
+    return np.where(seen, totals, np.nan)
+
+
+def _format_amount(amount: float, unit: str) -> str:
+    if unit == "г" and amount >= 1000:
+        return f"{amount / 1000:.3g} кг"
+    if unit == "мл" and amount >= 1000:
+        return f"{amount / 1000:.3g} л"
+    return f"{amount:g} {unit}".rstrip()
+
+
+def _shopping_list(flat: _Flat) -> List[str]:
+    # Same ingredient (case-insensitive) in the same base unit is merged across the whole plan
+    if not flat.names:
+        return []
+    keys = np.array([f"{name.lower()}\x00{unit}" for name, unit in zip(flat.names, flat.units)], dtype=object)
+    unique, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    amount = np.where(np.isnan(flat.amount), 0.0, flat.amount)
+    totals = np.bincount(inverse.ravel(), weights=amount, minlength=len(unique))
+    items = []
+    for index, total in zip(first, totals):
+        name, unit = flat.names[index], flat.units[index]
+        items.append(f"{name} — {_format_amount(round(float(total), 1), unit)}" if total > 0 else name)
+    return items
+
+
+def analyze_menu(document: Dict[str, Any]) -> NutritionReport:
+    days = _dicts(document.get("days"))
+    flat = _Flat(days)
+    computed_totals, computed = _computed_meals(flat)
+    meals = np.where(computed[:, None], computed_totals, flat.reported)
+    per_day = _group_sum(meals, flat.meal_day, len(days))
+    plan = np.nansum(per_day, axis=0) if len(days) else np.full(len(MACROS), np.nan)
+    with np.errstate(invalid="ignore"):
+        daily_average = np.nanmean(per_day, axis=0) if len(days) else np.full(len(MACROS), np.nan)
+    report = NutritionReport(
+        meals=meals,
+        days=per_day,
+        day_numbers=flat.day_numbers,
+        computed=computed,
+        plan=plan,
+        daily_average=daily_average,
+        shopping_list=_shopping_list(flat),
+    )
+    report.issues = check_targets(document, report)
+    return report
+
+
+def check_targets(document: Dict[str, Any], report: NutritionReport) -> List[str]:
+    issues: List[str] = []
+    target = _number(document.get("total_daily_calories"))
+    if not np.isnan(target) and target > 0 and len(report.days):
+        deviation = (report.days[:, 0] - target) / target
+        off = np.flatnonzero(np.abs(deviation) > CALORIES_TOLERANCE)
+        for i in off:
+            issues.append(f"День {report.day_numbers[i]}: {report.days[i, 0]:.0f} ккал при цели {target:.0f}")
+    ratio = document.get("macros_ratio") or {}
+    wanted = np.array([_number(ratio.get(f"{key}_percent")) for key in ("protein", "fat", "carbs")])
+    actual = report.macros_ratio
+    if actual is not None and not np.isnan(wanted).all():
+        labels = ("белков", "жиров", "углеводов")
+        for label, want, got in zip(labels, wanted, actual):
+            if not np.isnan(want) and abs(got - want) > RATIO_TOLERANCE:
+                issues.append(f"Доля {label}: {got}% при цели {want:.0f}%")
+    return issues
+
+
+def apply_nutrition(document: Dict[str, Any]) -> NutritionReport:
+    # Writes the derived fields into a validated menu_schema document in place
+    report = analyze_menu(document)
+    meal_index = 0
+    for day in _dicts(document.get("days")):
+        for meal in _dicts(day.get("meals")):
+            if report.computed[meal_index]:
+                for key, value in zip(MACROS, report.meals[meal_index]):
+                    meal[key] = int(round(value))
+            meal_index += 1
+    if document.get("total_daily_calories") is None and not np.isnan(report.daily_average[0]):
+        document["total_daily_calories"] = int(round(report.daily_average[0]))
+    ratio = document.get("macros_ratio")
+    if isinstance(ratio, dict) and report.macros_ratio is not None:
+        for key, share in zip(("protein_percent", "fat_percent", "carbs_percent"), report.macros_ratio):
+            if ratio.get(key) is None:
+                ratio[key] = share
+    document["shopping_list"] = report.shopping_list
+    return report
@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+import asyncio
+import json
+from typing import Any, Dict, List, Tuple
+
+from openai import AsyncOpenAI, OpenAI
+from llm_client import get_async_client, get_client
+from llm_metrics import acreate_completion
+from structured import (
+    JSON_MODE_UNSUPPORTED,
+    CompiledSchema,
+    IncrementalJSON,
+    get_at,
+    parse_repair,
+    repair_messages,
+    set_at,
+    unit_of,
+)
+
+# Generated by the fan-out; keys before it in the schema are the skeleton, keys after it
+# are written in the reduce step, except those computed locally from the ingredients
+FANOUT_KEY = "days"
+LOCAL_KEYS = ("shopping_list",)
+
+DAYS_PROMPT = (
+    "Ты — фитнес-тренер-агент по питанию. Каркас плана питания уже утверждён, твоя задача — расписать указанные дни. "
+    "Строго соблюдай цель, калорийность, ограничения, исключённые ингредиенты, оборудование и время готовки из каркаса. "
+    "Все текстовые значения на русском (ru). Для каждого ингредиента указывай qty и unit (г, мл, шт). "
+    'Возвращай только JSON-объект {"days": [...]} без комментариев, каждый день — строго по схеме дня.'
+)
+
+TAIL_PROMPT = (
+    "Ты — фитнес-тренер-агент по питанию. План питания уже расписан по дням, осталось дописать "
+    "завершающие поля плана по каркасу и списку блюд. Все текстовые значения на русском (ru). "
+    "Возвращай только JSON-объект с указанными полями строго по схеме, без комментариев."
+)
+
+
+class MenuPlanner:
+    # Map-reduce generation of long menu plans: the skeleton (the menu_schema keys
+    # before the days) comes first, then days are generated in chunks concurrently and
+    # merged, the keys after the days (notes) are written from the merged plan, and the
+    # result is validated as one document. Latency follows the slowest chunk instead
+    # of the plan length, and no single completion runs into max_tokens.
+
+    def __init__(
+        self,
+        client: OpenAI | None = None,
+        model: str = "deepseek-chat",
+        temperature: float = 0.6,
+        *,
+        async_client: AsyncOpenAI | None = None,
+        chunk_days: int = 7,
+        max_parallel: int = 5,
+        tokens_per_meal: int = 350,
+    ) -> None:
+        if client is None:
+            client, async_client = get_client(), async_client or get_async_client()
+        self.client = client
+        self.async_client = async_client
+        self.model = model
+        self.temperature = temperature
+        self.chunk_days = chunk_days
+        self.max_parallel = max_parallel
+        self.tokens_per_meal = tokens_per_meal
+
+    def should_fan_out(self, skeleton: Dict[str, Any]) -> bool:
+        # Short plans are cheaper to finish in the original completion
+        return self._duration(skeleton) > self.chunk_days
+
+    def _duration(self, skeleton: Dict[str, Any]) -> int:
+        try:
+            return max(1, int(skeleton.get("duration_days") or 1))
+        except (TypeError, ValueError):
+            return 1
+
+    def _chunks(self, duration: int) -> List[Tuple[int, int]]:
+        return [(first, min(first + self.chunk_days - 1, duration)) for first in range(1, duration + 1, self.chunk_days)]
+
+    @staticmethod
+    def _tail_keys(schema: CompiledSchema) -> List[str]:
+        keys = list(schema.spec)
+        if FANOUT_KEY not in keys:
+            return []
+        return [key for key in keys[keys.index(FANOUT_KEY) + 1 :] if key not in LOCAL_KEYS]
+
+    def _format_kwargs(self) -> dict:
+        return {} if self.model in JSON_MODE_UNSUPPORTED else {"response_format": {"type": "json_object"}}
+
+    async def _complete(self, messages: List[Dict[str, str]], *, max_tokens: int, temperature: float) -> str:
+        response = await acreate_completion(
+            self.async_client,
+            agent=type(self).__name__,
+            model=self.model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            **self._format_kwargs(),
+        )
+        return response.choices[0].message.content or ""
+
+    def _days_messages(self, schema: CompiledSchema, skeleton: Dict[str, Any], first: int, last: int) -> List[Dict[str, str]]:
+        return [
+            {"role": "system", "content": DAYS_PROMPT},
+            {
+                "role": "user",
+                "content": (
+                    f"Каркас плана: {json.dumps(skeleton, ensure_ascii=False)}\n"
+                    f"Схема дня: {json.dumps(schema.spec_at(('days', 0)), ensure_ascii=False)}\n"
+                    f"Распиши дни с {first} по {last} включительно, по {skeleton.get('meals_per_day') or 3} приёма пищи в день."
+                ),
+            },
+        ]
+
+    async def _generate_days(
+        self, schema: CompiledSchema, skeleton: Dict[str, Any], first: int, last: int
+    ) -> Dict[int, Any]:
+        meals = skeleton.get("meals_per_day") if isinstance(skeleton.get("meals_per_day"), int) else 3
+        max_tokens = min(8192, 200 + self.tokens_per_meal * meals * (last - first + 1))
+        text = await self._complete(
+            self._days_messages(schema, skeleton, first, last), max_tokens=max_tokens, temperature=self.temperature
+        )
+        # Element by element, so a chunk cut off by max_tokens still keeps its finished days
+        days = [value for path, value in IncrementalJSON().feed(text) if len(path) == 2 and path[0] == "days"]
+        # Days are numbered by position: models often restart the count at 1 in every chunk
+        return {
+            number: {**day, "day": number}
+            for number, day in zip(range(first, last + 1), days)
+            if isinstance(day, dict)
+        }
+
+    async def _generate_tail(
+        self, schema: CompiledSchema, skeleton: Dict[str, Any], days: List[Dict[str, Any]], keys: List[str]
+    ) -> Dict[str, Any]:
+        # Reduce step: the schema keys after the days (notes), written from the dishes only
+        dishes = {
+            day["day"]: [meal.get("dish") for meal in day.get("meals") or [] if isinstance(meal, dict)] for day in days
+        }
+        messages = [
+            {"role": "system", "content": TAIL_PROMPT},
+            {
+                "role": "user",
+                "content": (
+                    f"Каркас плана: {json.dumps(skeleton, ensure_ascii=False)}\n"
+                    f"Блюда по дням: {json.dumps(dishes, ensure_ascii=False)}\n"
+                    f"Поля и их схема: {json.dumps({key: schema.spec_at((key,)) for key in keys}, ensure_ascii=False)}"
+                ),
+            },
+        ]
+        parser = IncrementalJSON()
+        parser.feed(await self._complete(messages, max_tokens=1024, temperature=self.temperature))
+        value = parser.value()
+        return {key: value[key] for key in keys if key in value} if isinstance(value, dict) else {}
+
+    async def agenerate(self, schema: CompiledSchema, skeleton: Dict[str, Any]) -> Dict[str, Any]:
+        keys = list(schema.spec)
+        head = keys[: keys.index(FANOUT_KEY)] if FANOUT_KEY in keys else keys
+        skeleton = {key: value for key, value in skeleton.items() if key in head}
+        duration = self._duration(skeleton)
+        semaphore = asyncio.Semaphore(self.max_parallel)
+
+        async def chunk(first: int, last: int) -> Dict[int, Any]:
+            async with semaphore:
+                days = await self._generate_days(schema, skeleton, first, last)
+                missing = [n for n in range(first, last + 1) if n not in days]
+                if missing:
+                    # One retry for the days the model skipped, not for the whole chunk
+                    days.update(await self._generate_days(schema, skeleton, missing[0], missing[-1]))
+                return days
+
+        merged: Dict[int, Any] = {}
+        for days in await asyncio.gather(*(chunk(first, last) for first, last in self._chunks(duration))):
+            merged.update(days)
+
+        # shopping_list and the nutrition totals are computed from the ingredients afterwards
+        days = [merged[n] for n in sorted(merged)]
+        document = {**skeleton, FANOUT_KEY: days}
+        tail_keys = self._tail_keys(schema)
+        if tail_keys:
+            try:
+                document.update(await self._generate_tail(schema, skeleton, days, tail_keys))
+            except Exception:  # noqa: BLE001
+                # The days are the plan; missing notes are filled with defaults by validation
+                pass
+        fixed = await self.arepair(schema, document)
+
+        missing = [n for n in range(1, duration + 1) if n not in merged]
+        if missing:
+            # Days lost even after the retry: say so instead of returning a silently shorter plan
+            note = f"Не удалось составить дни: {', '.join(map(str, missing))}. Попросите расписать их повторно."
+            if not isinstance(schema.spec.get("notes"), list):
+                raise RuntimeError(note)
+            if not isinstance(fixed.get("notes"), list):
+                fixed["notes"] = []
+            fixed["notes"].append(note)
+        return fixed
+
+    async def arepair(self, schema: CompiledSchema, document: Dict[str, Any]) -> Dict[str, Any]:
+        # Final validation of the merged document; broken units are repaired concurrently
+        fixed, errors = schema.validate(document)
+        units: Dict[Tuple, List] = {}
+        for error in errors:
+            units.setdefault(unit_of(error.path), []).append(error)
+
+        async def repair(unit: Tuple, unit_errors: List) -> None:
+            messages = repair_messages(schema, unit, get_at(fixed, unit), fixed, unit_errors)
+            text = await self._complete(messages, max_tokens=2048, temperature=0.0)
+            ok, value = parse_repair(schema, unit, text)
+            if ok:
+                set_at(fixed, unit, value)
+
+        await asyncio.gather(*(repair(unit, unit_errors) for unit, unit_errors in units.items()), return_exceptions=True)
+        return fixed
@@ -0,0 +1,327 @@
+from __future__ import annotations
+
+import asyncio
+import email.utils
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional, Tuple, TypeVar
+
+import openai
+
+T = TypeVar("T")
+
+log = logging.getLogger("llm")
+
+RETRYABLE_STATUSES = frozenset({408, 409, 429})
+
+
+class CircuitOpenError(RuntimeError):
+    # Raised without touching the network while the upstream is considered down
+    pass
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, openai.APIConnectionError):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code in RETRYABLE_STATUSES or exc.status_code >= 500
+    return False
+
+
+def is_upstream_failure(exc: BaseException) -> bool:
+    # What counts against the breaker: the provider is unreachable or broken, not our request or quota
+    if isinstance(exc, openai.APIConnectionError):
+        return True
+    return isinstance(exc, openai.APIStatusError) and exc.status_code >= 500
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        max_attempts: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+        max_retry_after: float = 60.0,
+    ) -> None:
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+
+    def delay(self, attempt: int, exc: BaseException) -> Optional[float]:
+        # None means give up; attempt counts from 1
+        if attempt >= self.max_attempts or not is_retryable(exc):
+            return None
+        hinted = retry_after(exc)
+        if hinted is not None:
+            return hinted if hinted <= self.max_retry_after else None
+        # Full jitter keeps a burst of failed chats from retrying in lockstep
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    # closed -> open once the last `window` calls hold at least failure_threshold upstream failures
+    # making up failure_ratio of them; after reset_timeout one probe call is let through (half-open)
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self, failure_threshold: int = 20, reset_timeout: float = 30.0, *, window: int = 50, failure_ratio: float = 0.5
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failure_ratio = failure_ratio
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._outcomes: deque[bool] = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._probing:
+                raise CircuitOpenError("LLM upstream is unavailable, try again later")
+            self._state = self.HALF_OPEN
+            self._probing = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state != self.CLOSED:
+                log.warning("llm circuit closed")
+                self._outcomes.clear()
+            self._state = self.CLOSED
+            self._outcomes.append(True)
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._probing = False
+            if self._state == self.OPEN:
+                return
+            self._outcomes.append(False)
+            failures = self._outcomes.count(False)
+            tripped = failures >= self.failure_threshold and failures >= self.failure_ratio * len(self._outcomes)
+            if self._state == self.HALF_OPEN or tripped:
+                log.warning("llm circuit opened after %d of %d calls failed", failures, len(self._outcomes))
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def release(self) -> None:
+        # A probe that ended without a verdict (cancelled, client-side error)
+        with self._lock:
+            self._probing = False
+
+    def settle(self, exc: BaseException) -> None:
+        if is_upstream_failure(exc):
+            self.record_failure()
+        else:
+            self.release()
+
+
+class LatencyWindow:
+    # Recent successful call latencies, used to pick the hedging deadline
+
+    def __init__(self, size: int = 200, min_samples: int = 20) -> None:
+        self._samples: deque[float] = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def observe(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Resilience:
+    def __init__(
+        self,
+        policy: Optional[RetryPolicy] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        *,
+        hedge: bool = False,
+        hedge_quantile: float = 0.95,
+    ) -> None:
+        self.policy = policy or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.latencies = LatencyWindow()
+
+    @classmethod
+    def from_env(cls) -> "Resilience":
+        return cls(
+            RetryPolicy(
+                max_attempts=int(os.getenv("LLM_RETRY_ATTEMPTS", "4")),
+                base_delay=float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5")),
+                max_delay=float(os.getenv("LLM_RETRY_MAX_DELAY", "8")),
+            ),
+            CircuitBreaker(
+                failure_threshold=int(os.getenv("LLM_BREAKER_THRESHOLD", "20")),
+                reset_timeout=float(os.getenv("LLM_BREAKER_RESET", "30")),
+            ),
+            hedge=os.getenv("LLM_HEDGE", "0") == "1",
+        )
+
+    def call(self, attempt: Callable[[], T], *, track_latency: bool = True) -> Tuple[T, int]:
+        # Returns (result, retries taken)
+        retries = 0
+        while True:
+            try:
+                result = self._attempt(attempt, track_latency)
+            except Exception as exc:
+                delay = self.policy.delay(retries + 1, exc)
+                if delay is None:
+                    raise
+                retries += 1
+                time.sleep(delay)
+                continue
+            return result, retries
+
+    async def acall(
+        self,
+        attempt: Callable[[], Awaitable[T]],
+        *,
+        hedge: bool = True,
+        track_latency: bool = True,
+        admit: Optional[Callable[[], Awaitable[None]]] = None,
+    ) -> Tuple[T, int]:
+        # admit(): waits for a slot before every attempt (the LLM scheduler); that wait is
+        # not upstream latency, so neither the latency window nor the hedge clock sees it
+        retries = 0
+        while True:
+            try:
+                if hedge and self.hedge:
+                    result = await self._ahedged(attempt, track_latency, admit)
+                else:
+                    result = await self._aattempt(attempt, track_latency, admit)
+            except Exception as exc:
+                delay = self.policy.delay(retries + 1, exc)
+                if delay is None:
+                    raise
+                retries += 1
+                await asyncio.sleep(delay)
+                continue
+            return result, retries
+
+    def _attempt(self, attempt: Callable[[], T], track_latency: bool) -> T:
+        self.breaker.before_call()
+        started = time.perf_counter()
+        try:
+            result = attempt()
+        except Exception as exc:
+            self.breaker.settle(exc)
+            raise
+        except BaseException:
+            self.breaker.release()
+            raise
+        self.breaker.record_success()
+        if track_latency:
+            self.latencies.observe(time.perf_counter() - started)
+        return result
+
+    async def _aattempt(
+        self,
+        attempt: Callable[[], Awaitable[T]],
+        track_latency: bool,
+        admit: Optional[Callable[[], Awaitable[None]]] = None,
+        admitted: Optional[asyncio.Event] = None,
+    ) -> T:
+        if admit is not None:
+            await admit()
+        if admitted is not None:
+            admitted.set()
+        self.breaker.before_call()
+        started = time.perf_counter()
+        try:
+            result = await attempt()
+        except Exception as exc:
+            self.breaker.settle(exc)
+            raise
+        except BaseException:
+            self.breaker.release()
+            raise
+        self.breaker.record_success()
+        if track_latency:
+            self.latencies.observe(time.perf_counter() - started)
+        return result
+
+    async def _ahedged(
+        self,
+        attempt: Callable[[], Awaitable[T]],
+        track_latency: bool,
+        admit: Optional[Callable[[], Awaitable[None]]] = None,
+    ) -> T:
+        # Fire a second identical request once the first outlives the recent p95;
+        # whichever succeeds first wins and the other one is cancelled
+        deadline = self.latencies.quantile(self.hedge_quantile)
+        admitted = asyncio.Event()
+        tasks = {asyncio.ensure_future(self._aattempt(attempt, track_latency, admit, admitted))}
+        try:
+            if deadline is not None:
+                # The clock starts once the first attempt is admitted: time spent queueing
+                # in the scheduler must not trigger hedges that double the shaped traffic
+                waiter = asyncio.ensure_future(admitted.wait())
+                await asyncio.wait(tasks | {waiter}, return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                done, _ = await asyncio.wait(tasks, timeout=deadline)
+                if not done:
+                    log.info("llm hedged request after %.2fs", deadline)
+                    tasks.add(asyncio.ensure_future(self._aattempt(attempt, track_latency, admit)))
+            error: Optional[BaseException] = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            assert error is not None
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+RESILIENCE = Resilience.from_env()
@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+History = List[Dict[str, str]]
+# chat_id -> history to store, or None to delete the session
+Changes = Dict[int, Optional[History]]
+
+
+# Minimal interface the handlers use instead of a raw chat_id -> history dict
+class SessionStore:
+    def get(self, chat_id: int) -> History:
+        raise NotImplementedError
+
+    def save(self, chat_id: int, history: History) -> None:
+        raise NotImplementedError
+
+    def reset(self, chat_id: int) -> None:
+        raise NotImplementedError
+
+    def save_many(self, changes: Changes) -> None:
+        for chat_id, history in changes.items():
+            if history is None:
+                self.reset(chat_id)
+            else:
+                self.save(chat_id, history)
+
+    async def aget(self, chat_id: int) -> History:
+        return self.get(chat_id)
+
+    def close(self) -> None:
+        pass
+
+    async def aclose(self) -> None:
+        self.close()
+
+
+class SqliteSessionStore(SessionStore):
+    def __init__(self, path: str) -> None:
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (chat_id INTEGER PRIMARY KEY, history TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, chat_id: int) -> History:
+        with self._lock:
+            row = self._conn.execute("SELECT history FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def save(self, chat_id: int, history: History) -> None:
+        data = json.dumps(history, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sessions (chat_id, history, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET history = excluded.history, updated = excluded.updated",
+                (chat_id, data, time.time()),
+            )
+            self._conn.commit()
+
+    def reset(self, chat_id: int) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+            self._conn.commit()
+
+    def save_many(self, changes: Changes) -> None:
+        # One transaction for a whole batch of saved and reset chats
+        now = time.time()
+        rows = [
+            (chat_id, json.dumps(history, ensure_ascii=False), now)
+            for chat_id, history in changes.items()
+            if history is not None
+        ]
+        deleted = [(chat_id,) for chat_id, history in changes.items() if history is None]
+        with self._lock:
+            self._conn.executemany("DELETE FROM sessions WHERE chat_id = ?", deleted)
+            self._conn.executemany(
+                "INSERT INTO sessions (chat_id, history, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET history = excluded.history, updated = excluded.updated",
+                rows,
+            )
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+# LRU of live sessions bounded by count, bytes and idle time, in front of an optional
+# persistent `backend`. Every save and reset is written through to the backend by one
+# background task (off the event loop, batched per flush), so a crash loses at most
+# the batch in flight; evicted sessions are reloaded lazily on the chat's next message,
+# so RAM stays flat however many chats the bot has seen.
+class MemorySessionStore(SessionStore):
+    @dataclass
+    class _Entry:
+        history: History
+        size: int
+        touched: float
+
+    def __init__(
+        self,
+        *,
+        max_sessions: int = 10_000,
+        max_bytes: int = 64 * 1024 * 1024,
+        idle_ttl: float = 3600.0,
+        backend: Optional[SessionStore] = None,
+    ) -> None:
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.backend = backend
+        self._entries: "OrderedDict[int, MemorySessionStore._Entry]" = OrderedDict()
+        self._bytes = 0
+        # Changes not yet in the backend, and the batch the writer is storing right now
+        self._dirty: Changes = {}
+        self._writing: Changes = {}
+        self._writer: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _size_of(history: History) -> int:
+        # Rough per-message overhead plus the encoded payload is enough for budgeting
+        return sum(64 + len(m.get("content", "").encode("utf-8")) for m in history)
+
+    @property
+    def bytes_used(self) -> int:
+        return self._bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, chat_id: int) -> History:
+        now = time.monotonic()
+        entry = self._entries.get(chat_id)
+        if entry is not None:
+            entry.touched = now
+            self._entries.move_to_end(chat_id)
+            return entry.history
+
+        history = self._unwritten(chat_id)
+        if history is None:
+            history = self.backend.get(chat_id) if self.backend is not None else []
+        self._put(chat_id, history, now)
+        return history
+
+    async def aget(self, chat_id: int) -> History:
+        # Same as get(), but a cold session is read from the backend in a worker thread
+        if chat_id in self._entries or self.backend is None or self._unwritten(chat_id) is not None:
+            return self.get(chat_id)
+        history = await asyncio.to_thread(self.backend.get, chat_id)
+        if chat_id in self._entries or self._unwritten(chat_id) is not None:
+            # Loaded or changed by someone else while we were reading
+            return self.get(chat_id)
+        self._put(chat_id, history, time.monotonic())
+        return history
+
+    def save(self, chat_id: int, history: History) -> None:
+        self._put(chat_id, history, time.monotonic())
+        self._write_through(chat_id, history)
+
+    def reset(self, chat_id: int) -> None:
+        entry = self._entries.pop(chat_id, None)
+        if entry is not None:
+            self._bytes -= entry.size
+        self._write_through(chat_id, None)
+
+    def close(self) -> None:
+        if self.backend is not None:
+            changes = {**self._writing, **self._dirty}
+            self._dirty = {}
+            if changes:
+                self.backend.save_many(changes)
+            self.backend.close()
+        self._entries.clear()
+        self._bytes = 0
+
+    async def aclose(self) -> None:
+        # Lets the writer store what is queued, then closes the backend off the loop
+        if self._writer is not None:
+            await asyncio.wait([self._writer])
+        if self.backend is not None:
+            await asyncio.to_thread(self.close)
+        else:
+            self.close()
+
+    def _unwritten(self, chat_id: int) -> Optional[History]:
+        # A change still on its way to the backend is newer than what the backend has
+        for changes in (self._dirty, self._writing):
+            if chat_id in changes:
+                history = changes[chat_id]
+                # A copy: the queued version must not change while the writer serializes it
+                return [] if history is None else list(history)
+        return None
+
+    def _write_through(self, chat_id: int, history: Optional[History]) -> None:
+        if self.backend is None:
+            return
+        # Handlers keep appending to the live list; the writer gets this version of it
+        self._dirty[chat_id] = None if history is None else list(history)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (scripts, shutdown): store it right away
+            self.backend.save_many(self._dirty)
+            self._dirty = {}
+            return
+        if self._writer is None or self._writer.done():
+            self._writer = loop.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        # Saves arriving while a batch is stored are coalesced into the next one
+        while self._dirty:
+            self._writing, self._dirty = self._dirty, {}
+            try:
+                await asyncio.to_thread(self.backend.save_many, self._writing)
+            except Exception as exc:  # noqa: BLE001
+                print(f"[sessions] write of {len(self._writing)} chats failed: {exc}")
+                # Newer changes win; the failed batch is retried with the next save or on close
+                self._dirty = {**self._writing, **self._dirty}
+                self._writing = {}
+                return
+            self._writing = {}
+
+    def _put(self, chat_id: int, history: History, now: float) -> None:
+        old = self._entries.pop(chat_id, None)
+        if old is not None:
+            self._bytes -= old.size
+        size = self._size_of(history)
+        self._entries[chat_id] = self._Entry(history=history, size=size, touched=now)
+        self._bytes += size
+        self._evict(now, keep=chat_id)
+
+    def _evict(self, now: float, *, keep: int) -> None:
+        # Entries are ordered by last access, so idle ones are always at the front
+        while self._entries:
+            chat_id, entry = next(iter(self._entries.items()))
+            if chat_id == keep:
+                break
+            over_budget = len(self._entries) > self.max_sessions or self._bytes > self.max_bytes
+            idle = now - entry.touched > self.idle_ttl
+            if not (over_budget or idle):
+                break
+            # Already written through (or queued) on save, so nothing to spill
+            self._entries.popitem(last=False)
+            self._bytes -= entry.size
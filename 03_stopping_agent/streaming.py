@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+# Telegram hard limit for one message
+MAX_MESSAGE_LEN = 4096
+
+
+class TelegramStreamer:
+    # Streams a reply into one Telegram message: the first chunk is sent as soon as
+    # it arrives, later chunks are coalesced into edits at most once per
+    # `min_interval` seconds (Telegram rejects faster edits of the same message).
+    # finish() applies the final formatting in one last edit.
+
+    def __init__(self, message: Message, *, min_interval: float = 1.0, min_delta_chars: int = 20) -> None:
+        self.message = message
+        self.min_interval = min_interval
+        self.min_delta_chars = min_delta_chars
+        self.sent: Optional[Message] = None
+        self._parts: list[str] = []
+        self._shown = ""
+        self._last_edit = 0.0
+        self._wakeup = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    async def push(self, delta: str) -> None:
+        if not delta:
+            return
+        self._parts.append(delta)
+        if self.sent is None:
+            if not self.text.strip():
+                return
+            self.sent = await self.message.answer(self._preview(), parse_mode=None)
+            self._shown = self.text
+            self._last_edit = time.monotonic()
+            self._flusher = asyncio.create_task(self._flush_loop())
+            return
+        self._wakeup.set()
+
+    async def finish(self, text: str, *, use_markdown: bool) -> None:
+        await self.close()
+        if len(text) > MAX_MESSAGE_LEN:
+            # Too long for one message: plain-text chunks, formatting can't span messages
+            chunks = [text[i : i + MAX_MESSAGE_LEN] for i in range(0, len(text), MAX_MESSAGE_LEN)]
+            await self._show(chunks[0], plain=True)
+            for chunk in chunks[1:]:
+                await self.message.answer(chunk, parse_mode=None)
+            return
+        try:
+            # Markdown replies use the bot's default parse mode (MarkdownV2), as message.answer did
+            await self._show(text, plain=not use_markdown)
+        except TelegramBadRequest:
+            if not use_markdown:
+                raise
+            # Model output that isn't valid MarkdownV2 still reaches the user
+            await self._show(text, plain=True)
+
+    async def _show(self, text: str, *, plain: bool) -> None:
+        kwargs = {"parse_mode": None} if plain else {}
+        if self.sent is None:
+            self.sent = await self.message.answer(text, **kwargs)
+            return
+        try:
+            await self.sent.edit_text(text, **kwargs)
+        except TelegramBadRequest as exc:
+            if "message is not modified" not in str(exc):
+                raise
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            wait = self.min_interval - (time.monotonic() - self._last_edit)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            text = self.text
+            if len(text) - len(self._shown) < self.min_delta_chars:
+                continue
+            try:
+                await self.sent.edit_text(self._preview(), parse_mode=None)
+                self._shown = text
+            except TelegramRetryAfter as exc:
+                await asyncio.sleep(exc.retry_after)
+                self._wakeup.set()
+            except TelegramBadRequest:
+                pass
+            self._last_edit = time.monotonic()
+
+    async def discard(self) -> None:
+        # Reply was superseded: remove the partial message instead of leaving it cut off
+        await self.close()
+        if self.sent is not None:
+            try:
+                await self.sent.delete()
+            except TelegramBadRequest:
+                pass
+            self.sent = None
+
+    async def close(self) -> None:
+        if self._flusher is None:
+            return
+        self._flusher.cancel()
+        try:
+            await self._flusher
+        except asyncio.CancelledError:
+            pass
+        self._flusher = None
+
+    def _preview(self) -> str:
+        text = self.text
+        if len(text) <= MAX_MESSAGE_LEN:
+            return text
+        return text[: MAX_MESSAGE_LEN - 1] + "…"
@@ -0,0 +1,461 @@
+from __future__ import annotations
+
+import asyncio
+import json
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+Path = Tuple[Union[str, int], ...]
+
+# Models whose API rejects response_format={"type": "json_object"}
+JSON_MODE_UNSUPPORTED = frozenset({"deepseek-reasoner"})
+
+REPAIR_PROMPT = (
+    "Ты исправляешь фрагмент JSON, чтобы он соответствовал схеме. "
+    "Сохрани все корректные значения, исправь только перечисленные ошибки, текстовые значения на русском. "
+    'Верни только JSON-объект вида {"value": <исправленный фрагмент>} без комментариев.'
+)
+
+
+@dataclass
+class SchemaError:
+    path: Path
+    message: str
+
+
+def format_path(path: Path) -> str:
+    out = ""
+    for part in path:
+        out += f"[{part}]" if isinstance(part, int) else (f".{part}" if out else str(part))
+    return out or "$"
+
+
+# --- Schema compilation -------------------------------------------------------
+# template.json describes types informally: "integer | null (comment)", ["string"],
+# nested objects. It is compiled once into a tree of closures; each closure checks
+# a value, applies the safe local fixes (numeric strings, missing nullable keys,
+# unknown keys) and records what only the model can fix.
+
+Validator = Callable[[Any, Path, List[SchemaError]], Any]
+
+_CHECKS: Dict[str, Callable[[Any], bool]] = {
+    "string": lambda v: isinstance(v, str),
+    "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    "boolean": lambda v: isinstance(v, bool),
+}
+
+
+def _coerce(value: Any, names: frozenset) -> Any:
+    if isinstance(value, float) and value.is_integer() and "integer" in names:
+        return int(value)
+    if isinstance(value, str) and names & {"integer", "number"}:
+        try:
+            number = float(value.strip().replace(",", "."))
+        except ValueError:
+            return value
+        return int(number) if "integer" in names and number.is_integer() else number
+    return value
+
+
+def _scalar(spec: str) -> Validator:
+    head = spec.split("(", 1)[0]
+    names = frozenset(t.strip() for t in head.split("|") if t.strip() in _CHECKS or t.strip() == "null")
+    names = names or frozenset({"string"})
+    checks = tuple(_CHECKS[n] for n in names if n in _CHECKS)
+    expected = " | ".join(sorted(names))
+
+    def validate(value: Any, path: Path, errors: List[SchemaError]) -> Any:
+        if value is None:
+            if "null" not in names:
+                errors.append(SchemaError(path, f"required, expected {expected}"))
+            return value
+        value = _coerce(value, names)
+        if not any(check(value) for check in checks):
+            errors.append(SchemaError(path, f"expected {expected}, got {type(value).__name__}"))
+        return value
+
+    validate.nullable = "null" in names  # type: ignore[attr-defined]
+    return validate
+
+
+def _array(item_spec: Any) -> Validator:
+    item = _compile(item_spec) if item_spec is not None else None
+
+    def validate(value: Any, path: Path, errors: List[SchemaError]) -> Any:
+        if value is None:
+            return []
+        if not isinstance(value, list):
+            errors.append(SchemaError(path, "expected array"))
+            return value
+        if item is not None:
+            value = [item(v, path + (i,), errors) for i, v in enumerate(value)]
+        return value
+
+    validate.default = list  # type: ignore[attr-defined]
+    return validate
+
+
+def _object(spec: Dict[str, Any]) -> Validator:
+    fields = {key: _compile(sub) for key, sub in spec.items()}
+
+    def validate(value: Any, path: Path, errors: List[SchemaError]) -> Any:
+        if not isinstance(value, dict):
+            errors.append(SchemaError(path, "expected object"))
+            return value
+        out = {}
+        for key, field in fields.items():
+            if key in value:
+                out[key] = field(value[key], path + (key,), errors)
+            elif hasattr(field, "default"):
+                out[key] = field.default()
+            elif getattr(field, "nullable", False):
+                out[key] = None
+            else:
+                errors.append(SchemaError(path + (key,), "missing"))
+                out[key] = None
+        # Keys outside the schema are dropped rather than sent back for repair
+        return out
+
+    if all(hasattr(f, "default") or getattr(f, "nullable", False) for f in fields.values()):
+        # A missing object whose fields may all be empty (macros_ratio) is filled locally too
+        validate.default = lambda: {  # type: ignore[attr-defined]
+            key: field.default() if hasattr(field, "default") else None for key, field in fields.items()
+        }
+    return validate
+
+
+def _compile(spec: Any) -> Validator:
+    if isinstance(spec, dict):
+        return _object(spec)
+    if isinstance(spec, list):
+        return _array(spec[0] if spec else None)
+    return _scalar(str(spec))
+
+
+class CompiledSchema:
+    def __init__(self, spec: Dict[str, Any]) -> None:
+        self.spec = spec
+        self._root = _compile(spec)
+        self._units: Dict[Path, Validator] = {}
+
+    def validate(self, value: Any, path: Path = ()) -> Tuple[Any, List[SchemaError]]:
+        errors: List[SchemaError] = []
+        validator = self._root if not path else self._unit_validator(path)
+        return validator(value, path, errors), errors
+
+    def spec_at(self, path: Path) -> Any:
+        spec: Any = self.spec
+        for part in path:
+            spec = spec[0] if isinstance(part, int) else spec[part]
+        return spec
+
+    def _unit_validator(self, path: Path) -> Validator:
+        # Elements of one array share a validator: key it by the path without indexes
+        shape = tuple(0 if isinstance(p, int) else p for p in path)
+        validator = self._units.get(shape)
+        if validator is None:
+            validator = self._units[shape] = _compile(self.spec_at(shape))
+        return validator
+
+
+@lru_cache(maxsize=8)
+def _compile_cached(spec_json: str) -> CompiledSchema:
+    return CompiledSchema(json.loads(spec_json))
+
+
+def compile_template(template: Optional[dict]) -> Optional[CompiledSchema]:
+    # The first "*_schema" entry of template.json (bio_schema, menu_schema), compiled once per content
+    if not template:
+        return None
+    fmt = str(template.get("desired_format") or "json").lower()
+    if "json" not in fmt:
+        return None
+    for key, spec in template.items():
+        if key.endswith("_schema") and isinstance(spec, dict):
+            return _compile_cached(json.dumps(spec, ensure_ascii=False))
+    return None
+
+
+def unit_of(path: Path) -> Path:
+    # Repair granularity: a top-level field, or a single element of a top-level array
+    # (one day of a 30-day menu), never the whole document
+    if len(path) >= 2 and isinstance(path[1], int):
+        return path[:2]
+    return path[:1]
+
+
+def get_at(value: Any, path: Path) -> Any:
+    for part in path:
+        value = value[part]
+    return value
+
+
+def set_at(value: Any, path: Path, new: Any) -> None:
+    get_at(value, path[:-1])[path[-1]] = new
+
+
+# --- Incremental parsing ------------------------------------------------------
+
+
+class IncrementalJSON:
+    # One pass over a streamed top-level JSON object (optionally inside a ``` fence).
+    # feed() returns top-level members and elements of top-level arrays as soon as
+    # they close, so they can be validated while the rest is still generating.
+
+    def __init__(self) -> None:
+        self._parts: List[str] = []
+        self._size = 0
+        self.started = False
+        self.rejected = False
+        self.done = False
+        self._fenced = False
+        self._start = self._end = -1
+        self._depth = 0
+        self._in_string = self._escape = False
+        self._key: Optional[str] = None
+        self._key_start = self._value_start = self._elem_start = -1
+        self._in_array = False
+        self._index = 0
+
+    @property
+    def text(self) -> str:
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    @property
+    def current_key(self) -> Optional[str]:
+        # Top-level key whose value is being streamed right now
+        return self._key if self._value_start >= 0 else None
+
+    def _load(self, start: int, end: int) -> Any:
+        raw = self.text[start:end].strip()
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return _Broken(raw)
+
+    def value(self) -> Any:
+        if not self.done:
+            return None
+        loaded = self._load(self._start, self._end + 1)
+        return None if isinstance(loaded, _Broken) else loaded
+
+    def feed(self, delta: str) -> List[Tuple[Path, Any]]:
+        base = self._size
+        self._parts.append(delta)
+        self._size += len(delta)
+        out: List[Tuple[Path, Any]] = []
+        if self.rejected or self.done:
+            return out
+        for offset, ch in enumerate(delta):
+            pos = base + offset
+            if not self.started:
+                if ch == "{":
+                    self.started, self._depth, self._start = True, 1, pos
+                elif ch == "`":
+                    self._fenced = True
+                elif not (ch.isspace() or self._fenced):
+                    # Plain-text answer (refusal, clarifying question)
+                    self.rejected = True
+                    return out
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._key is None and self._key_start >= 0:
+                        self._key = str(self._load(self._key_start, pos + 1))
+                continue
+            if ch.isspace():
+                continue
+            if self._depth == 1:
+                if ch == ":":
+                    continue
+                if ch in ",}":
+                    if self._key is not None and self._value_start >= 0 and not self._in_array:
+                        out.append(((self._key,), self._load(self._value_start, pos)))
+                    self._key, self._key_start, self._value_start, self._in_array = None, -1, -1, False
+                    if ch == "}":
+                        self.done, self._end = True, pos
+                        break
+                    continue
+                if self._key is None:
+                    if ch == '"':
+                        self._in_string, self._key_start = True, pos
+                    continue
+                if self._value_start < 0:
+                    self._value_start = pos
+                if ch == '"':
+                    self._in_string = True
+                elif ch == "[":
+                    self._depth, self._in_array, self._index, self._elem_start = 2, True, 0, -1
+                elif ch == "{":
+                    self._depth = 2
+                continue
+            if self._in_array and self._depth == 2 and ch in ",]":
+                if self._elem_start >= 0:
+                    out.append(((self._key, self._index), self._load(self._elem_start, pos)))
+                    self._index += 1
+                    self._elem_start = -1
+                if ch == "]":
+                    self._depth = 1
+                continue
+            if self._in_array and self._depth == 2 and self._elem_start < 0:
+                self._elem_start = pos
+            if ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+        return out
+
+
+class _Broken(str):
+    # Raw text of a member that is not valid JSON on its own
+    pass
+
+
+class StructuredOutput:
+    # Streams text through IncrementalJSON and validates each closed unit right away.
+    # With an async repair function, a broken unit gets its repair call while the
+    # rest of the answer is still streaming; result()/aresult() validate the whole
+    # document, repair the remaining broken units and splice the fixes in.
+
+    def __init__(
+        self,
+        schema: CompiledSchema,
+        *,
+        arepair: Optional[Callable[[List[Dict[str, str]]], Awaitable[str]]] = None,
+    ) -> None:
+        self.schema = schema
+        self.parser = IncrementalJSON()
+        self._arepair = arepair
+        # Top-level members seen so far: context for early repairs
+        self._partial: Dict[str, Any] = {}
+        self._repairs: Dict[Path, asyncio.Task] = {}
+
+    @property
+    def is_json(self) -> bool:
+        return self.parser.started
+
+    @property
+    def value(self) -> Any:
+        return self.parser.value()
+
+    @property
+    def members(self) -> Dict[str, Any]:
+        return self._partial
+
+    def feed(self, delta: str) -> None:
+        for path, value in self.parser.feed(delta):
+            if isinstance(value, _Broken):
+                # Syntax errors are not repaired piecemeal: the whole answer falls back to raw text
+                continue
+            if path[0] not in self.schema.spec:
+                # Unknown key, dropped by validation anyway
+                continue
+            if len(path) == 1:
+                self._partial[path[0]] = value
+            if self._arepair is None:
+                continue
+            fixed, errors = self.schema.validate(value, path)
+            if errors and path not in self._repairs:
+                messages = repair_messages(self.schema, path, fixed, self._partial, errors)
+                self._repairs[path] = asyncio.ensure_future(self._arepair(messages))
+
+    def _broken_units(self) -> Optional[Tuple[Any, Dict[Path, List[SchemaError]]]]:
+        value = self.parser.value()
+        if not isinstance(value, dict):
+            return None
+        document, errors = self.schema.validate(value)
+        units: Dict[Path, List[SchemaError]] = {}
+        for error in errors:
+            units.setdefault(unit_of(error.path), []).append(error)
+        return document, units
+
+    def _apply(self, document: Any, unit: Path, text: str) -> None:
+        ok, fixed = parse_repair(self.schema, unit, text)
+        if ok:
+            set_at(document, unit, fixed)
+
+    def result(self, repair: Callable[[List[Dict[str, str]]], str]) -> Any:
+        # Validated document with broken units repaired, or None if the answer is not a JSON object
+        found = self._broken_units()
+        if found is None:
+            return None
+        document, units = found
+        for unit, errors in units.items():
+            self._apply(document, unit, repair(repair_messages(self.schema, unit, get_at(document, unit), document, errors)))
+        return document
+
+    async def aresult(self) -> Any:
+        assert self._arepair is not None
+        try:
+            found = self._broken_units()
+            if found is None:
+                return None
+            document, units = found
+            for unit, errors in units.items():
+                if unit not in self._repairs:
+                    messages = repair_messages(self.schema, unit, get_at(document, unit), document, errors)
+                    self._repairs[unit] = asyncio.ensure_future(self._arepair(messages))
+            pending = [unit for unit in units]
+            texts = await asyncio.gather(*(self._repairs[unit] for unit in pending), return_exceptions=True)
+            for unit, text in zip(pending, texts):
+                if isinstance(text, str):
+                    self._apply(document, unit, text)
+            return document
+        finally:
+            self.cancel()
+
+    def cancel(self) -> None:
+        # Early repairs of units that turned out fine after local fixes (or an abandoned reply)
+        for task in self._repairs.values():
+            task.cancel()
+
+
+def repair_messages(
+    schema: CompiledSchema, unit: Path, current: Any, document: Dict[str, Any], errors: List[SchemaError]
+) -> List[Dict[str, str]]:
+    # Small top-level fields (title, target, restrictions) give the model enough context
+    context = {
+        key: value
+        for key, value in document.items()
+        if key != unit[0] and len(json.dumps(value, ensure_ascii=False)) <= 300
+    }
+    issues = "\n".join(f"- {format_path(e.path)}: {e.message}" for e in errors)
+    return [
+        {"role": "system", "content": REPAIR_PROMPT},
+        {
+            "role": "user",
+            "content": (
+                f"Путь фрагмента: {format_path(unit)}\n"
+                f"Схема фрагмента: {json.dumps(schema.spec_at(unit), ensure_ascii=False)}\n"
+                f"Контекст документа: {json.dumps(context, ensure_ascii=False)}\n"
+                f"Текущее значение: {json.dumps(current, ensure_ascii=False)}\n"
+                f"Ошибки:\n{issues}"
+            ),
+        },
+    ]
+
+
+def parse_repair(schema: CompiledSchema, unit: Path, text: str) -> Tuple[bool, Any]:
+    # (ok, fixed value); a repair that still fails validation is not applied
+    parser = IncrementalJSON()
+    parser.feed(text)
+    value = parser.value()
+    if not isinstance(value, dict) or "value" not in value:
+        return False, None
+    fixed, errors = schema.validate(value["value"], unit)
+    return not errors, fixed
+
+
+def render(document: Any) -> str:
+    return "```json\n" + json.dumps(document, ensure_ascii=False, indent=2) + "\n```"
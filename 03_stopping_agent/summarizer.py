@@ -1,15 +1,46 @@
 from __future__ import annotations
 
 import json
-from dataclasses import dataclass
+import os
+from dataclasses import dataclass, field
 from typing import Iterable
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from base_agent import BaseAgent, UsageInfo
+from humanizer import compile_renderer
+from prompts import SystemPrompt
+from scheduler import PRIORITY_BACKGROUND
+from structured import IncrementalJSON
 
 
+# Static prompts are module constants so every request sends a byte-identical prefix
+HISTORY_SUMMARY_PROMPT = (
+    "Ты — ассистент, который кратко конспектирует диалог между тренером и пользователем. "
+    "Сделай лаконичное резюме в 3-7 пунктов: цель, ограничения/аллергии, предпочтения, ориентиры по калориям/макросам, бюджет/время/оборудование."
+)
+
+# Only for the opt-in LLM fallback; menus are normally rendered by humanizer.py
+MENU_HUMANIZE_PROMPT = (
+    "Ты — ассистент, который превращает JSON-меню в краткий человекочитаемый план. "
+    "Сводка: цель, длительность, приёмы пищи/день, калорийность/макросы (если есть), основные блюда по дням, список покупок (кратко)."
+)
+
 class SummarizerAgent(BaseAgent):
-    def __init__(self, client: OpenAI, model: str = "deepseek-chat", temperature: float = 0.2) -> None:
-        super().__init__(client, model, temperature)
+    # Summaries run in the background and yield to interactive replies
+    priority = PRIORITY_BACKGROUND
+
+    def __init__(
+        self,
+        client: OpenAI | None = None,
+        model: str = "deepseek-chat",
+        temperature: float = 0.2,
+        *,
+        async_client: AsyncOpenAI | None = None,
+        llm_humanize: bool = False,
+    ) -> None:
+        super().__init__(client, model, temperature, async_client=async_client)
+        # Menus that the schema renderer cannot handle go to the LLM only if this is set
+        self.llm_humanize = llm_humanize
+        self._menu_prompt = SystemPrompt(MENU_HUMANIZE_PROMPT, os.path.join(os.path.dirname(__file__), "template.json"))
 
     @dataclass
     class Summary:
@@ -19,14 +50,13 @@ class SummarizerAgent(BaseAgent):
         prompt_tokens: int
         completion_tokens: int
         max_tokens: int
+        # Telegram-sized messages of the text (one page unless a rendered menu is long)
+        pages: list[str] = field(default_factory=list)
 
-    def summarize_history(self, history: Iterable[dict[str, str]], *, max_tokens: int = 4096) -> "SummarizerAgent.Summary":
-        system = (
-            "Ты — ассистент, который кратко конспектирует диалог между тренером и пользователем. "
-            "Сделай лаконичное резюме в 3-7 пунктов: цель, ограничения/аллергии, предпочтения, ориентиры по калориям/макросам, бюджет/время/оборудование."
-        )
-        messages = [{"role": "system", "content": system}] + list(history)
-        content, usage = self.chat_completion(messages, max_tokens=max_tokens)
+    def _history_messages(self, history: Iterable[dict[str, str]]) -> list[dict[str, str]]:
+        return [{"role": "system", "content": HISTORY_SUMMARY_PROMPT}] + list(history)
+
+    def _summary(self, content: str, usage: UsageInfo) -> "SummarizerAgent.Summary":
         return self.Summary(
             text=content,
             model=usage.model,
@@ -34,25 +64,76 @@ class SummarizerAgent(BaseAgent):
             prompt_tokens=usage.prompt_tokens,
             completion_tokens=usage.completion_tokens,
             max_tokens=usage.max_tokens,
+            pages=[content],
         )
 
-    def humanize_json_menu(self, json_text: str, *, max_tokens: int = 4096) -> "SummarizerAgent.Summary":
-        system = (
-            "Ты — ассистент, который превращает JSON-меню в краткий человекочитаемый план. "
-            "Сводка: цель, длительность, приёмы пищи/день, калорийность/макросы (если есть), основные блюда по дням, список покупок (кратко)."
-        )
-        messages = [
-            {"role": "system", "content": system},
+    def summarize_history(self, history: Iterable[dict[str, str]], *, max_tokens: int = 4096) -> "SummarizerAgent.Summary":
+        content, usage = self.chat_completion(self._history_messages(history), max_tokens=max_tokens)
+        return self._summary(content, usage)
+
+    async def asummarize_history(self, history: Iterable[dict[str, str]], *, max_tokens: int = 4096) -> "SummarizerAgent.Summary":
+        content, usage = await self.achat_completion(self._history_messages(history), max_tokens=max_tokens)
+        return self._summary(content, usage)
+
+    def _menu_messages(self, json_text: str) -> list[dict[str, str]]:
+        return [
+            {"role": "system", "content": MENU_HUMANIZE_PROMPT},
             {"role": "user", "content": f"JSON-меню:\n```json\n{json_text}\n```"},
         ]
-        content, usage = self.chat_completion(messages, max_tokens=max_tokens)
+
+    def _render_menu(self, document: dict) -> "SummarizerAgent.Summary | None":
+        renderer = compile_renderer(self._menu_prompt.template)
+        if renderer is None:
+            return None
+        pages = renderer.pages(document)
         return self.Summary(
-            text=content,
-            model=usage.model,
-            total_tokens=usage.total_tokens,
-            prompt_tokens=usage.prompt_tokens,
-            completion_tokens=usage.completion_tokens,
-            max_tokens=usage.max_tokens,
+            text="\n\n".join(pages),
+            model="local",
+            total_tokens=0,
+            prompt_tokens=0,
+            completion_tokens=0,
+            max_tokens=0,
+            pages=pages,
         )
 
+    def _raw_menu(self, json_text: str) -> "SummarizerAgent.Summary":
+        return self.Summary(
+            text=json_text, model="local", total_tokens=0, prompt_tokens=0, completion_tokens=0, max_tokens=0, pages=[json_text]
+        )
+
+    @staticmethod
+    def _parse_menu(json_text: str) -> dict | None:
+        parser = IncrementalJSON()
+        parser.feed(json_text.strip())
+        document = parser.value()
+        return document if isinstance(document, dict) else None
+
+    def humanize_json_menu(self, json_text: str, *, max_tokens: int = 4096) -> "SummarizerAgent.Summary":
+        # Rendered from menu_schema without a network call; the LLM is only an opt-in fallback
+        document = self._parse_menu(json_text)
+        summary = self._render_menu(document) if document is not None else None
+        if summary is not None:
+            return summary
+        if not self.llm_humanize:
+            return self._raw_menu(json_text)
+        content, usage = self.chat_completion(self._menu_messages(json_text), max_tokens=max_tokens)
+        return self._summary(content, usage)
+
+    async def ahumanize_json_menu(self, json_text: str, *, max_tokens: int = 4096) -> "SummarizerAgent.Summary":
+        document = self._parse_menu(json_text)
+        summary = self._render_menu(document) if document is not None else None
+        if summary is not None:
+            return summary
+        if not self.llm_humanize:
+            return self._raw_menu(json_text)
+        content, usage = await self.achat_completion(self._menu_messages(json_text), max_tokens=max_tokens)
+        return self._summary(content, usage)
 
+    async def ahumanize_menu(self, document: dict, *, max_tokens: int = 4096) -> "SummarizerAgent.Summary | None":
+        # Final menu of a reply as plain-text pages; None keeps the JSON reply as it is
+        summary = self._render_menu(document)
+        if summary is not None or not self.llm_humanize:
+            return summary
+        json_text = json.dumps(document, ensure_ascii=False, indent=2)
+        content, usage = await self.achat_completion(self._menu_messages(json_text), max_tokens=max_tokens)
+        return self._summary(content, usage)
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+try:
+    import tiktoken
+except ImportError:  # optional: without it counts fall back to the chars/3 estimate
+    tiktoken = None
+
+Messages = List[Dict[str, Any]]
+
+# Chat framing per message (role, separators) and the primer of the reply
+MESSAGE_OVERHEAD = 4
+REPLY_PRIMER = 3
+
+CONTEXT_WINDOWS = {"deepseek-chat": 65536, "deepseek-reasoner": 65536}
+MAX_OUTPUT_TOKENS = {"deepseek-chat": 8192, "deepseek-reasoner": 32768}
+DEFAULT_CONTEXT_WINDOW = 65536
+DEFAULT_MAX_OUTPUT = 8192
+
+
+class PromptTooLargeError(RuntimeError):
+    def __init__(self, prompt_tokens: int, limit: int) -> None:
+        super().__init__(f"prompt is {prompt_tokens} tokens, the context window leaves room for {limit}")
+        self.prompt_tokens = prompt_tokens
+        self.limit = limit
+
+
+def _estimate(text: str) -> int:
+    # Same heuristic as before: ~3 chars per token for mixed Russian/English text
+    return len(text) // 3
+
+
+def _load_encoder(name: str) -> Optional[Callable[[str], int]]:
+    if tiktoken is None or not name:
+        return None
+    try:
+        encoding = tiktoken.get_encoding(name)
+    except Exception as exc:  # noqa: BLE001
+        # The BPE file is fetched once and cached (TIKTOKEN_CACHE_DIR); offline without a cache we estimate
+        print(f"[tokens] tokenizer {name!r} unavailable, estimating by length: {exc}")
+        return None
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+class TokenCounter:
+    # Prompt sizes before the request goes out. Counts are cached per message
+    # content (history messages are recounted on every turn otherwise) and per
+    # session as a running total that only counts newly appended messages.
+    # The tokenizer is only an approximation of the provider's, so budgets keep
+    # a safety margin.
+
+    def __init__(
+        self,
+        encoding: str = "o200k_base",
+        *,
+        max_cached: int = 10_000,
+        margin: float = 0.05,
+        context_window: Optional[int] = None,
+        max_output: Optional[int] = None,
+    ) -> None:
+        self.encoding = encoding
+        self.max_cached = max_cached
+        self.margin = margin
+        self.context_window_override = context_window
+        self.max_output_override = max_output
+        self._encoder: Optional[Callable[[str], int]] = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, int]" = OrderedDict()
+        # chat -> (messages counted, last counted message, running total)
+        self._sessions: Dict[Hashable, Tuple[int, Any, int]] = {}
+
+    @classmethod
+    def from_env(cls) -> "TokenCounter":
+        window = int(os.getenv("LLM_CONTEXT_WINDOW", "0"))
+        output = int(os.getenv("LLM_MAX_OUTPUT_TOKENS", "0"))
+        return cls(
+            os.getenv("LLM_TOKENIZER", "o200k_base"),
+            context_window=window or None,
+            max_output=output or None,
+        )
+
+    def _encode_len(self, text: str) -> int:
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._encoder = _load_encoder(self.encoding)
+                    self._loaded = True
+        return self._encoder(text) if self._encoder is not None else _estimate(text)
+
+    def count_text(self, text: str) -> int:
+        if not text:
+            return 0
+        with self._lock:
+            count = self._cache.get(text)
+            if count is not None:
+                self._cache.move_to_end(text)
+                return count
+        count = self._encode_len(text)
+        with self._lock:
+            self._cache[text] = count
+            if len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+        return count
+
+    def count_message(self, message: Dict[str, Any]) -> int:
+        return MESSAGE_OVERHEAD + self.count_text(str(message.get("content") or ""))
+
+    def count_messages(self, messages: Messages) -> int:
+        return REPLY_PRIMER + sum(self.count_message(m) for m in messages)
+
+    def count_session(self, chat_id: Hashable, history: Messages) -> int:
+        # Appends are counted incrementally; anything else (compaction, reset) recounts
+        counted, last, total = self._sessions.get(chat_id, (0, None, 0))
+        if counted and (len(history) < counted or history[counted - 1] is not last):
+            counted, total = 0, 0
+        total += sum(self.count_message(m) for m in history[counted:])
+        self._sessions[chat_id] = (len(history), history[-1] if history else None, total)
+        return REPLY_PRIMER + total
+
+    def forget(self, chat_id: Hashable) -> None:
+        self._sessions.pop(chat_id, None)
+
+    def context_window(self, model: str) -> int:
+        return self.context_window_override or CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+
+    def max_output(self, model: str) -> int:
+        return self.max_output_override or MAX_OUTPUT_TOKENS.get(model, DEFAULT_MAX_OUTPUT)
+
+    def prompt_limit(self, model: str, *, reserve: int = 256) -> int:
+        # Largest prompt that still leaves `reserve` tokens for the answer
+        return int(self.context_window(model) * (1 - self.margin)) - reserve
+
+    def fit_max_tokens(
+        self, model: str, messages: Messages, requested: Optional[int] = None, *, min_tokens: int = 256
+    ) -> int:
+        # max_tokens sized to what is left of the context window; raises before any network call
+        prompt = self.count_messages(messages)
+        room = int(self.context_window(model) * (1 - self.margin)) - prompt
+        if room < min_tokens:
+            raise PromptTooLargeError(prompt, self.prompt_limit(model, reserve=min_tokens))
+        return min(room, requested or self.max_output(model))
+
+
+COUNTER = TokenCounter.from_env()
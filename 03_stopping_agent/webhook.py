@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import hashlib
+import json
+import multiprocessing
+import os
+import socket
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import urlparse
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector, web
+
+from llm_metrics import serve_metrics
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Workers only listen on 127.0.0.1; the front process is the one Telegram talks to
+WORKER_HOST = "127.0.0.1"
+WORKER_PATH = "/update"
+
+# Both factories are top-level functions of the bot's main.py: spawned workers import
+# the module afresh, so every worker has its own SESSIONS, LLM clients and caches
+BotFactory = Callable[[], Bot]
+DispatcherFactory = Callable[[], Dispatcher]
+
+
+@dataclass
+class WebhookSettings:
+    # Public HTTPS URL registered with setWebhook; its path is served locally
+    url: str
+    host: str = "0.0.0.0"
+    port: int = 8080
+    secret: Optional[str] = None
+    # workers > 1: a front process shards updates by chat_id over this many bot processes,
+    # listening on WORKER_HOST:worker_port + i
+    workers: int = 1
+    worker_port: int = 8100
+
+    @property
+    def path(self) -> str:
+        return urlparse(self.url).path or "/"
+
+    @classmethod
+    def from_env(cls) -> Optional["WebhookSettings"]:
+        url = os.getenv("WEBHOOK_URL")
+        if not url:
+            return None
+        return cls(
+            url=url,
+            host=os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+            port=int(os.getenv("WEBHOOK_PORT", "8080")),
+            secret=os.getenv("WEBHOOK_SECRET") or None,
+            workers=int(os.getenv("WEBHOOK_WORKERS", "1")),
+            worker_port=int(os.getenv("WEBHOOK_WORKER_PORT", "8100")),
+        )
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    # Consistent hashing of chat ids onto workers: a chat always lands on the same
+    # process (its session stays there), and changing the worker count only moves
+    # ~1/N of the chats instead of reshuffling all of them
+
+    def __init__(self, nodes: int, *, replicas: int = 64) -> None:
+        points = sorted((_hash(f"{node}:{replica}"), node) for node in range(nodes) for replica in range(replicas))
+        self._points = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key: int) -> int:
+        index = bisect.bisect(self._points, _hash(str(key)))
+        return self._nodes[index % len(self._nodes)]
+
+
+_CHAT_UPDATES = (
+    "message",
+    "edited_message",
+    "channel_post",
+    "edited_channel_post",
+    "business_message",
+    "edited_business_message",
+    "my_chat_member",
+    "chat_member",
+    "chat_join_request",
+    "message_reaction",
+    "message_reaction_count",
+    "chat_boost",
+    "removed_chat_boost",
+)
+
+
+def chat_id_of(update: Dict[str, Any]) -> int:
+    # Routing key of a raw update: its chat, else the user (inline queries, polls), else 0
+    for kind in _CHAT_UPDATES:
+        body = update.get(kind)
+        if isinstance(body, dict) and isinstance(body.get("chat"), dict):
+            return int(body["chat"]["id"])
+    query = update.get("callback_query")
+    if isinstance(query, dict) and isinstance(query.get("message"), dict):
+        return int(query["message"]["chat"]["id"])
+    for body in update.values():
+        if isinstance(body, dict) and isinstance(body.get("from"), dict):
+            return int(body["from"]["id"])
+    return 0
+
+
+def _serve_metrics(index: int) -> None:
+    # One /metrics endpoint per process: METRICS_PORT + worker index
+    if os.getenv("METRICS_PORT"):
+        serve_metrics(int(os.environ["METRICS_PORT"]) + index)
+
+
+def _bot_app(bot: Bot, dp: Dispatcher, path: str, secret: Optional[str]) -> web.Application:
+    app = web.Application()
+    SimpleRequestHandler(dp, bot, secret_token=secret).register(app, path=path)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+def _run_worker(index: int, settings: WebhookSettings, build_bot: BotFactory, build_dispatcher: DispatcherFactory) -> None:
+    _serve_metrics(index)
+    app = _bot_app(build_bot(), build_dispatcher(), WORKER_PATH, None)
+    web.run_app(app, host=WORKER_HOST, port=settings.worker_port + index, print=None)
+
+
+async def _wait_for_port(port: int, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((WORKER_HOST, port), timeout=0.2):
+                return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"webhook worker on port {port} did not start")
+
+
+def _front_app(settings: WebhookSettings, build_bot: BotFactory, build_dispatcher: DispatcherFactory) -> web.Application:
+    ring = HashRing(settings.workers)
+    context = multiprocessing.get_context("spawn")
+    workers: List[Any] = [None] * settings.workers
+    session: Optional[ClientSession] = None
+    supervisor: Optional[asyncio.Task] = None
+
+    def start_worker(index: int) -> None:
+        workers[index] = context.Process(
+            target=_run_worker, args=(index, settings, build_bot, build_dispatcher), daemon=True
+        )
+        workers[index].start()
+
+    async def supervise() -> None:
+        # A crashed worker is restarted on the same port, so its chats come back to it
+        while True:
+            await asyncio.sleep(1.0)
+            for index, proc in enumerate(workers):
+                if not proc.is_alive():
+                    print(f"[webhook] worker {index} exited with {proc.exitcode}, restarting")
+                    start_worker(index)
+
+    async def forward(request: web.Request) -> web.StreamResponse:
+        if settings.secret and request.headers.get(SECRET_HEADER) != settings.secret:
+            return web.Response(status=401)
+        body = await request.read()
+        worker = ring.node_for(chat_id_of(json.loads(body)))
+        url = f"http://{WORKER_HOST}:{settings.worker_port + worker}{WORKER_PATH}"
+        try:
+            async with session.post(url, data=body, headers={"Content-Type": "application/json"}) as resp:
+                return web.Response(body=await resp.read(), status=resp.status, content_type=resp.content_type)
+        except ClientError:
+            # Worker down or restarting: Telegram redelivers the update later
+            return web.Response(status=503)
+
+    async def on_startup(app: web.Application) -> None:
+        nonlocal session, supervisor
+        for index in range(settings.workers):
+            start_worker(index)
+        await asyncio.gather(*(_wait_for_port(settings.worker_port + index) for index in range(settings.workers)))
+        session = ClientSession(connector=TCPConnector(limit=0), timeout=ClientTimeout(total=60))
+        supervisor = asyncio.create_task(supervise())
+        bot = build_bot()
+        try:
+            await bot.set_webhook(settings.url, secret_token=settings.secret)
+        finally:
+            await bot.session.close()
+
+    async def on_cleanup(app: web.Application) -> None:
+        if supervisor is not None:
+            supervisor.cancel()
+        if session is not None:
+            await session.close()
+        for proc in workers:
+            if proc is not None:
+                proc.terminate()
+        for proc in workers:
+            if proc is not None:
+                proc.join(timeout=10)
+
+    app = web.Application()
+    app.router.add_post(settings.path, forward)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def run_webhook(build_bot: BotFactory, build_dispatcher: DispatcherFactory, settings: WebhookSettings) -> None:
+    # Blocking entry point of webhook mode (instead of dp.start_polling)
+    if settings.workers <= 1:
+        bot = build_bot()
+        app = _bot_app(bot, build_dispatcher(), settings.path, settings.secret)
+
+        async def register(app: web.Application) -> None:
+            await bot.set_webhook(settings.url, secret_token=settings.secret)
+
+        app.on_startup.append(register)
+        _serve_metrics(0)
+    else:
+        app = _front_app(settings, build_bot, build_dispatcher)
+    web.run_app(app, host=settings.host, port=settings.port, print=None)
@@ -2,23 +2,32 @@ from __future__ import annotations
 
 from dataclasses import dataclass
 from typing import List, Dict
-from base_agent import BaseAgent
+from base_agent import BaseAgent, UsageInfo
+
+
+GENERATOR_PROMPT = (
+    "Ты — помощник, который пишет сообщения коммитов. Формат строгий и один‑строчный: "
+    "Политика: 1 сообщение — 1 уточняющий вопрос. Когда данных достаточно — верни ТОЛЬКО commit message без пояснений."
+)
 
 
 @dataclass
 class AgentResult:
     content: str
     is_final: bool = False
+    usage: UsageInfo | None = None
 
 
 class CommitGeneratorAgent(BaseAgent):
+    def _messages(self, history: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        return [{"role": "system", "content": GENERATOR_PROMPT}] + history
+
     def step(self, history: List[Dict[str, str]]) -> AgentResult:
-        system = (
-            "Ты — помощник, который пишет сообщения коммитов. Формат строгий и один‑строчный: "
-            "Политика: 1 сообщение — 1 уточняющий вопрос. Когда данных достаточно — верни ТОЛЬКО commit message без пояснений."
-        )
-        messages = [{"role": "system", "content": system}] + history
-        content = self.chat(messages)
-        return AgentResult(content=content, is_final=False)
+        content, usage = self.chat_completion(self._messages(history))
+        return AgentResult(content=content, is_final=False, usage=usage)
+
+    async def astep(self, history: List[Dict[str, str]]) -> AgentResult:
+        content, usage = await self.achat_completion(self._messages(history))
+        return AgentResult(content=content, is_final=False, usage=usage)
 
 
@@ -1,36 +1,59 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from base_agent import BaseAgent
+from base_agent import BaseAgent, UsageInfo
+from commit_rules import RuleReport, check_commit_message, format_feedback
+
+
+# Mechanical rules 1-5 are checked locally (commit_rules.py); the LLM only judges the tag semantics
+SEMANTIC_VALIDATOR_PROMPT = (
+    "Ты — строгий валидатор сообщений коммитов. Формат сообщения уже проверен, проверь ТОЛЬКО семантику тега:\n"
+    "[Project] = новая фича, [Bugfix] = исправление бага, [Structure] = рефакторинг. "
+    "Если семантика явно противоречит тегу по формулировке субъекта — считай это нарушением; иначе верни OK_AGENT1.\n\n"
+    "ФОРМАТ ВЫВОДА (строго один из):\n"
+    "- OK_AGENT1\n"
+    "- Issues:\n- <короткое нарушение>\n\nProposed:\n<однострочное исправленное сообщение с верным тегом>\n"
+    "Не добавляй никакие дополнительные комментарии, кавычки или код‑блоки."
+)
 
 
 @dataclass
 class AgentResult:
     content: str
     is_final: bool = False
+    usage: UsageInfo | None = None
+    # Set when the local rule engine answered; proposed is a locally auto-fixed message
+    rules: RuleReport | None = None
+    proposed: str | None = None
 
 
 class CommitValidatorAgent(BaseAgent):
-    def validate(self, commit_message: str) -> AgentResult:
-        system = (
-            "Ты — строгий валидатор сообщений коммитов. Валидируй ТОЧНО по правилам:\n"
-            "1) Сообщение ДОЛЖНО начинаться с одного из тегов: [Project] | [Bugfix] | [Structure] и пробела.\n"
-            "2) После тега первое слово ДОЛЖНО начинаться с заглавной буквы.\n"
-            "3) Сообщение ДОЛЖНО быть однострочным (без переводов строк).\n"
-            "4) Сообщение ДОЛЖНО оканчиваться точкой.\n"
-            "5) Сообщение ДОЛЖНО быть только на английском (ASCII буквы/цифры/знаки препинания).\n"
-            "Семантика: [Project] = новая фича, [Bugfix] = исправление бага, [Structure] = рефакторинг. Если семантика явно противоречит тегу по формулировке субъекта — считай это нарушением; иначе пропусти семантическую проверку.\n\n"
-            "ФОРМАТ ВЫВОДА (строго один из):\n"
-            "- OK_AGENT1\n"
-            "- Issues:\n- <короткое нарушение 1>\n- <короткое нарушение 2>\n\nProposed:\n<однострочное исправленное сообщение>\n"
-            "Не добавляй никакие дополнительные комментарии, кавычки или код‑блоки."
-        )
+    def _messages(self, commit_message: str) -> list[dict[str, str]]:
         user = f"Проверь это сообщение коммита:\n{commit_message.strip()}"
-        messages = [
-            {"role": "system", "content": system},
+        return [
+            {"role": "system", "content": SEMANTIC_VALIDATOR_PROMPT},
             {"role": "user", "content": user},
         ]
-        content = self.chat(messages)
-        return AgentResult(content=content, is_final=(content.strip() == "OK_AGENT1"))
+
+    def _check_locally(self, commit_message: str) -> AgentResult | None:
+        report = check_commit_message(commit_message)
+        if report.ok:
+            return None
+        self._print_answer("[RULES]", format_feedback(report))
+        return AgentResult(content=format_feedback(report), is_final=False, rules=report, proposed=report.proposed)
+
+    def validate(self, commit_message: str) -> AgentResult:
+        local = self._check_locally(commit_message)
+        if local is not None:
+            return local
+        content, usage = self.chat_completion(self._messages(commit_message))
+        return AgentResult(content=content, is_final=(content.strip() == "OK_AGENT1"), usage=usage)
+
+    async def avalidate(self, commit_message: str) -> AgentResult:
+        local = self._check_locally(commit_message)
+        if local is not None:
+            return local
+        content, usage = await self.achat_completion(self._messages(commit_message))
+        return AgentResult(content=content, is_final=(content.strip() == "OK_AGENT1"), usage=usage)
 
 
@@ -1,21 +1,37 @@
 from __future__ import annotations
 
+import asyncio
 from dataclasses import dataclass
-from typing import List, Dict
-from openai import OpenAI
+from typing import Any, List, Dict, Tuple
+from openai import AsyncOpenAI, OpenAI
+from llm_client import get_async_client, get_client
+from llm_metrics import acreate_completion, create_completion
+
+
+@dataclass
+class UsageInfo:
+    model: str
+    total_tokens: int
+    prompt_tokens: int
+    completion_tokens: int
 
 
 class BaseAgent:
     def __init__(
         self,
-        client: OpenAI,
+        client: OpenAI | None = None,
         model: str = "deepseek-chat",
         temperature: float = 0.4,
         *,
         show_request: bool = False,
         show_answers: bool = False,
+        async_client: AsyncOpenAI | None = None,
     ) -> None:
+        if client is None:
+            # Shared pooled clients from llm_client, built on first use
+            client, async_client = get_client(), async_client or get_async_client()
         self.client = client
+        self.async_client = async_client
         self.model = model
         self.temperature = temperature
         self.show_request = show_request
@@ -40,14 +56,48 @@ class BaseAgent:
             pass
 
     def chat(self, messages: List[Dict[str, str]]) -> str:
+        content, _usage = self.chat_completion(messages)
+        return content
+
+    def chat_completion(self, messages: List[Dict[str, str]]) -> Tuple[str, UsageInfo]:
         self._print_request("[LLM PROMPT]", messages)
-        response = self.client.chat.completions.create(
+        response = create_completion(
+            self.client,
+            agent=type(self).__name__,
             model=self.model,
             messages=messages,
             temperature=self.temperature,
         )
-        content = (response.choices[0].message.content or "").strip()
-        self._print_answer("[LLM ANSWER]", content)
+        return self._parse_response(response)
+
+    async def achat(self, messages: List[Dict[str, str]]) -> str:
+        content, _usage = await self.achat_completion(messages)
         return content
 
+    async def achat_completion(self, messages: List[Dict[str, str]]) -> Tuple[str, UsageInfo]:
+        if self.async_client is None:
+            return await asyncio.to_thread(self.chat_completion, messages)
+
+        self._print_request("[LLM PROMPT]", messages)
+        response = await acreate_completion(
+            self.async_client,
+            agent=type(self).__name__,
+            model=self.model,
+            messages=messages,
+            temperature=self.temperature,
+        )
+        return self._parse_response(response)
 
+    def _parse_response(self, response: Any) -> Tuple[str, UsageInfo]:
+        content = (response.choices[0].message.content or "").strip()
+        self._print_answer("[LLM ANSWER]", content)
+        usage = getattr(response, "usage", None)
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) if usage else 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) if usage else 0
+        total_tokens = getattr(usage, "total_tokens", prompt_tokens + completion_tokens) if usage else (prompt_tokens + completion_tokens)
+        return content, UsageInfo(
+            model=getattr(response, "model", self.model),
+            total_tokens=total_tokens,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+        )
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+TAGS = ("Project", "Bugfix", "Structure")
+
+_TAG_RE = re.compile(r"^\[(Project|Bugfix|Structure)\] ")
+_LOOSE_TAG_RE = re.compile(r"^\s*\[\s*(project|bugfix|structure)\s*\]\s*", re.IGNORECASE)
+_WRAPPERS = "`'\" "
+
+
+@dataclass
+class RuleReport:
+    message: str
+    violations: List[str] = field(default_factory=list)
+    # Locally auto-fixed message; None when a rule can't be fixed without the LLM
+    proposed: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return not self.violations
+
+
+def check_commit_message(message: str) -> RuleReport:
+    # Mechanical rules 1-5 of the validator prompt, checked without an LLM call
+    text = message.strip()
+    violations: List[str] = []
+
+    match = _TAG_RE.match(text)
+    if not match:
+        violations.append("Message must start with one of the tags [Project] | [Bugfix] | [Structure] followed by a space.")
+    else:
+        # Capitalization is judged on the description only; without a parsed tag there is none
+        description = text[match.end():]
+        if not description[:1].isupper():
+            violations.append("First word after the tag must start with a capital letter.")
+    if "\n" in text or "\r" in text:
+        violations.append("Message must be a single line.")
+    if not text.endswith("."):
+        violations.append("Message must end with a period.")
+    if not text.isascii():
+        violations.append("Message must be in English (ASCII only).")
+
+    report = RuleReport(message=text, violations=violations)
+    if violations:
+        report.proposed = autofix(text)
+    return report
+
+
+def autofix(message: str) -> Optional[str]:
+    text = " ".join(message.strip(_WRAPPERS).split())
+    if not text.isascii():
+        # Translation is the generator's job
+        return None
+
+    match = _LOOSE_TAG_RE.match(text)
+    if not match:
+        # Without a tag the right one is a semantic choice; leave it to the LLM
+        return None
+    tag = next(t for t in TAGS if t.lower() == match.group(1).lower())
+    subject = text[match.end():].strip()
+    if not subject:
+        return None
+    subject = subject[0].upper() + subject[1:]
+    subject = subject.rstrip(" .!;:,") + "."
+    fixed = f"[{tag}] {subject}"
+    return fixed if check_commit_message(fixed).ok else None
+
+
+def format_feedback(report: RuleReport) -> str:
+    # Same shape as the LLM validator's answer so the generator sees one format
+    lines = ["Issues:"] + [f"- {v}" for v in report.violations]
+    if report.proposed:
+        lines += ["", "Proposed:", report.proposed]
+    return "\n".join(lines)
@@ -3,19 +3,28 @@ import os
 from aiogram import Bot, Dispatcher, Router
 from aiogram.filters import CommandStart
 from aiogram.types import Message
-from aiogram.enums import ParseMode, ChatAction
+from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from dotenv import load_dotenv, find_dotenv
-from openai import OpenAI
+from chat_action import HEARTBEAT
+from llm_client import aclose_clients
+from llm_metrics import serve_metrics
+from resilience import CircuitOpenError
+from scheduler import set_chat
 from agent_generator import CommitGeneratorAgent
 from agent_validator import CommitValidatorAgent
+from chat_worker import ChatDispatcher, deliver
+from negotiation import STATUS_QUESTION, NegotiationEngine, RoundReport
+from session_store import MemorySessionStore, SqliteSessionStore
+from webhook import WebhookSettings, run_webhook
 
 
 # Load environment variables
 load_dotenv(find_dotenv())
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
 TELEGRAM_API_KEY = os.getenv("TELEGRAM_API_KEY")
 
 if not OPENAI_API_KEY:
@@ -24,24 +33,34 @@ if not TELEGRAM_API_KEY:
     raise RuntimeError("TELEGRAM_API_KEY is not set")
 
 
-openai_client = (
-    OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
-    if OPENAI_BASE_URL
-    else OpenAI(api_key=OPENAI_API_KEY)
-)
-
 router = Router()
 
-# Sessions: chat_id -> history
-SESSIONS: dict[int, list[dict[str, str]]] = {}
+# Sessions: hot chats in a bounded LRU, idle/evicted ones spilled to SQLite
+SESSIONS_DB = os.getenv("SESSIONS_DB") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "sessions.sqlite3")
+SESSIONS = MemorySessionStore(
+    max_sessions=int(os.getenv("SESSIONS_MAX_CHATS", "10000")),
+    max_bytes=int(os.getenv("SESSIONS_MAX_BYTES", str(64 * 1024 * 1024))),
+    idle_ttl=float(os.getenv("SESSIONS_IDLE_TTL", "3600")),
+    backend=SqliteSessionStore(SESSIONS_DB),
+)
 
-GEN = CommitGeneratorAgent(openai_client)
-VAL = CommitValidatorAgent(openai_client)
+GEN = CommitGeneratorAgent()
+VAL = CommitValidatorAgent()
+NEGOTIATOR = NegotiationEngine(
+    GEN,
+    VAL,
+    max_rounds=int(os.getenv("NEGOTIATION_MAX_ROUNDS", "4")),
+    token_budget=int(os.getenv("NEGOTIATION_TOKEN_BUDGET", "6000")),
+    time_budget=float(os.getenv("NEGOTIATION_TIME_BUDGET", "60")),
+    # >1 races that many candidates per round; first approved one wins
+    speculative=int(os.getenv("NEGOTIATION_SPECULATIVE", "1")),
+)
 
 
 @router.message(CommandStart())
 async def on_start(message: Message) -> None:
-    SESSIONS[message.chat.id] = []
+    DISPATCHER.cancel(message.chat.id)
+    SESSIONS.reset(message.chat.id)
     await message.answer(
         "Опиши кратко, какое изменение ты внес. Я помогу оформить commit message, а проверяющий агент валидирует формат.",
         parse_mode=None,
@@ -50,75 +69,112 @@ async def on_start(message: Message) -> None:
 
 @router.message()
 async def on_message(message: Message) -> None:
-    chat_id = message.chat.id
     user_text = (message.text or "").strip()
     if not user_text:
         await message.answer("Пожалуйста, отправьте текст.", parse_mode=None)
         return
 
-    history = SESSIONS.setdefault(chat_id, [])
-    history.append({"role": "user", "content": user_text})
+    # Serialized per chat; bursts of messages are merged into one negotiation
+    DISPATCHER.submit(message)
+
+
+async def process_message(message: Message, user_text: str) -> None:
+    chat_id = message.chat.id
+    # Fair share for this chat's negotiation calls in the shared LLM scheduler
+    set_chat(chat_id)
+    history = await SESSIONS.aget(chat_id)
+    # Committed to the session only after the negotiation finished (not when superseded)
+    dialog = history + [{"role": "user", "content": user_text}]
+    # One shared heartbeat keeps "typing..." up for the whole negotiation
+    typing = HEARTBEAT.typing(message.bot, chat_id)
 
     try:
-        stop_event = asyncio.Event()
-
-        async def keep_typing() -> None:
-            try:
-                while not stop_event.is_set():
-                    await message.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-                    await asyncio.wait_for(stop_event.wait(), timeout=4.0)
-            except asyncio.TimeoutError:
-                await keep_typing()
-
-        typing_task = asyncio.create_task(keep_typing())
-
-        # Step 1: генератор формирует кандидат
-        gen_res = await asyncio.to_thread(GEN.step, history)
-        try:
-            print(f"[Agent1] {gen_res.content}")
-        except Exception:
-            pass
-        history.append({"role": "assistant", "content": gen_res.content})
-
-        # Кандидат от агента 1
-        candidate = gen_res.content
-
-        # Валидация и общение между агентами до статуса OK_AGENT1
-        while True:
-            val_res = await asyncio.to_thread(VAL.validate, candidate)
-            try:
-                print(f"[Agent2] {val_res.content}")
-            except Exception:
-                pass
-            if val_res.is_final and val_res.content == "OK_AGENT1":
-                await message.answer(f"{candidate}", parse_mode=None)
-                SESSIONS[chat_id] = []
-                break
-            # Передаём подсказки валидатора снова генератору как обычный юзер‑ввод
-            history.append({"role": "user", "content": val_res.content})
-            gen_fix = await asyncio.to_thread(GEN.step, history)
-            try:
-                print(f"[Agent1] {gen_fix.content}")
-            except Exception:
-                pass
-            candidate = gen_fix.content
-
-        stop_event.set()
-        await typing_task
+        def log_round(report: RoundReport) -> None:
+            label = "[Agent1]" if report.actor == "generator" else "[Agent2]"
+            print(f"{label}#{report.lane} ({report.latency * 1000:.0f} ms, {report.tokens} tok) {report.content}")
+
+        result = await NEGOTIATOR.run(dialog, on_round=log_round)
+        print(f"[Negotiation] {result.status}: {len(result.rounds)} steps, {result.total_tokens} tok, {result.elapsed:.1f} s")
+
+        typing.stop()
+
+        # The session is updated without awaiting; after that the answer is delivered
+        # even if a newer message supersedes this negotiation
+        if result.status == STATUS_QUESTION:
+            # Уточняющий вопрос генератора — ждём ответа пользователя
+            dialog.append({"role": "assistant", "content": result.candidate})
+            SESSIONS.save(chat_id, dialog)
+            await deliver(message.answer(result.candidate, parse_mode=None))
+        elif result.ok:
+            SESSIONS.reset(chat_id)
+            await deliver(message.answer(f"{result.candidate}", parse_mode=None))
+        elif result.candidate:
+            SESSIONS.reset(chat_id)
+            await deliver(
+                message.answer(
+                    f"Не удалось согласовать сообщение за отведённый бюджет. Лучший вариант:\n{result.candidate}",
+                    parse_mode=None,
+                )
+            )
+        else:
+            # Budget ran out before any candidate: the session is left as it was
+            await deliver(
+                message.answer(
+                    "Не удалось составить сообщение коммита за отведённый бюджет. Повторите запрос чуть позже.",
+                    parse_mode=None,
+                )
+            )
+    except CircuitOpenError:
+        await message.answer("LLM сейчас недоступна, попробуйте через минуту.", parse_mode=None)
     except Exception as exc:  # noqa: BLE001
         await message.answer(f"Произошла ошибка: {exc}", parse_mode=None)
+    finally:
+        typing.stop()
 
 
-async def main() -> None:
-    bot = Bot(token=TELEGRAM_API_KEY, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN_V2))
+# Per-chat actors: one in-flight negotiation per chat, superseded ones get cancelled
+DISPATCHER = ChatDispatcher(process_message, debounce=float(os.getenv("CHAT_DEBOUNCE", "0.4")))
+
+
+async def on_shutdown() -> None:
+    HEARTBEAT.close()
+    await SESSIONS.aclose()
+    await aclose_clients()
+
+
+def build_bot() -> Bot:
+    # TELEGRAM_API_SERVER: self-hosted Bot API server (or a local fake in load tests)
+    api_server = os.getenv("TELEGRAM_API_SERVER")
+    session = AiohttpSession(api=TelegramAPIServer.from_base(api_server)) if api_server else None
+    return Bot(token=TELEGRAM_API_KEY, session=session, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN_V2))
+
+
+def build_dispatcher() -> Dispatcher:
     dp = Dispatcher()
     dp.include_router(router)
-    await dp.start_polling(bot)
+    dp.shutdown.register(on_shutdown)
+    return dp
+
+
+async def main() -> None:
+    # Prometheus metrics for every LLM call (latency, TTFT, tokens, retries) on :METRICS_PORT/metrics
+    if os.getenv("METRICS_PORT"):
+        serve_metrics(int(os.environ["METRICS_PORT"]))
+
+    bot = build_bot()
+    # getUpdates is refused while a webhook from an earlier webhook-mode run is set
+    await bot.delete_webhook()
+    await build_dispatcher().start_polling(bot)
 
 
 if __name__ == "__main__":
+    # WEBHOOK_URL switches to webhook mode; WEBHOOK_WORKERS > 1 shards chats over processes
+    WEBHOOK = WebhookSettings.from_env()
     try:
-        asyncio.run(main())
+        if WEBHOOK is not None:
+            run_webhook(build_bot, build_dispatcher, WEBHOOK)
+        else:
+            asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         pass
 
@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Set, TypeVar
+
+from agent_generator import CommitGeneratorAgent
+from agent_validator import AgentResult, CommitValidatorAgent
+
+T = TypeVar("T")
+
+STATUS_OK = "ok"
+STATUS_QUESTION = "question"
+STATUS_MAX_ROUNDS = "max_rounds"
+STATUS_TOKEN_BUDGET = "token_budget"
+STATUS_TIME_BUDGET = "time_budget"
+STATUS_REPEATED = "repeated"
+
+
+@dataclass
+class RoundReport:
+    index: int
+    # "generator", "validator" or "rules" (local validator answer, no LLM call)
+    actor: str
+    content: str
+    latency: float
+    tokens: int
+    # Speculative lane that produced this step (always 0 without speculation)
+    lane: int = 0
+
+
+@dataclass
+class NegotiationResult:
+    status: str
+    candidate: str
+    rounds: List[RoundReport] = field(default_factory=list)
+    elapsed: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.status == STATUS_OK
+
+    @property
+    def total_tokens(self) -> int:
+        return sum(r.tokens for r in self.rounds)
+
+
+@dataclass
+class _LaneOutcome:
+    candidate: str
+    verdict: Optional[AgentResult]
+    question: bool = False
+    # Budget status that stopped this lane early; candidate is its best so far (may be "")
+    budget: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.verdict is not None and self.verdict.is_final
+
+    @property
+    def rank(self) -> int:
+        # Fallback preference: a rejected candidate (actionable feedback), then a question, then nothing
+        if not self.candidate:
+            return 0
+        return 1 if self.question else 2
+
+
+class _BudgetExceeded(Exception):
+    def __init__(self, status: str) -> None:
+        super().__init__(status)
+        self.status = status
+
+
+class NegotiationEngine:
+    # Bounded generator <-> validator loop. Each round the generator sees the dialog
+    # plus only the latest candidate and validator verdict, never the accumulated
+    # feedback, so prompt size per round stays flat.
+    #
+    # With speculative > 1 every round runs that many generate -> validate lanes
+    # concurrently; the first approved candidate wins and the other lanes are cancelled.
+
+    def __init__(
+        self,
+        generator: CommitGeneratorAgent,
+        validator: CommitValidatorAgent,
+        *,
+        max_rounds: int = 4,
+        token_budget: int = 6000,
+        time_budget: float = 60.0,
+        speculative: int = 1,
+    ) -> None:
+        self.generator = generator
+        self.validator = validator
+        self.max_rounds = max_rounds
+        self.token_budget = token_budget
+        self.time_budget = time_budget
+        self.speculative = max(1, speculative)
+
+    async def run(
+        self,
+        history: List[Dict[str, str]],
+        *,
+        on_round: Optional[Callable[[RoundReport], None]] = None,
+    ) -> NegotiationResult:
+        started = time.monotonic()
+        result = NegotiationResult(status=STATUS_MAX_ROUNDS, candidate="")
+        run = _Run(self, result, deadline=started + self.time_budget, on_round=on_round)
+
+        try:
+            prompt = history
+            for _ in range(self.max_rounds):
+                outcome = await run.race(prompt)
+                if outcome.candidate:
+                    # A round cut short by the budget keeps the previous round's candidate
+                    result.candidate = outcome.candidate
+                if outcome.budget is not None:
+                    result.status = outcome.budget
+                    return result
+                if outcome.ok:
+                    result.status = STATUS_OK
+                    return result
+                if outcome.question:
+                    # Generator asks the user for details: nothing to validate yet
+                    result.status = STATUS_QUESTION
+                    return result
+                if outcome.candidate in run.seen:
+                    # Same or oscillating candidate: more rounds won't converge
+                    result.status = STATUS_REPEATED
+                    return result
+                run.seen.add(outcome.candidate)
+                prompt = history + [
+                    {"role": "assistant", "content": outcome.candidate},
+                    {"role": "user", "content": outcome.verdict.content if outcome.verdict else ""},
+                ]
+            return result
+        except _BudgetExceeded as exc:
+            result.status = exc.status
+            return result
+        finally:
+            result.elapsed = time.monotonic() - started
+
+
+class _Run:
+    # Per-request state shared by the lanes of one negotiation
+
+    def __init__(
+        self,
+        engine: NegotiationEngine,
+        result: NegotiationResult,
+        *,
+        deadline: float,
+        on_round: Optional[Callable[[RoundReport], None]],
+    ) -> None:
+        self.engine = engine
+        self.result = result
+        self.deadline = deadline
+        self.on_round = on_round
+        self.seen: Set[str] = set()
+
+    def record(self, lane: int, actor: str, content: str, latency: float, tokens: int) -> None:
+        report = RoundReport(
+            index=len(self.result.rounds), actor=actor, content=content, latency=latency, tokens=tokens, lane=lane
+        )
+        self.result.rounds.append(report)
+        if self.on_round is not None:
+            self.on_round(report)
+
+    async def call(self, coro: Coroutine[Any, Any, T]) -> tuple[T, float]:
+        call_started = time.monotonic()
+        remaining = self.deadline - call_started
+        if self.result.total_tokens >= self.engine.token_budget or remaining <= 0:
+            coro.close()
+            raise _BudgetExceeded(STATUS_TOKEN_BUDGET if remaining > 0 else STATUS_TIME_BUDGET)
+        try:
+            value = await asyncio.wait_for(coro, timeout=remaining)
+        except asyncio.TimeoutError:
+            raise _BudgetExceeded(STATUS_TIME_BUDGET) from None
+        return value, time.monotonic() - call_started
+
+    async def lane(self, index: int, prompt: List[Dict[str, str]]) -> _LaneOutcome:
+        # A budget running out stops only this lane; it reports its best candidate so far
+        candidate = ""
+        verdict: Optional[AgentResult] = None
+        try:
+            gen, latency = await self.call(self.engine.generator.astep(prompt))
+            self.record(index, "generator", gen.content, latency, gen.usage.total_tokens if gen.usage else 0)
+            if _is_question(gen.content):
+                return _LaneOutcome(candidate=gen.content, verdict=None, question=True)
+
+            candidate = gen.content
+            checked = set()
+            while True:
+                checked.add(candidate)
+                val, latency = await self.call(self.engine.validator.avalidate(candidate))
+                actor = "rules" if val.rules else "validator"
+                self.record(index, actor, val.content, latency, val.usage.total_tokens if val.usage else 0)
+                verdict = val
+                # Locally auto-fixed: re-check it without a generator round trip
+                if val.is_final or not val.proposed or val.proposed in checked:
+                    return _LaneOutcome(candidate=candidate, verdict=val)
+                candidate = val.proposed
+                verdict = None
+        except _BudgetExceeded as exc:
+            return _LaneOutcome(candidate=candidate, verdict=verdict, budget=exc.status)
+
+    async def race(self, prompt: List[Dict[str, str]]) -> _LaneOutcome:
+        lanes = self.engine.speculative
+        if lanes == 1:
+            return await self.lane(0, prompt)
+
+        tasks = [asyncio.create_task(self.lane(i, prompt)) for i in range(lanes)]
+        fallback: Optional[_LaneOutcome] = None
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    outcome = task.result()
+                    if outcome.ok:
+                        return outcome
+                    if fallback is None or outcome.rank > fallback.rank:
+                        fallback = outcome
+            assert fallback is not None
+            return fallback
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _is_question(text: str) -> bool:
+    return text.rstrip().endswith("?")
@@ -0,0 +1,25 @@
+from __future__ import annotations
+
+import importlib
+import sys
+from pathlib import Path
+from types import ModuleType
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def _lesson_module_names() -> set[str]:
+    return {p.stem for p in ROOT.glob("0*_*/*.py")}
+
+
+def import_lesson(lesson: str, *modules: str) -> list[ModuleType]:
+    # Lessons are flat script folders sharing module names (agent, base_agent, ...),
+    # so drop whatever another lesson left in sys.modules before importing.
+    for name in _lesson_module_names():
+        sys.modules.pop(name, None)
+    path = str(ROOT / lesson)
+    sys.path.insert(0, path)
+    try:
+        return [importlib.import_module(name) for name in modules]
+    finally:
+        sys.path.remove(path)
@@ -0,0 +1,83 @@
+"""Before/after load test: sync client in asyncio.to_thread vs. the async client path.
+
+Usage: python bench/bench_async_client.py --requests 500 --concurrency 200 --latency 0.2
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import statistics
+import time
+from typing import Awaitable, Callable
+
+from openai import AsyncOpenAI, OpenAI
+
+from _lessons import import_lesson
+from fake_openai import FakeConfig, start_in_process
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[idx]
+
+
+async def run_load(call: Callable[[int], Awaitable[object]], total: int, concurrency: int) -> tuple[float, list[float]]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+
+    async def one(i: int) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            await call(i)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    return time.perf_counter() - started, latencies
+
+
+def report(label: str, elapsed: float, latencies: list[float]) -> None:
+    print(
+        f"{label:<10} rps={len(latencies) / elapsed:8.1f}  "
+        f"p50={statistics.median(latencies) * 1000:7.1f}ms  "
+        f"p99={percentile(latencies, 99) * 1000:7.1f}ms"
+    )
+
+
+async def main_async(base_url: str, total: int, concurrency: int) -> None:
+    (agent_mod,) = import_lesson("02_formatted_output", "agent")
+    sync_client = OpenAI(api_key="bench", base_url=base_url)
+    async_client = AsyncOpenAI(api_key="bench", base_url=base_url)
+
+    before = agent_mod.FormattingAgent(sync_client)
+    after = agent_mod.FormattingAgent(sync_client, async_client=async_client)
+
+    elapsed, latencies = await run_load(
+        lambda i: asyncio.to_thread(before.reply_payload, f"Кто такой Ленин? #{i}"), total, concurrency
+    )
+    report("to_thread", elapsed, latencies)
+
+    elapsed, latencies = await run_load(lambda i: after.areply_payload(f"Кто такой Ленин? #{i}"), total, concurrency)
+    report("async", elapsed, latencies)
+
+    await async_client.close()
+    sync_client.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.2)
+    args = parser.parse_args()
+
+    proc, base_url = start_in_process(FakeConfig(latency=args.latency, content='{"known_for": ["революция"]}'))
+    try:
+        asyncio.run(main_async(base_url, args.requests, args.concurrency))
+    finally:
+        proc.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Typing indicator under many concurrent handlers: per-request keep_typing tasks vs. the shared heartbeat.
+
+Handlers wait on a simulated LLM call (random `--wait` seconds) while showing "typing...";
+`--per-chat` handlers run in the same chat at once. Reported: sendChatAction calls,
+the busiest second (Telegram allows ~30 requests/s per bot), the longest gap
+between actions of a waiting chat (the indicator fades after ~5 s) and peak tasks.
+
+Usage: python bench/bench_chat_action.py --chats 500 --per-chat 2 --wait 10
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter, defaultdict
+
+from aiogram import Bot
+from aiogram.enums import ChatAction
+
+from _lessons import import_lesson
+from fake_telegram import FAKE_TOKEN, FakeTelegramSession
+
+
+def keep_typing_old(bot: Bot, chat_id: int):
+    # The handlers' previous pattern: one task per request, recursing on every timeout
+    stop_event = asyncio.Event()
+
+    async def keep_typing() -> None:
+        try:
+            while not stop_event.is_set():
+                await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+                await asyncio.wait_for(stop_event.wait(), timeout=4.0)
+        except asyncio.TimeoutError:
+            await keep_typing()
+
+    task = asyncio.create_task(keep_typing())
+    return stop_event, task
+
+
+async def scenario(label: str, chats: int, per_chat: int, wait: float, latency: float, heartbeat) -> None:
+    session = FakeTelegramSession(latency=latency)
+    bot = Bot(FAKE_TOKEN, session=session)
+    rng = random.Random(1)
+    waiting: dict[int, list[tuple[float, float]]] = defaultdict(list)
+    peak_tasks = 0
+
+    async def handler(chat_id: int) -> None:
+        started = time.perf_counter()
+        if heartbeat is None:
+            stop_event, task = keep_typing_old(bot, chat_id)
+        else:
+            lease = heartbeat.typing(bot, chat_id)
+        await asyncio.sleep(rng.uniform(wait / 2, wait))
+        if heartbeat is None:
+            stop_event.set()
+            await task
+        else:
+            lease.stop()
+        waiting[chat_id].append((started, time.perf_counter()))
+
+    async def sample_tasks() -> None:
+        nonlocal peak_tasks
+        while True:
+            peak_tasks = max(peak_tasks, len(asyncio.all_tasks()))
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.create_task(sample_tasks())
+    started = time.perf_counter()
+    await asyncio.gather(*(handler(1000 + n) for n in range(chats) for _ in range(per_chat)))
+    elapsed = time.perf_counter() - started
+    sampler.cancel()
+    if heartbeat is not None:
+        heartbeat.close()
+
+    actions = [call for call in session.calls if call.method == "SendChatAction"]
+    busiest = max(Counter(int(call.at - started) for call in actions).values(), default=0)
+    by_chat: dict[int, list[float]] = defaultdict(list)
+    for call in actions:
+        by_chat[call.chat_id].append(call.at)
+    max_gap = 0.0
+    for chat_id, spans in waiting.items():
+        start, end = min(begin for begin, _ in spans), max(stop for _, stop in spans)
+        points = [start] + sorted(by_chat[chat_id]) + [end]
+        max_gap = max(max_gap, max(b - a for a, b in zip(points, points[1:])))
+    print(
+        f"{label:<11} actions={len(actions):6d}  per chat={len(actions) / chats:5.1f}  "
+        f"busiest second={busiest:5d}  max gap={max_gap:4.1f}s  peak tasks={peak_tasks:5d}  wall={elapsed:5.1f}s"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=500)
+    parser.add_argument("--per-chat", type=int, default=2)
+    parser.add_argument("--wait", type=float, default=10.0)
+    parser.add_argument("--latency", type=float, default=0.05, help="Bot API round trip, seconds")
+    parser.add_argument("--rps", type=float, default=10.0, help="heartbeat's sendChatAction budget per second")
+    args = parser.parse_args()
+
+    (chat_action,) = import_lesson("03_stopping_agent", "chat_action")
+    asyncio.run(scenario("keep_typing", args.chats, args.per_chat, args.wait, args.latency, None))
+    heartbeat = chat_action.ChatActionHeartbeat(per_second=args.rps)
+    asyncio.run(scenario("heartbeat", args.chats, args.per_chat, args.wait, args.latency, heartbeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Commit bot time-to-answer: serial negotiation vs. speculative parallel candidates.
+
+Usage: python bench/bench_commit_speculative.py --conversations 200 --speculative 3
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import statistics
+
+from openai import AsyncOpenAI, OpenAI
+
+from _lessons import import_lesson
+from bench_async_client import percentile
+from fake_openai import FakeConfig, start_in_process
+
+# The generator sometimes breaks the format (fixed locally) or picks a wrong tag,
+# the semantic validator rejects about a third of candidates.
+ROUTES = (
+    ("пишет сообщения коммитов", ("[Project] Add feature {n}.", "[project] add feature {n}", "[Bugfix] Add feature {n}.")),
+    ("валидатор", ("OK_AGENT1", "OK_AGENT1", "Issues:\n- Tag does not match the change.\n\nProposed:\n[Project] Add feature.")),
+)
+
+
+async def main_async(base_url: str, conversations: int, concurrency: int, speculative: int) -> None:
+    gen_mod, val_mod, neg_mod = import_lesson("04_agent_communication", "agent_generator", "agent_validator", "negotiation")
+    sync_client = OpenAI(api_key="bench", base_url=base_url)
+    client = AsyncOpenAI(api_key="bench", base_url=base_url)
+    gen = gen_mod.CommitGeneratorAgent(sync_client, async_client=client)
+    val = val_mod.CommitValidatorAgent(sync_client, async_client=client)
+    history = [{"role": "user", "content": "Added a login form"}]
+
+    for lanes in sorted({1, speculative}):
+        engine = neg_mod.NegotiationEngine(gen, val, speculative=lanes)
+        semaphore = asyncio.Semaphore(concurrency)
+        results = []
+
+        async def one() -> None:
+            async with semaphore:
+                results.append(await engine.run(history))
+
+        await asyncio.gather(*(one() for _ in range(conversations)))
+        latencies = [r.elapsed for r in results]
+        ok = sum(r.ok for r in results)
+        tokens = statistics.mean(r.total_tokens for r in results)
+        print(
+            f"speculative={lanes}  ok={ok}/{len(results)}  "
+            f"p50={statistics.median(latencies) * 1000:7.1f}ms  p99={percentile(latencies, 99) * 1000:7.1f}ms  "
+            f"tokens/answer={tokens:6.0f}"
+        )
+
+    await client.close()
+    sync_client.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--speculative", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--jitter", type=float, default=0.6)
+    args = parser.parse_args()
+
+    config = FakeConfig(latency=args.latency, jitter=args.jitter, routes=ROUTES, seed=1)
+    proc, base_url = start_in_process(config)
+    try:
+        asyncio.run(main_async(base_url, args.conversations, args.concurrency, args.speculative))
+    finally:
+        proc.terminate()
+
+
+if __name__ == "__main__":
+    main()
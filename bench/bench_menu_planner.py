@@ -0,0 +1,122 @@
+"""Long menu plans (03): one streamed completion vs. skeleton + concurrent day chunks (MenuPlanner).
+
+Usage: python bench/bench_menu_planner.py --days 30 --token-rate 200
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import time
+
+from openai import AsyncOpenAI, OpenAI
+
+from _lessons import import_lesson
+from fake_openai import FakeConfig, start_in_process
+
+SKELETON = {
+    "plan_title": "Сушка на месяц",
+    "target": "снижение жира",
+    "meals_per_day": 3,
+    "total_daily_calories": 1900,
+    "dietary_style": "всеядное",
+    "restrictions": [],
+    "avoid_ingredients": ["арахис"],
+    "preferred_cuisines": [],
+    "budget_level": "средний",
+    "max_cook_time_min": 30,
+    "equipment": ["плита"],
+    "macros_ratio": {"protein_percent": 30, "fat_percent": 25, "carbs_percent": 45},
+}
+
+
+def day(number: int) -> dict:
+    meal = {
+        "name": "обед",
+        "dish": "Гречка с курицей",
+        "calories": 620,
+        "protein_g": 45,
+        "fat_g": 14,
+        "carbs_g": 70,
+        "ingredients": [
+            {"name": "Гречка", "qty": 80, "unit": "г"},
+            {"name": "Куриное филе", "qty": 150, "unit": "г"},
+        ],
+        "recipe": "Отварить гречку. Обжарить филе. Подать вместе.",
+    }
+    return {"day": number, "meals": [dict(meal, name=name) for name in ("завтрак", "обед", "ужин")]}
+
+
+def plan(days: int) -> str:
+    document = {**SKELETON, "duration_days": days, "days": [day(n) for n in range(1, days + 1)], "shopping_list": [], "notes": []}
+    # Same key order as menu_schema: the skeleton precedes the days
+    ordered = {"plan_title": document.pop("plan_title"), "target": document.pop("target"), "duration_days": days, **document}
+    return json.dumps(ordered, ensure_ascii=False)
+
+
+async def scenario(label: str, base_url: str, history: list[dict[str, str]], chunk_days: int) -> None:
+    agent_mod, planner_mod = import_lesson("03_stopping_agent", "agent", "planner")
+    sync_client = OpenAI(api_key="bench", base_url=base_url, max_retries=0)
+    async_client = AsyncOpenAI(api_key="bench", base_url=base_url, max_retries=0)
+    planner = (
+        planner_mod.MenuPlanner(sync_client, async_client=async_client, chunk_days=chunk_days, max_parallel=10)
+        if chunk_days
+        else None
+    )
+    agent = agent_mod.FormattingAgent(sync_client, async_client=async_client, planner=planner)
+    first_delta: list[float] = []
+
+    async def on_delta(delta: str) -> None:
+        if not first_delta:
+            first_delta.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    try:
+        payload = await agent.astream_reply_payload_from_history(history, on_delta)
+    finally:
+        await async_client.close()
+        sync_client.close()
+    elapsed = time.perf_counter() - started
+    document = json.loads(payload.text.strip("`").removeprefix("json"))
+    print(
+        f"{label:<10} total={elapsed:6.2f}s  first token={first_delta[0] * 1000:6.1f}ms  "
+        f"days={len(document['days']):3d}  notes={document['notes']}  shopping_list={document['shopping_list']}"
+    )
+
+
+async def main_async(base_url: str, days: int, chunk_days: int) -> None:
+    history = [{"role": "user", "content": f"Три приёма пищи в день на {days} дней, аллергия на арахис"}]
+    await scenario("single", base_url, history, 0)
+    await scenario("chunked", base_url, history, chunk_days)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--chunk-days", type=int, default=7)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--token-rate", type=float, default=200)
+    args = parser.parse_args()
+
+    chunk = json.dumps({"days": [day(n) for n in range(1, args.chunk_days + 1)]}, ensure_ascii=False)
+    tail = json.dumps({"notes": ["Пейте больше воды"]}, ensure_ascii=False)
+    proc, base_url = start_in_process(
+        FakeConfig(
+            latency=args.latency,
+            token_rate=args.token_rate,
+            # Planner prompts first: they also mention the trainer role
+            routes=(
+                ("Каркас плана питания уже утверждён", (chunk,)),
+                ("План питания уже расписан по дням", (tail,)),
+                ("фитнес-тренер", (plan(args.days),)),
+            ),
+        )
+    )
+    try:
+        asyncio.run(main_async(base_url, args.days, args.chunk_days))
+    finally:
+        proc.terminate()
+
+
+if __name__ == "__main__":
+    main()
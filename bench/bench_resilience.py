@@ -0,0 +1,85 @@
+"""Resilience layer against a fault-injecting stub: retries, hedging and the circuit breaker.
+
+Usage: python bench/bench_resilience.py --requests 300 --concurrency 50
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import time
+
+from openai import AsyncOpenAI, OpenAI
+
+from _lessons import import_lesson
+from bench_async_client import percentile, report, run_load
+from fake_openai import FakeConfig, start_in_process
+
+CONTENT = '{"known_for": ["революция"]}'
+
+
+async def scenario(
+    label: str, config: FakeConfig, total: int, concurrency: int, *, attempts: int, hedge: bool = False
+) -> None:
+    agent_mod, resilience = import_lesson("02_formatted_output", "agent", "resilience")
+    # Fast backoff so the run measures behaviour, not sleeping
+    resilience.RESILIENCE.policy = resilience.RetryPolicy(max_attempts=attempts, base_delay=0.05, max_delay=0.5)
+    resilience.RESILIENCE.breaker = resilience.CircuitBreaker(reset_timeout=1.0)
+    resilience.RESILIENCE.hedge = hedge
+
+    proc, base_url = start_in_process(config)
+    sync_client = OpenAI(api_key="bench", base_url=base_url, max_retries=0)
+    async_client = AsyncOpenAI(api_key="bench", base_url=base_url, max_retries=0)
+    agent = agent_mod.FormattingAgent(sync_client, async_client=async_client)
+    failures: dict[str, int] = {}
+    failed_latencies: list[float] = []
+
+    async def call(i: int) -> None:
+        started = time.perf_counter()
+        try:
+            await agent.areply_payload(f"Кто такой Ленин? #{i}")
+        except Exception as exc:  # noqa: BLE001
+            failures[type(exc).__name__] = failures.get(type(exc).__name__, 0) + 1
+            failed_latencies.append(time.perf_counter() - started)
+
+    try:
+        if hedge:
+            # Warm the latency window so the p95 deadline is known
+            await run_load(call, 50, 10)
+        elapsed, latencies = await run_load(call, total, concurrency)
+    finally:
+        await async_client.close()
+        sync_client.close()
+        proc.terminate()
+    report(label, elapsed, latencies)
+    if failures:
+        p50_failed = percentile(failed_latencies, 50) * 1000
+        print(f"{'':<10} failed: {failures}  p50 of failed={p50_failed:.1f}ms")
+
+
+async def main_async(total: int, concurrency: int, latency: float) -> None:
+    faulty = FakeConfig(latency=latency, content=CONTENT, error_rate=0.3, retry_after=0.05, seed=1)
+    print("30% of requests fail with 503 + Retry-After")
+    await scenario("no-retry", faulty, total, concurrency, attempts=1)
+    await scenario("retry", faulty, total, concurrency, attempts=4)
+
+    tail = FakeConfig(latency=latency, content=CONTENT, slow_rate=0.05, slow_factor=10, seed=2)
+    print("5% of requests are 10x slower")
+    await scenario("no-hedge", tail, total, concurrency, attempts=4)
+    await scenario("hedge", tail, total, concurrency, attempts=4, hedge=True)
+
+    outage = FakeConfig(latency=latency, content=CONTENT, outage=(0.0, 3600.0))
+    print("upstream down: breaker opens after 20 failures and fails fast")
+    await scenario("outage", outage, total, concurrency, attempts=4)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.1)
+    args = parser.parse_args()
+    asyncio.run(main_async(args.requests, args.concurrency, args.latency))
+
+
+if __name__ == "__main__":
+    main()
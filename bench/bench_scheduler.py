@@ -0,0 +1,108 @@
+"""Burst of chats against a rate-limited provider: no client-side limit vs. the shared scheduler.
+
+Usage: python bench/bench_scheduler.py --chats 60 --messages 3 --rpm 600
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from openai import AsyncOpenAI, OpenAI
+
+from _lessons import import_lesson
+from bench_async_client import percentile
+from fake_openai import FakeConfig, start_in_process
+
+
+def retries_total(llm_metrics) -> float:
+    return sum(
+        float(line.rsplit(" ", 1)[1])
+        for line in llm_metrics.METRICS.render_prometheus().splitlines()
+        if line.startswith("llm_retries_total{")
+    )
+
+
+async def scenario(label: str, base_url: str, chats: int, messages: int, rpm: float) -> None:
+    agent_mod, summarizer_mod, scheduler, resilience, llm_metrics = import_lesson(
+        "03_stopping_agent", "agent", "summarizer", "scheduler", "resilience", "llm_metrics"
+    )
+    scheduler.SCHEDULER = scheduler.LLMScheduler(rpm=rpm)
+    llm_metrics.SCHEDULER = scheduler.SCHEDULER
+    resilience.RESILIENCE.policy = resilience.RetryPolicy(max_attempts=20, max_retry_after=5)
+
+    sync_client = OpenAI(api_key="bench", base_url=base_url, max_retries=0)
+    async_client = AsyncOpenAI(api_key="bench", base_url=base_url, max_retries=0)
+    agent = agent_mod.FormattingAgent(sync_client, async_client=async_client)
+    summarizer = summarizer_mod.SummarizerAgent(sync_client, async_client=async_client)
+    interactive: list[float] = []
+    background: list[float] = []
+    failed = 0
+
+    async def chat(chat_id: int) -> None:
+        nonlocal failed
+        scheduler.set_chat(chat_id)
+        for i in range(messages):
+            history = [{"role": "user", "content": f"Что съесть на ужин? #{chat_id}.{i}"}]
+            started = time.perf_counter()
+            try:
+                await agent.areply_payload_from_history(history)
+            except Exception:  # noqa: BLE001
+                failed += 1
+            interactive.append(time.perf_counter() - started)
+
+            async def summarize() -> None:
+                nonlocal failed
+                started = time.perf_counter()
+                try:
+                    await summarizer.asummarize_history(history)
+                except Exception:  # noqa: BLE001
+                    failed += 1
+                background.append(time.perf_counter() - started)
+
+            # Like history compaction: fire and forget next to the reply
+            asyncio.ensure_future(summarize())
+
+    started = time.perf_counter()
+    await asyncio.gather(*(chat(c) for c in range(chats)))
+    replies_done = time.perf_counter() - started
+    while len(background) < chats * messages:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    await async_client.close()
+    sync_client.close()
+
+    calls = len(interactive) + len(background)
+    print(
+        f"{label:<10} calls/s={calls / elapsed:6.1f}  429s={retries_total(llm_metrics):5.0f}  failed={failed:3d}  "
+        f"replies p50={statistics.median(interactive) * 1000:7.1f}ms p99={percentile(interactive, 99) * 1000:7.1f}ms  "
+        f"summaries p50={statistics.median(background) * 1000:7.1f}ms  (replies done in {replies_done:.1f}s)"
+    )
+
+
+async def main_async(base_url: str, chats: int, messages: int, rpm: float) -> None:
+    await scenario("no-limit", base_url, chats, messages, 0)
+    # A little under the provider ceiling leaves room for clock skew between the two buckets
+    await scenario("scheduler", base_url, chats, messages, rpm * 0.95)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chats", type=int, default=60)
+    parser.add_argument("--messages", type=int, default=3)
+    parser.add_argument("--rpm", type=float, default=600)
+    parser.add_argument("--latency", type=float, default=0.2)
+    args = parser.parse_args()
+
+    proc, base_url = start_in_process(
+        FakeConfig(latency=args.latency, content='{"answer": "Гречка с курицей"}', rpm_limit=args.rpm)
+    )
+    try:
+        asyncio.run(main_async(base_url, args.chats, args.messages, args.rpm))
+    finally:
+        proc.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+"""End-to-end baseline for all four bots against the stub: the Tk streaming worker (01),
+the formatting bot (02), the nutrition dialog (03) and the commit negotiation (04).
+
+Telegram bots get their updates through fake_telegram.TelegramFeeder, so the whole
+handler path runs (routers, chat dispatcher, streaming edits, sessions). Every
+scenario runs in its own process: peak RSS is per bot. Reports conversations/s,
+p50/p99 per message, time to the first reply, LLM calls and tokens per conversation.
+
+Usage:
+  python bench/bench_suite.py --conversations 100 --out baseline.json
+  python bench/bench_suite.py --compare baseline.json
+  python bench/bench_suite.py --replay transcripts.jsonl   # recorded answers, see README
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+
+from _lessons import import_lesson
+from bench_async_client import percentile
+from fake_openai import FakeConfig, start_in_process
+
+BIO = json.dumps(
+    {
+        "birth_date": "1879-03-14",
+        "death_date": "1955-04-18",
+        "birth_place": "Ульм",
+        "death_place": "Принстон",
+        "interesting_facts": ["Играл на скрипке", "Отказался от поста президента Израиля"],
+        "known_for": ["Теория относительности", "Фотоэффект"],
+    },
+    ensure_ascii=False,
+)
+
+
+def _menu(days: int) -> str:
+    meal = {
+        "dish": "Гречка с курицей",
+        "calories": 620,
+        "protein_g": 45,
+        "fat_g": 14,
+        "carbs_g": 70,
+        "ingredients": [
+            {"name": "Гречка", "qty": 80, "unit": "г"},
+            {"name": "Куриное филе", "qty": 150, "unit": "г"},
+        ],
+        "recipe": "Отварить гречку. Обжарить филе.",
+    }
+    document = {
+        "plan_title": "Сушка",
+        "target": "снижение жира",
+        "duration_days": days,
+        "meals_per_day": 3,
+        "total_daily_calories": 1900,
+        "dietary_style": "всеядное",
+        "restrictions": [],
+        "avoid_ingredients": [],
+        "preferred_cuisines": [],
+        "budget_level": "средний",
+        "max_cook_time_min": 30,
+        "equipment": ["плита"],
+        "macros_ratio": {"protein_percent": 30, "fat_percent": 25, "carbs_percent": 45},
+        "days": [
+            {"day": n, "meals": [dict(meal, name=name) for name in ("завтрак", "обед", "ужин")]}
+            for n in range(1, days + 1)
+        ],
+        "notes": [],
+    }
+    return json.dumps(document, ensure_ascii=False)
+
+
+@dataclass
+class Scenario:
+    lesson: str
+    # User messages of one conversation ("{n}" = conversation number)
+    script: tuple[str, ...]
+    # Substring the last reply must contain for the conversation to count as ok
+    expect: str
+    # Stub answers: by system prompt marker, and by user message (written as a replay transcript)
+    routes: tuple[tuple[str, tuple[str, ...]], ...] = ()
+    answers: dict[str, str] = field(default_factory=dict)
+    reasoning: str = ""
+    model: str = "deepseek-chat"
+
+
+SCENARIOS = {
+    "tk": Scenario(
+        "01_hello_world",
+        ("Привет! Как дела?", "Расскажи анекдот"),
+        expect="анекдот",
+        reasoning="Пользователь здоровается, отвечу коротко и дружелюбно. " * 4,
+        answers={
+            "Привет! Как дела?": "Привет! Всё хорошо, чем помочь?",
+            "Расскажи анекдот": "Короткий анекдот: программист ушёл в бар и не вернулся — бесконечный цикл.",
+        },
+        model="deepseek-reasoner",
+    ),
+    "formatting": Scenario(
+        "02_formatted_output",
+        # The repeated question is answered from ResponseCache
+        ("Кто такой Эйнштейн? #{n}", "Кто такой Эйнштейн? #{n}"),
+        expect="Ульм",
+        routes=(("историк-агент", (BIO,)),),
+    ),
+    "nutrition": Scenario(
+        "03_stopping_agent",
+        ("Составь меню на 3 дня", "Три приёма пищи в день", "Аллергии нет, цель — снижение жира, бюджет средний"),
+        # The plan is sent as JSON split into several messages; the last one ends with the
+        # shopping list computed by nutrition.py
+        expect="Куриное филе — ",
+        routes=(("конспектирует диалог", ("- Цель: снижение жира\n- Аллергий нет\n- 3 приёма пищи",)),),
+        answers={
+            "Составь меню на 3 дня": "1. Сколько приёмов пищи в день?",
+            "Три приёма пищи в день": "2. Есть ли у вас аллергия?",
+            "Аллергии нет, цель — снижение жира, бюджет средний": _menu(3),
+        },
+    ),
+    "commit": Scenario(
+        "04_agent_communication",
+        ("Added a login form #{n}",),
+        expect="dd feature",
+        routes=(
+            ("пишет сообщения коммитов", ("[Project] Add feature {n}.", "[project] add feature {n}", "[Bugfix] Add feature {n}.")),
+            ("валидатор", ("OK_AGENT1", "OK_AGENT1", "Issues:\n- Tag does not match the change.\n\nProposed:\n[Project] Add feature.")),
+        ),
+    ),
+}
+
+
+def _write_transcript(path: str, scenario: Scenario, replay: str | None) -> None:
+    # Recorded answers go first: Transcripts keeps the first entry per user message
+    with open(path, "w", encoding="utf-8") as out:
+        if replay:
+            with open(replay, "r", encoding="utf-8") as f:
+                out.write(f.read().rstrip("\n") + "\n")
+        for text, answer in scenario.answers.items():
+            entry = {"model": scenario.model, "messages": [{"role": "user", "content": text}], "content": answer}
+            out.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def _metric_total(text: str, name: str) -> float:
+    return sum(float(line.rsplit(" ", 1)[1]) for line in text.splitlines() if line.startswith(name + "{"))
+
+
+class _TimedQueue(queue.Queue):
+    # Stamps the first answer token the Tk worker hands to the UI thread
+    def __init__(self) -> None:
+        super().__init__()
+        self.first_token: float | None = None
+
+    def put(self, item, block=True, timeout=None) -> None:  # noqa: ANN001
+        if self.first_token is None and isinstance(item, tuple) and item[0] == "token":
+            self.first_token = time.perf_counter()
+        super().put(item, block, timeout)
+
+
+def _run_tk(scenario: Scenario, conversations: int, concurrency: int) -> tuple[int, list[float], list[float]]:
+    (main_mod,) = import_lesson(scenario.lesson, "main")
+    lock = threading.Lock()
+    done: list[float] = []
+    first: list[float] = []
+
+    def conversation(n: int) -> bool:
+        # The worker thread of ChatApplication without a Tk root: the UI thread is replaced
+        # by draining the queue, which is what _poll_stream_queue does every frame
+        app = main_mod.ChatApplication.__new__(main_mod.ChatApplication)
+        app._active_response = None
+        messages: list[dict[str, str]] = []
+        answer = ""
+        for text in scenario.script:
+            app.stream_queue = _TimedQueue()
+            messages.append({"role": "user", "content": text.format(n=n)})
+            started = time.perf_counter()
+            app._stream_assistant_reply(list(messages), threading.Event())
+            items = list(app.stream_queue.queue)
+            kind, answer = items[-1]
+            with lock:
+                done.append(time.perf_counter() - started)
+                if app.stream_queue.first_token is not None:
+                    first.append(app.stream_queue.first_token - started)
+            if kind != "done":
+                return False
+            messages.append({"role": "assistant", "content": answer})
+        return scenario.expect in answer
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        ok = sum(pool.map(conversation, range(conversations)))
+    main_mod.get_client().close()
+    return ok, done, first
+
+
+async def _run_telegram(scenario: Scenario, conversations: int, concurrency: int, api_latency: float) -> tuple[int, list[float], list[float]]:
+    from aiogram import Dispatcher
+    from fake_telegram import Conversation, TelegramFeeder
+
+    (main_mod,) = import_lesson(scenario.lesson, "main")
+    dp = Dispatcher()
+    dp.include_router(main_mod.router)
+    feeder = TelegramFeeder(dp, chat_dispatcher=getattr(main_mod, "DISPATCHER", None), api_latency=api_latency)
+    semaphore = asyncio.Semaphore(concurrency)
+    finished: list[Conversation] = []
+
+    async def conversation(n: int) -> None:
+        async with semaphore:
+            conv = Conversation(chat_id=10_000 + n)
+            for text in scenario.script:
+                await feeder.send(conv, text.format(n=n))
+            finished.append(conv)
+
+    await asyncio.gather(*(conversation(n) for n in range(conversations)))
+    ok = sum(bool(replies) and scenario.expect in replies[-1] for replies in (feeder.replies(c.chat_id) for c in finished))
+    await feeder.close()
+    await main_mod.aclose_clients()
+    return ok, [t for c in finished for t in c.done], [t for c in finished for t in c.first_reply]
+
+
+def run_scenario(name: str, options: dict, results: "multiprocessing.Queue[dict]") -> None:
+    scenario = SCENARIOS[name]
+    if options["replay"] or options["upstream"]:
+        # Real answers: a conversation is ok when every message got a reply
+        scenario = replace(scenario, expect="")
+    workdir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    replay = os.path.join(workdir, "transcript.jsonl")
+    _write_transcript(replay, scenario, options["replay"])
+    config = FakeConfig(
+        latency=options["latency"],
+        jitter=options["jitter"],
+        token_rate=options["token_rate"],
+        routes=scenario.routes,
+        seed=options["seed"],
+        replay=replay,
+        reasoning=scenario.reasoning,
+        upstream=options["upstream"],
+        record=options["record"],
+    )
+    proc, base_url = start_in_process(config)
+    # The bots read their configuration at import time
+    os.environ.update(
+        OPENAI_API_KEY=os.getenv("OPENAI_API_KEY") or "bench",
+        OPENAI_BASE_URL=base_url,
+        TELEGRAM_API_KEY="123456:bench",
+        SESSIONS_DB=os.path.join(workdir, "sessions.sqlite3"),
+        CHAT_DEBOUNCE="0",
+    )
+    # The bots print every negotiation round and LLM call; --verbose keeps it
+    quiet = contextlib.nullcontext() if options["verbose"] else contextlib.redirect_stdout(open(os.devnull, "w"))
+    try:
+        with quiet:
+            started = time.perf_counter()
+            if name == "tk":
+                ok, done, first = _run_tk(scenario, options["conversations"], options["concurrency"])
+            else:
+                ok, done, first = asyncio.run(
+                    _run_telegram(scenario, options["conversations"], options["concurrency"], options["api_latency"])
+                )
+            elapsed = time.perf_counter() - started
+    finally:
+        proc.terminate()
+
+    metrics = sys.modules["llm_metrics"].METRICS.render_prometheus()
+    count = options["conversations"]
+    results.put(
+        {
+            "scenario": name,
+            "ok": ok,
+            "conversations": count,
+            "conv_per_s": count / elapsed,
+            "p50_ms": statistics.median(done) * 1000,
+            "p99_ms": percentile(done, 99) * 1000,
+            "first_reply_p50_ms": statistics.median(first) * 1000 if first else None,
+            "llm_calls_per_conv": _metric_total(metrics, "llm_requests_total") / count,
+            "tokens_per_conv": (
+                _metric_total(metrics, "llm_prompt_tokens_total") + _metric_total(metrics, "llm_completion_tokens_total")
+            )
+            / count,
+            # ru_maxrss is in KiB on Linux
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+    )
+
+
+def report(result: dict) -> None:
+    first = result["first_reply_p50_ms"]
+    print(
+        f"{result['scenario']:<11} ok={result['ok']}/{result['conversations']}  "
+        f"conv/s={result['conv_per_s']:7.1f}  p50={result['p50_ms']:7.1f}ms  p99={result['p99_ms']:7.1f}ms  "
+        f"first={'-' if first is None else f'{first:.1f}ms':>8}  "
+        f"calls/conv={result['llm_calls_per_conv']:4.1f}  tokens/conv={result['tokens_per_conv']:7.0f}  "
+        f"rss={result['peak_rss_mb']:6.1f}MB"
+    )
+
+
+# Metric -> True if higher is better; anything worse than the baseline by more than --tolerance is flagged
+COMPARED = {"conv_per_s": True, "p50_ms": False, "p99_ms": False, "tokens_per_conv": False, "peak_rss_mb": False}
+
+
+def compare(results: list[dict], baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for result in results:
+        base = baseline.get("results", {}).get(result["scenario"])
+        if base is None:
+            continue
+        if result["ok"] < base["ok"]:
+            regressions.append(f"{result['scenario']}: ok {base['ok']} -> {result['ok']}")
+        for metric, higher_is_better in COMPARED.items():
+            before, after = base[metric], result[metric]
+            if not before:
+                continue
+            change = (after - before) / before
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{result['scenario']}: {metric} {before:.1f} -> {after:.1f} ({change:+.0%})")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated subset of: " + ", ".join(SCENARIOS))
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.3)
+    parser.add_argument("--token-rate", type=float, default=400)
+    parser.add_argument("--api-latency", type=float, default=0.03, help="Bot API round trip of the fake Telegram")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--replay", default=None, help="JSONL transcript recorded with fake_openai.py --record")
+    parser.add_argument("--upstream", default=None, help="record against this real base URL instead of the stub")
+    parser.add_argument("--record", default=None, help="append the real answers to this JSONL transcript")
+    parser.add_argument("--out", default=None, help="write the results as a JSON baseline")
+    parser.add_argument("--compare", default=None, help="flag regressions against a JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    parser.add_argument("--verbose", action="store_true", help="keep the bots' own output")
+    args = parser.parse_args()
+
+    options = {
+        "conversations": args.conversations,
+        "concurrency": args.concurrency,
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "token_rate": args.token_rate,
+        "api_latency": args.api_latency,
+        "seed": args.seed,
+        "replay": args.replay,
+        "upstream": args.upstream,
+        "record": args.record,
+        "verbose": args.verbose,
+    }
+    # A fresh interpreter per scenario: lessons share module names and RSS is per bot
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in args.scenarios.split(","):
+        channel = context.Queue()
+        proc = context.Process(target=run_scenario, args=(name, options, channel))
+        proc.start()
+        try:
+            result = channel.get(timeout=600)
+        except queue.Empty:
+            result = None
+        proc.join()
+        if result is None:
+            print(f"{name:<11} failed (exit code {proc.exitcode})")
+            continue
+        report(result)
+        results.append(result)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"options": options, "results": {r["scenario"]: r for r in results}}, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
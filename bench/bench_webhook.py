@@ -0,0 +1,166 @@
+"""Webhook mode scaling (04 commit bot): handled updates per second with 1..N worker processes.
+
+For every worker count the bot is started as `python main.py` in webhook mode
+(WEBHOOK_WORKERS=N: a front process shards chats over N bot processes) against the
+OpenAI stub and a fake Bot API served from this process. Updates are pushed the way
+Telegram does it: many chats at once, the messages of one chat one after another;
+an update counts as handled when the bot's reply reaches the Bot API.
+
+Usage: python bench/bench_webhook.py --workers 1,2,4 --chats 200 --messages 5
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from aiohttp import ClientSession, TCPConnector, web
+
+from _lessons import ROOT
+from bench_async_client import percentile
+from bench_commit_speculative import ROUTES
+from fake_openai import FakeConfig, free_port, start_in_process
+from fake_telegram import FAKE_TOKEN, build_bot_api_app
+
+LESSON = "04_agent_communication"
+SECRET = "bench-secret"
+
+
+def make_update(update_id: int, chat_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+            "text": text,
+        },
+    }
+
+
+async def wait_for_port(port: int, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+        else:
+            writer.close()
+            return
+
+
+async def scenario(workers: int, base_url: str, chats: int, messages: int) -> tuple[float, list[float]]:
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    pending: dict[int, asyncio.Future] = {}
+
+    def on_call(method: str, params: dict[str, str]) -> None:
+        if method == "setWebhook":
+            ready.set()
+        elif method == "sendMessage":
+            future = pending.pop(int(params["chat_id"]), None)
+            if future is not None and not future.done():
+                future.set_result(time.perf_counter())
+
+    api = web.AppRunner(build_bot_api_app(on_call))
+    await api.setup()
+    api_port = free_port()
+    await web.TCPSite(api, "127.0.0.1", api_port).start()
+
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix="bench_webhook_")
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY="bench",
+        OPENAI_BASE_URL=base_url,
+        TELEGRAM_API_KEY=FAKE_TOKEN,
+        TELEGRAM_API_SERVER=f"http://127.0.0.1:{api_port}",
+        WEBHOOK_URL=f"http://127.0.0.1:{port}/webhook",
+        WEBHOOK_HOST="127.0.0.1",
+        WEBHOOK_PORT=str(port),
+        WEBHOOK_SECRET=SECRET,
+        WEBHOOK_WORKERS=str(workers),
+        WEBHOOK_WORKER_PORT=str(free_port()),
+        SESSIONS_DB=os.path.join(workdir, "sessions.sqlite3"),
+        CHAT_DEBOUNCE="0",
+    )
+    bot = subprocess.Popen([sys.executable, "main.py"], cwd=ROOT / LESSON, env=env, stdout=subprocess.DEVNULL)
+    latencies: list[float] = []
+    try:
+        # The front registers the webhook only once every worker listens; aiohttp binds right after
+        await asyncio.wait_for(ready.wait(), timeout=60)
+        await wait_for_port(port)
+        url = f"http://127.0.0.1:{port}/webhook"
+        headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+        async with ClientSession(connector=TCPConnector(limit=0)) as session:
+
+            async def chat(chat_id: int) -> None:
+                for i in range(messages):
+                    future = pending[chat_id] = loop.create_future()
+                    started = time.perf_counter()
+                    update = make_update(chat_id * messages + i, chat_id, f"Added a login form #{i}")
+                    async with session.post(url, json=update, headers=headers) as resp:
+                        resp.raise_for_status()
+                    latencies.append(await asyncio.wait_for(future, timeout=60) - started)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(chat(1000 + n) for n in range(chats)))
+            elapsed = time.perf_counter() - started
+    finally:
+        bot.send_signal(signal.SIGINT)
+        try:
+            bot.wait(timeout=20)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        await api.cleanup()
+    return elapsed, latencies
+
+
+async def main_async(base_url: str, worker_counts: list[int], chats: int, messages: int) -> None:
+    # Throughput of one worker, taken from the first run; speedup is measured in those units
+    per_worker = None
+    for workers in worker_counts:
+        elapsed, latencies = await scenario(workers, base_url, chats, messages)
+        rate = len(latencies) / elapsed
+        per_worker = per_worker or rate / workers
+        speedup = rate / per_worker
+        print(
+            f"workers={workers:<3} updates/s={rate:8.1f}  "
+            f"p50={statistics.median(latencies) * 1000:7.1f}ms  p99={percentile(latencies, 99) * 1000:7.1f}ms  "
+            f"speedup={speedup:4.2f}x  efficiency={speedup / workers:4.0%}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated worker counts")
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    worker_counts = [int(n) for n in args.workers.split(",")]
+    cores = os.cpu_count() or 1
+    if max(worker_counts) > cores:
+        print(f"note: {cores} CPU core(s) here, worker counts above that cannot scale")
+
+    config = FakeConfig(latency=args.latency, routes=ROUTES, seed=1)
+    proc, base_url = start_in_process(config)
+    try:
+        asyncio.run(main_async(base_url, worker_counts, args.chats, args.messages))
+    finally:
+        proc.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import random
+import socket
+import time
+import uuid
+from dataclasses import dataclass, field
+
+from aiohttp import ClientSession, web
+
+
+@dataclass
+class FakeConfig:
+    latency: float = 0.2
+    content: str = "OK_AGENT1"
+    # reasoning_content sent before every answer, like deepseek-reasoner ("" = none)
+    reasoning: str = ""
+    # Lognormal sigma applied to latency (0 = fixed latency)
+    jitter: float = 0.0
+    # (marker, answers): if the system prompt contains marker, answer with a random choice;
+    # "{n}" in an answer is replaced with a request counter
+    routes: tuple[tuple[str, tuple[str, ...]], ...] = field(default_factory=tuple)
+    seed: int | None = None
+    # Generation speed: ~4 chars ("tokens") per chunk at this rate per second (0 = no delay)
+    token_rate: float = 0.0
+    # Fault injection: share of requests answered with error_status (plus Retry-After if set)
+    error_rate: float = 0.0
+    error_status: int = 503
+    retry_after: float | None = None
+    # Tail latency: share of requests that take slow_factor times longer
+    slow_rate: float = 0.0
+    slow_factor: float = 10.0
+    # Outage window in seconds since server start: every request fails with error_status
+    outage: tuple[float, float] | None = None
+    # Provider rate limit: requests over this many per minute get 429 + Retry-After (0 = unlimited)
+    rpm_limit: float = 0.0
+    # JSONL transcript (see Transcripts): recorded answers are replayed, unknown requests fall back to routes
+    replay: str | None = None
+    # Record mode: forward every request to this OpenAI-compatible base URL and append it to `record`
+    upstream: str | None = None
+    record: str | None = None
+
+    def pick_fault(self, rng: random.Random, uptime: float) -> bool:
+        if self.outage is not None and self.outage[0] <= uptime < self.outage[1]:
+            return True
+        return self.error_rate > 0 and rng.random() < self.error_rate
+
+    def pick_latency(self, rng: random.Random) -> float:
+        latency = self.latency
+        if self.jitter > 0:
+            latency *= rng.lognormvariate(0.0, self.jitter)
+        if self.slow_rate > 0 and rng.random() < self.slow_rate:
+            latency *= self.slow_factor
+        return latency
+
+    def pick_content(self, rng: random.Random, messages: list[dict], counter: int) -> str:
+        system = next((str(m.get("content") or "") for m in messages if m.get("role") == "system"), "")
+        for marker, answers in self.routes:
+            if marker in system:
+                return rng.choice(answers).replace("{n}", str(counter))
+        return self.content
+
+
+def transcript_key(model: str, messages: list[dict]) -> str:
+    # Recorded answers are looked up by the exact conversation sent to the model
+    payload = json.dumps([model, [[m.get("role"), m.get("content")] for m in messages]], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _last_user(messages: list[dict]) -> str:
+    return next((str(m.get("content") or "") for m in reversed(messages) if m.get("role") == "user"), "")
+
+
+class Transcripts:
+    # Real conversations recorded with --record, one JSON object per line:
+    # {"model", "messages", "content", "reasoning_content", "usage"}. A request is
+    # matched exactly first, then by its last user message (history may differ
+    # between the recording and the benchmark).
+
+    def __init__(self, path: str | None = None) -> None:
+        self.exact: dict[str, dict] = {}
+        self.by_last_user: dict[str, dict] = {}
+        if path:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        self.add(json.loads(line))
+
+    def add(self, entry: dict) -> None:
+        self.exact[transcript_key(entry.get("model", ""), entry["messages"])] = entry
+        self.by_last_user.setdefault(_last_user(entry["messages"]), entry)
+
+    def find(self, model: str, messages: list[dict]) -> dict | None:
+        return self.exact.get(transcript_key(model, messages)) or self.by_last_user.get(_last_user(messages))
+
+    def __len__(self) -> int:
+        return len(self.exact)
+
+
+def _completion(model: str, content: str, prompt_chars: int, reasoning: str | None = None, usage: dict | None = None) -> dict:
+    prompt_tokens = max(1, prompt_chars // 4)
+    completion_tokens = max(1, (len(content) + len(reasoning or "")) // 4)
+    message = {"role": "assistant", "content": content}
+    if reasoning:
+        message["reasoning_content"] = reasoning
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "message": message,
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": usage
+        or {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def _chunk(model: str, chunk_id: str, delta: dict, finish_reason: str | None = None) -> bytes:
+    payload = {
+        "id": chunk_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+async def _stream(
+    request: web.Request, config: FakeConfig, model: str, content: str, usage: dict | None, reasoning: str | None = None
+) -> web.StreamResponse:
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+    chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+    interval = 1.0 / config.token_rate if config.token_rate > 0 else 0.0
+    await response.write(_chunk(model, chunk_id, {"role": "assistant", "content": ""}))
+    for i in range(0, len(reasoning or ""), 4):
+        if interval:
+            await asyncio.sleep(interval)
+        await response.write(_chunk(model, chunk_id, {"reasoning_content": reasoning[i : i + 4]}))
+    for i in range(0, len(content), 4):
+        if interval:
+            await asyncio.sleep(interval)
+        await response.write(_chunk(model, chunk_id, {"content": content[i : i + 4]}))
+    await response.write(_chunk(model, chunk_id, {}, "stop"))
+    if usage is not None:
+        # stream_options.include_usage: trailing chunk with empty choices
+        tail = {"id": chunk_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model, "choices": [], "usage": usage}
+        await response.write(f"data: {json.dumps(tail)}\n\n".encode("utf-8"))
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+
+def build_app(config: FakeConfig) -> web.Application:
+    if config.upstream and not config.record:
+        raise ValueError("record mode needs a transcript path (--record)")
+    rng = random.Random(config.seed)
+    transcripts = Transcripts(config.replay)
+    session: ClientSession | None = None
+    counter = 0
+    started = time.monotonic()
+    # Token bucket for rpm_limit, one second of burst like real providers
+    allowance = config.rpm_limit / 60.0
+    refilled = started
+
+    async def chat_completions(request: web.Request) -> web.StreamResponse:
+        nonlocal counter, allowance, refilled
+        counter += 1
+        if config.rpm_limit > 0:
+            now = time.monotonic()
+            allowance = min(config.rpm_limit / 60.0, allowance + (now - refilled) * config.rpm_limit / 60.0)
+            refilled = now
+            if allowance < 1:
+                wait = (1 - allowance) * 60.0 / config.rpm_limit
+                error = {"error": {"message": "rate limit reached", "type": "rate_limit_error", "code": None}}
+                return web.json_response(error, status=429, headers={"Retry-After": f"{wait:.3f}"})
+            allowance -= 1
+        body = await request.json()
+        model = body.get("model", "fake")
+        messages = body.get("messages", [])
+        prompt_chars = sum(len(str(m.get("content") or "")) for m in messages)
+        if config.upstream:
+            entry = await forward(request, body)
+            completion = _completion(model, entry["content"], prompt_chars, entry.get("reasoning_content"), entry.get("usage"))
+            return await respond(request, body, completion, entry)
+        if config.pick_fault(rng, time.monotonic() - started):
+            headers = {"Retry-After": f"{config.retry_after:g}"} if config.retry_after is not None else None
+            error = {"error": {"message": "injected fault", "type": "server_error", "code": None}}
+            return web.json_response(error, status=config.error_status, headers=headers)
+        entry = transcripts.find(model, messages) or {
+            "content": config.pick_content(rng, messages, counter),
+            "reasoning_content": config.reasoning or None,
+        }
+        # latency models time to first token
+        await asyncio.sleep(config.pick_latency(rng))
+        completion = _completion(model, entry["content"], prompt_chars, entry.get("reasoning_content"), entry.get("usage"))
+        if not body.get("stream") and config.token_rate > 0:
+            # Non-streamed answers take the same generation time, they just arrive at once
+            await asyncio.sleep(completion["usage"]["completion_tokens"] / config.token_rate)
+        return await respond(request, body, completion, entry)
+
+    async def respond(request: web.Request, body: dict, completion: dict, entry: dict) -> web.StreamResponse:
+        if body.get("stream"):
+            include_usage = (body.get("stream_options") or {}).get("include_usage")
+            usage = completion["usage"] if include_usage else None
+            return await _stream(request, config, completion["model"], entry["content"], usage, entry.get("reasoning_content"))
+        return web.json_response(completion)
+
+    async def forward(request: web.Request, body: dict) -> dict:
+        # Record mode: the real provider answers (non-streamed), the stub re-streams it if asked
+        upstream_body = {k: v for k, v in body.items() if k not in ("stream", "stream_options")}
+        headers = {"Authorization": request.headers.get("Authorization", "")}
+        async with session.post(f"{config.upstream.rstrip('/')}/chat/completions", json=upstream_body, headers=headers) as resp:
+            data = await resp.json()
+        message = data["choices"][0]["message"]
+        entry = {
+            "model": body.get("model", ""),
+            "messages": body.get("messages", []),
+            "content": message.get("content") or "",
+            "reasoning_content": message.get("reasoning_content"),
+            "usage": data.get("usage"),
+        }
+        with open(config.record, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        return entry
+
+    async def on_startup(app: web.Application) -> None:
+        nonlocal session
+        if config.upstream:
+            session = ClientSession()
+
+    async def on_cleanup(app: web.Application) -> None:
+        if session is not None:
+            await session.close()
+
+    app = web.Application()
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_post("/chat/completions", chat_completions)
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    return app
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve(port: int, config: FakeConfig) -> None:
+    # Clients cancelling in-flight requests (hedging, speculation) is expected here
+    logging.getLogger("aiohttp.server").setLevel(logging.CRITICAL)
+    logging.getLogger("asyncio").setLevel(logging.CRITICAL)
+    web.run_app(build_app(config), host="127.0.0.1", port=port, print=None)
+
+
+def start_in_process(config: FakeConfig) -> tuple[multiprocessing.Process, str]:
+    port = free_port()
+    proc = multiprocessing.Process(target=serve, args=(port, config), daemon=True)
+    proc.start()
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                break
+        except OSError:
+            time.sleep(0.05)
+    return proc, f"http://127.0.0.1:{port}/v1"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible stub server")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--token-rate", type=float, default=0.0)
+    parser.add_argument("--content", default="OK_AGENT1")
+    parser.add_argument("--reasoning", default="", help="reasoning_content streamed before every answer")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--retry-after", type=float, default=None)
+    parser.add_argument("--slow-rate", type=float, default=0.0)
+    parser.add_argument("--replay", default=None, help="JSONL transcript to answer from")
+    parser.add_argument("--record", default=None, help="append real conversations to this JSONL transcript")
+    parser.add_argument("--upstream", default=None, help="real OpenAI-compatible base URL for --record")
+    args = parser.parse_args()
+    serve(
+        args.port,
+        FakeConfig(
+            latency=args.latency,
+            content=args.content,
+            reasoning=args.reasoning,
+            jitter=args.jitter,
+            token_rate=args.token_rate,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+            retry_after=args.retry_after,
+            slow_rate=args.slow_rate,
+            replay=args.replay,
+            upstream=args.upstream,
+            record=args.record,
+        ),
+    )
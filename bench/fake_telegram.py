@@ -0,0 +1,168 @@
+"""Fake Telegram for the bots: updates are fed straight into an aiogram Dispatcher,
+Bot API calls are answered locally and recorded instead of going to api.telegram.org.
+"""
+from __future__ import annotations
+
+import asyncio
+import itertools
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.base import BaseSession
+from aiogram.enums import ParseMode
+from aiogram.methods import TelegramMethod
+from aiogram.types import Chat, Message, Update, User
+from aiohttp import web
+
+# Syntactically valid token: aiogram checks the format, nothing is ever sent
+FAKE_TOKEN = "123456:FAKE-telegram-token-for-benchmarks"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Bench"}
+
+
+@dataclass
+class ApiCall:
+    at: float
+    method: str
+    chat_id: Optional[int]
+    message_id: Optional[int]
+    text: Optional[str]
+
+
+class FakeTelegramSession(BaseSession):
+    # Answers sendMessage/editMessageText with a Message and everything else with True,
+    # after `latency` seconds (Bot API round trip). Every call is kept in `calls`.
+
+    def __init__(self, *, latency: float = 0.0) -> None:
+        super().__init__()
+        self.latency = latency
+        self.calls: List[ApiCall] = []
+        self._message_ids = itertools.count(1000)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod[Any], timeout: Optional[int] = None) -> Any:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        name = type(method).__name__
+        chat_id = getattr(method, "chat_id", None)
+        text = getattr(method, "text", None)
+        message_id = getattr(method, "message_id", None)
+        if name == "SendMessage":
+            message_id = next(self._message_ids)
+        self.calls.append(ApiCall(time.perf_counter(), name, chat_id, message_id, text))
+        if name in ("SendMessage", "EditMessageText"):
+            return Message.model_validate(
+                {
+                    "message_id": message_id,
+                    "date": datetime.now(timezone.utc),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "from": BOT_USER,
+                    "text": text,
+                },
+                context={"bot": bot},
+            )
+        if name == "GetMe":
+            return User.model_validate(BOT_USER)
+        return True
+
+    async def close(self) -> None:
+        pass
+
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None, timeout: int = 30, chunk_size: int = 65536, raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:  # noqa: E501
+        raise NotImplementedError
+        yield b""
+
+
+@dataclass
+class Conversation:
+    chat_id: int
+    # Seconds from each user message to the first bot message and to the end of its handling
+    first_reply: List[float] = field(default_factory=list)
+    done: List[float] = field(default_factory=list)
+
+
+class TelegramFeeder:
+    # Drives a bot's router like Telegram would: one Update per user message.
+    # For bots that hand messages to a ChatDispatcher (03, 04) pass it in, so
+    # send() returns only once the reply has been produced.
+
+    def __init__(self, dispatcher: Dispatcher, *, chat_dispatcher: Any = None, api_latency: float = 0.0) -> None:
+        self.dp = dispatcher
+        self.chat_dispatcher = chat_dispatcher
+        self.session = FakeTelegramSession(latency=api_latency)
+        self.bot = Bot(FAKE_TOKEN, session=self.session, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN_V2))
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def update(self, chat_id: int, text: str) -> Update:
+        user = User(id=chat_id, is_bot=False, first_name=f"user{chat_id}")
+        message = Message(
+            message_id=next(self._message_ids),
+            date=datetime.now(timezone.utc),
+            chat=Chat(id=chat_id, type="private"),
+            from_user=user,
+            text=text,
+        )
+        return Update(update_id=next(self._update_ids), message=message)
+
+    async def send(self, conversation: Conversation, text: str) -> None:
+        started = time.perf_counter()
+        sent_before = len(self.session.calls)
+        await self.dp.feed_update(self.bot, self.update(conversation.chat_id, text))
+        if self.chat_dispatcher is not None:
+            await self.chat_dispatcher.join(conversation.chat_id)
+        conversation.done.append(time.perf_counter() - started)
+        first = next(
+            (
+                call.at
+                for call in self.session.calls[sent_before:]
+                if call.method == "SendMessage" and call.chat_id == conversation.chat_id
+            ),
+            None,
+        )
+        if first is not None:
+            conversation.first_reply.append(first - started)
+
+    def replies(self, chat_id: int) -> List[str]:
+        # Final text of every bot message in the chat (edits replace the streamed drafts)
+        texts: Dict[int, str] = {}
+        for call in self.session.calls:
+            if call.chat_id != chat_id or call.text is None:
+                continue
+            if call.method == "SendMessage" or (call.method == "EditMessageText" and call.message_id in texts):
+                texts[call.message_id] = call.text
+        return list(texts.values())
+
+    async def close(self) -> None:
+        await self.bot.session.close()
+
+
+def build_bot_api_app(on_call: Optional[Callable[[str, Dict[str, str]], None]] = None) -> web.Application:
+    # The same answers over HTTP, for bots in other processes (TELEGRAM_API_SERVER=http://host:port):
+    # POST /bot<token>/<method> with aiogram's form-encoded parameters
+    message_ids = itertools.count(1000)
+
+    async def handle(request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = {key: str(value) for key, value in (await request.post()).items()}
+        if on_call is not None:
+            on_call(method, params)
+        result: Any = True
+        if method in ("sendMessage", "editMessageText"):
+            message_id = int(params["message_id"]) if "message_id" in params else next(message_ids)
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        elif method == "getMe":
+            result = BOT_USER
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle)
+    return app